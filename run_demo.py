@@ -5,17 +5,20 @@ TODO:
 # built-in modules
 import argparse
 import importlib
+import json
 import logging
 import os
 import shutil
 import sys
 from pprint import pformat
 
+import pandas as pd
 import yaml
 
 sys.path.append(".")
 
 from src.utils.basic.general import get_timestamp, key_in_dict
+from src.utils.basic.profiling import ResourceMonitor
 
 # set logging configuration
 os.makedirs("logs", exist_ok=True)
@@ -116,6 +119,14 @@ class ExperimentRunner:
         config_fname = self.config_path.split("/")[-1]
         shutil.copy(src=self.config_path, dst=output_dir + "/" + config_fname)
 
+    def _save_resource_usage(self, resource_usage, output_dir):
+        r"""Saves the resources used by the pipeline steps as json and csv file in the timestamped output dir."""
+        with open(os.path.join(output_dir, "resource_usage.json"), "w") as file:
+            json.dump(resource_usage, file, indent=2)
+        pd.DataFrame(resource_usage).to_csv(
+            os.path.join(output_dir, "resource_usage.csv"), index=False
+        )
+
     def run(self):
         r""" Method to run the pipeline configuration defined in :py:attr:`config_dict`.
         TODO
@@ -164,14 +175,35 @@ class ExperimentRunner:
             pass
         self._save_config(self.timestamped_output_dir)
 
-        # Run all the steps in the pipeline
-        for step in self.config_dict["pipeline"]:
+        # Run all the steps in the pipeline while measuring the resources used by every step. The summary is saved
+        # after every step such that it is available for the completed steps if a later step fails.
+        resource_usage = []
+        for i, step in enumerate(self.config_dict["pipeline"]):
             instance_method = getattr(exp_instance, step["method"])
-            if key_in_dict("params", step):
-                params = step["params"]
-                instance_method(**params)
-            else:
-                instance_method()
+            # Experiment classes can report the number of processed items (e.g. images, nuclei) of a step in their
+            # item_counts attribute
+            if hasattr(exp_instance, "item_counts"):
+                exp_instance.item_counts = {}
+            with ResourceMonitor() as monitor:
+                if key_in_dict("params", step):
+                    params = step["params"]
+                    instance_method(**params)
+                else:
+                    instance_method()
+            stats = {"step": i, "method": step["method"]}
+            stats.update(monitor.get_stats())
+            stats.update(getattr(exp_instance, "item_counts", {}))
+            resource_usage.append(stats)
+            logging.debug(
+                "Step {} ({}) took {:.1f}s wall time, {:.1f}s CPU time, {:.2f} GB peak RSS.".format(
+                    i,
+                    step["method"],
+                    stats["wall_time"],
+                    stats["cpu_time"],
+                    stats["peak_rss"] / 1e9,
+                )
+            )
+            self._save_resource_usage(resource_usage, self.timestamped_output_dir)
 
         # Copy the log-file to the output directory
         shutil.copy(src=log_filename, dst=self.timestamped_output_dir + "/")
@@ -0,0 +1,170 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+
+import pandas as pd
+
+sys.path.append(".")
+
+from src.preprocessing.image_preprocessing import ImageDatasetPreprocessor
+from src.utils.basic.io import read_table
+from src.utils.basic.profiling import ResourceMonitor
+from src.utils.basic.synthetic import generate_synthetic_plates
+
+
+def get_stages(data_dir: str, n_jobs: int, target_size: int):
+    # Stages of the preprocessing pipeline as (name, method, params) in the order of execution
+    crop_params = {
+        "label_image_input_dir": os.path.join(data_dir, "labels"),
+        "min_area": 100,
+        "max_area": 4000,
+        "max_bbarea": 6000,
+        "max_eccentricity": 0.99,
+        "min_solidity": 0.1,
+        "min_aspect_ratio": 0.1,
+        "n_jobs": n_jobs,
+    }
+    return [
+        ("add_illumination_col", "add_image_illumination_col", {}),
+        ("qc_filtering", "filter_out_qc_flagged_images", {}),
+        ("save_filtered_images", "save_filtered_images", {"n_jobs": n_jobs}),
+        (
+            "segmentation",
+            "segment_all_images_given_outlines",
+            {"outline_input_dir": os.path.join(data_dir, "outlines"), "n_jobs": n_jobs},
+        ),
+        (
+            "crops",
+            "get_nuclear_crops",
+            dict(crop_params, extract_ncmo_features=False),
+        ),
+        (
+            "crops_nmco",
+            "get_nuclear_crops",
+            dict(crop_params, extract_ncmo_features=True),
+        ),
+        (
+            "padding",
+            "save_padded_images",
+            {"target_size": [target_size, target_size], "n_jobs": n_jobs},
+        ),
+        (
+            "resizing",
+            "resize_and_save_images",
+            {"target_size": [target_size, target_size], "n_jobs": n_jobs},
+        ),
+    ]
+
+
+def run_benchmark(
+    data_dir: str, output_dir: str, n_jobs: int, target_size: int, skip_nmco: bool
+):
+    preprocessor = ImageDatasetPreprocessor(
+        image_input_dir=os.path.join(data_dir, "images"),
+        metadata_file=os.path.join(data_dir, "metadata.csv"),
+        output_dir=output_dir,
+    )
+    results = []
+    for name, method, params in get_stages(data_dir, n_jobs, target_size):
+        if name == "crops_nmco" and skip_nmco:
+            continue
+        with ResourceMonitor() as monitor:
+            getattr(preprocessor, method)(**params)
+        stats = monitor.get_stats()
+        # Throughput is given w.r.t. the number of nuclei for the stages processing nuclei
+        if name.startswith("crops") or name in ["padding", "resizing"]:
+            stats["n_nuclei"] = len(
+                read_table(preprocessor.nuclei_metadata_file, columns=["image_file"])
+            )
+            stats["nuclei_per_s"] = stats["n_nuclei"] / max(stats["wall_time"], 1e-9)
+        stats["n_images"] = len(preprocessor.metadata)
+        stats["images_per_s"] = stats["n_images"] / max(stats["wall_time"], 1e-9)
+        stats["stage"] = name
+        results.append(stats)
+        logging.info(
+            "{}: {:.2f}s, peak RSS {:.0f} MB".format(
+                name, stats["wall_time"], stats["peak_rss"] / 2 ** 20
+            )
+        )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the stages of the image preprocessing pipeline on synthetic plates."
+    )
+    parser.add_argument(
+        "--n_images",
+        type=int,
+        nargs="+",
+        default=[8, 32],
+        help="Numbers of images per plate (scales) to benchmark.",
+    )
+    parser.add_argument("--n_plates", type=int, default=2)
+    parser.add_argument("--n_jobs", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--image_size", type=int, default=1024)
+    parser.add_argument("--n_nuclei", type=int, default=150)
+    parser.add_argument("--target_size", type=int, default=64)
+    parser.add_argument("--skip_nmco", action="store_true")
+    parser.add_argument(
+        "--work_dir",
+        type=str,
+        default=None,
+        help="Directory for the synthetic data and outputs (a temporary directory by default).",
+    )
+    parser.add_argument("--results_file", type=str, default="benchmark_results.json")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    work_dir = args.work_dir
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix="i2r_benchmark_")
+
+    results = []
+    for n_images in args.n_images:
+        data_dir = os.path.join(work_dir, "data_{}".format(n_images))
+        if not os.path.exists(os.path.join(data_dir, "metadata.csv")):
+            generate_synthetic_plates(
+                data_dir,
+                n_plates=args.n_plates,
+                n_images_per_plate=n_images,
+                image_size=args.image_size,
+                n_nuclei=args.n_nuclei,
+            )
+        for n_jobs in args.n_jobs:
+            logging.info("Images per plate: {}, workers: {}".format(n_images, n_jobs))
+            output_dir = os.path.join(work_dir, "output")
+            if os.path.exists(output_dir):
+                shutil.rmtree(output_dir)
+            os.makedirs(output_dir)
+            for stats in run_benchmark(
+                data_dir, output_dir, n_jobs, args.target_size, args.skip_nmco
+            ):
+                stats.update(
+                    {
+                        "n_plates": args.n_plates,
+                        "n_images_per_plate": n_images,
+                        "n_jobs": n_jobs,
+                        "image_size": args.image_size,
+                    }
+                )
+                results.append(stats)
+
+    with open(args.results_file, "w") as f:
+        json.dump(results, f, indent=2)
+    print(
+        pd.DataFrame(results)
+        .set_index(["n_images_per_plate", "n_jobs", "stage"])
+        .loc[:, ["wall_time", "cpu_time", "nuclei_per_s", "peak_rss", "read_bytes", "write_bytes"]]
+        .to_string()
+    )
+    if args.work_dir is None:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+import argparse
+import sys
+import time
+
+import numpy as np
+from skimage.io import imread
+
+sys.path.append(".")
+
+from src.utils.basic.feature_extraction import (
+    compute_carpenter_profiles,
+    compute_nuclear_chromatin_features,
+)
+from src.utils.basic.synthetic import get_synthetic_field_of_view
+
+
+def benchmark(profiler, label_image, intensity_image, n_repeats: int) -> float:
+    run_times = []
+    for _ in range(n_repeats):
+        start = time.time()
+        profiler(label_image=label_image, intensity_image=intensity_image)
+        run_times.append(time.time() - start)
+    return min(run_times)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compares the throughput of the nmco features and the CellProfiler-style profiles."
+    )
+    parser.add_argument("--image", type=str, default=None, help="Intensity image.")
+    parser.add_argument("--label_image", type=str, default=None, help="Label image.")
+    parser.add_argument("--size", type=int, default=1024)
+    parser.add_argument("--n_nuclei", type=int, default=200)
+    parser.add_argument("--n_repeats", type=int, default=3)
+    parser.add_argument("--skip_nmco", action="store_true")
+    args = parser.parse_args()
+
+    if args.image is not None and args.label_image is not None:
+        intensity_image = imread(args.image)
+        label_image = imread(args.label_image)
+    else:
+        intensity_image, label_image = get_synthetic_field_of_view(
+            image_size=args.size, n_nuclei=args.n_nuclei
+        )
+    n_nuclei = len(np.unique(label_image)) - 1
+
+    profilers = {"carpenter": compute_carpenter_profiles}
+    if not args.skip_nmco:
+        profilers["nmco"] = compute_nuclear_chromatin_features
+    print("Profiled {} nuclei in an image of size {}.".format(n_nuclei, label_image.shape))
+    for name, profiler in profilers.items():
+        run_time = benchmark(profiler, label_image, intensity_image, args.n_repeats)
+        print(
+            "{}: {:.3f}s ({:.1f} nuclei/s)".format(name, run_time, n_nuclei / run_time)
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -2,8 +2,8 @@ import copy
 import logging
 import os
 from abc import ABC
-from collections import Counter
-from typing import List, Iterable
+from collections import Counter, OrderedDict
+from typing import List, Iterable, Tuple
 
 import numpy as np
 import pandas as pd
@@ -11,12 +11,29 @@ import torch
 from PIL import Image
 from imblearn.under_sampling import RandomUnderSampler
 from skimage.io import imread
-from sklearn.preprocessing import LabelEncoder, StandardScaler, OneHotEncoder
+from sklearn.preprocessing import LabelEncoder, StandardScaler
 from torch import Tensor
 from torch.utils.data import Dataset, Subset, ConcatDataset
 from torchvision import transforms
 
-from src.utils.basic.general import combine_path
+from src.models.scaler import load_scaler, save_scaler, scalers
+from src.utils.basic.cache import MetadataIndexCache
+from src.utils.basic.general import combine_paths
+from src.utils.basic.io import get_table_columns, read_table
+from src.utils.basic.segmentation import normalize_image_to_uint8
+from src.utils.basic.storage import PackedCropStore, SharedImageCache
+
+
+def encode_labels(labels: Iterable, classes: List) -> np.ndarray:
+    # Equivalent to the transform of a label encoder with the given classes
+    codes = pd.Categorical(labels, categories=classes).codes
+    if (codes < 0).any():
+        raise ValueError(
+            "Labels not contained in the classes: {}".format(
+                list(pd.unique(np.asarray(labels)[codes < 0]))
+            )
+        )
+    return codes.astype(np.int64)
 
 
 class LabeledSlideDataset(Dataset, ABC):
@@ -29,17 +46,18 @@ class LabeledSlideDataset(Dataset, ABC):
         self.slide_image_names = None
 
     def create_slide_image_nuclei_dict_labels(self):
-        self.slide_image_nuclei_dict = dict()
-        for i in range(len(self.slide_image_names)):
-            slide_image_name = self.slide_image_names[i]
-            if slide_image_name in self.slide_image_nuclei_dict:
-                self.slide_image_nuclei_dict[slide_image_name].append(i)
-            else:
-                self.slide_image_nuclei_dict[slide_image_name] = [i]
-
-        self.slide_image_labels = np.array(
-            list(dict(zip(self.slide_image_names, self.labels)).values())
+        # The slide images are ordered by their first occurrence and labeled by their last nucleus
+        slide_codes, slide_image_names = pd.factorize(
+            np.asarray(self.slide_image_names), use_na_sentinel=False
         )
+        counts = np.bincount(slide_codes, minlength=len(slide_image_names))
+        slide_nuclei = np.argsort(slide_codes, kind="stable")
+        self.slide_image_nuclei_dict = dict(
+            zip(slide_image_names, np.split(slide_nuclei, np.cumsum(counts)[:-1]))
+        )
+        self.slide_image_labels = np.asarray(self.labels)[
+            slide_nuclei[np.cumsum(counts) - 1]
+        ]
 
 
 class TorchProfileSlideDataset(LabeledSlideDataset):
@@ -52,19 +70,30 @@ class TorchProfileSlideDataset(LabeledSlideDataset):
         exclude_features: List = None,
         image_name_col: str = "image_name",
         slide_image_name_col: str = "slide_image_name",
+        scaler: str = "standard",
+        scaler_file: str = None,
     ):
         super().__init__()
-        self.feature_labels = pd.read_csv(feature_label_file, index_col=0)
-        self.feature_labels = self.feature_labels.drop(columns=exclude_features)
+        # Only the required columns and the nuclei of the targets are read
+        if exclude_features is None:
+            exclude_features = []
+        columns = [
+            col
+            for col in get_table_columns(feature_label_file)
+            if col not in exclude_features
+        ]
+        if target_list is not None:
+            filters = {label_col: target_list}
+        else:
+            filters = None
+        self.feature_labels = read_table(
+            feature_label_file, columns=columns, filters=filters
+        )
         self.label_col = label_col
         self.n_control_samples = n_control_samples
         self.target_list = target_list
         self.slide_image_name_col = slide_image_name_col
 
-        if target_list is not None:
-            self.feature_labels = self.feature_labels.loc[
-                self.feature_labels[label_col].isin(target_list), :
-            ]
         if target_list is not None and "EMPTY" in target_list:
             idc = np.array(list(range(len(self.feature_labels)))).reshape(-1, 1)
             labels = self.feature_labels[self.label_col]
@@ -93,19 +122,35 @@ class TorchProfileSlideDataset(LabeledSlideDataset):
         )
         super().create_slide_image_nuclei_dict_labels()
 
-        self.features = np.array(
-            self.feature_labels.drop(
-                columns=list(
-                    set([label_col, slide_image_name_col, image_name_col]).intersection(
-                        set(self.feature_labels.columns)
-                    )
+        feature_labels = self.feature_labels.drop(
+            columns=list(
+                set([label_col, slide_image_name_col, image_name_col]).intersection(
+                    set(self.feature_labels.columns)
                 )
             )
         )
-        sc = StandardScaler()
-        # sc = RobustMAD()
-        self.features = sc.fit_transform(self.features)
-        self.features = np.clip(self.features, -15, 15)
+        feature_names = list(feature_labels.columns)
+        self.features = np.array(feature_labels, dtype=np.float32)
+        del feature_labels
+
+        # The scaler ("standard" or "robust_mad") is fitted and applied in chunks to avoid a float64 copy of all
+        # profiles. If a scaler file is given, the scaler fitted by an earlier run is reused, e.g. for the profiles of
+        # new targets, or the fitted scaler is saved otherwise.
+        chunk_size = 100000
+        if scaler_file is not None and os.path.exists(scaler_file):
+            sc = load_scaler(scaler_file, feature_names=feature_names)
+            logging.debug("Loaded the fitted scaler from {}.".format(scaler_file))
+        else:
+            sc = scalers[scaler]()
+            for i in range(0, len(self.features), chunk_size):
+                sc.partial_fit(self.features[i : i + chunk_size])
+            if scaler_file is not None:
+                save_scaler(sc, scaler_file, feature_names=feature_names)
+        for i in range(0, len(self.features), chunk_size):
+            self.features[i : i + chunk_size] = sc.transform(
+                self.features[i : i + chunk_size]
+            )
+        np.clip(self.features, -15, 15, out=self.features)
 
     def __len__(self):
         return len(self.features)
@@ -119,6 +164,9 @@ class TorchProfileSlideDataset(LabeledSlideDataset):
 
 
 class TorchImageSlideDataset(LabeledSlideDataset):
+    # Metadata columns required in addition to the ones given as arguments
+    metadata_cols = []
+
     def __init__(
         self,
         image_dir,
@@ -137,62 +185,80 @@ class TorchImageSlideDataset(LabeledSlideDataset):
         pseudo_rgb: bool = False,
         nmco_feature_file: str = None,
         train_target_list: List = None,
+        image_cache_size: int = None,
+        index_cache_dir: str = None,
     ):
         super().__init__()
         self.image_dir = image_dir
+        # Crops are read from a packed crop store if image_dir points to one instead of a directory of image files
+        if PackedCropStore.is_store(image_dir):
+            self.crop_store = PackedCropStore(image_dir)
+        else:
+            self.crop_store = None
         self.metadata_file = metadata_file
         self.image_file_col = image_file_col
         self.plate_col = plate_col
         self.batch_col = batch_col
         self.label_col = label_col
-        self.metadata = pd.read_csv(self.metadata_file, index_col=0)
+        # Only the required columns and the nuclei of the targets are read
+        metadata_cols = [
+            image_file_col,
+            plate_col,
+            label_col,
+            batch_col,
+            slide_image_name_col,
+            nuclei_density_col,
+            elongation_ratio_col,
+        ] + self.metadata_cols
         self.extra_features = extra_features
         self.slide_image_name_col = slide_image_name_col
         self.target_list = target_list
         self.train_target_list = train_target_list
         self.batch_labels = None
 
+        # If an index cache directory is given, the filtered metadata is stored there in a compact, integer-coded
+        # form once per metadata file and filter parameters and loaded from there by later runs
+        if index_cache_dir is not None:
+            index_cache = MetadataIndexCache(
+                index_cache_dir,
+                self.metadata_file,
+                params={
+                    "metadata_cols": metadata_cols,
+                    "label_col": label_col,
+                    "batch_col": batch_col,
+                    "target_list": target_list,
+                    "n_control_samples": n_control_samples,
+                    "selected_batches": selected_batches,
+                },
+            )
+        else:
+            index_cache = None
+        if index_cache is not None and index_cache.exists():
+            self.metadata = index_cache.load()
+            logging.debug("Loaded metadata index from {}.".format(index_cache.index_dir))
+        else:
+            self.metadata = self.read_metadata(
+                metadata_cols, target_list, n_control_samples, selected_batches
+            )
+            if index_cache is not None:
+                index_cache.save(self.metadata)
         if self.target_list is not None:
-            self.metadata = self.metadata.loc[
-                self.metadata[label_col].isin(target_list), :
-            ]
             self.target_list = sorted(self.target_list)
         # else:
         #     self.target_list = sorted(list(set(self.metadata[label_col])))
-        if n_control_samples is not None and "EMPTY_nan" in list(
-            self.metadata[label_col]
-        ):
-            idc = np.array(list(range(len(self.metadata)))).reshape(-1, 1)
-            labels = self.metadata[self.label_col]
-            target_n_samples = dict(Counter(labels))
-            target_n_samples["EMPTY_nan"] = n_control_samples
-            idc, _ = RandomUnderSampler(
-                sampling_strategy=target_n_samples, random_state=1234
-            ).fit_resample(idc, labels)
-            self.metadata = self.metadata.iloc[idc.flatten(), :]
-
-        if selected_batches is not None and batch_col in self.metadata.columns:
-            self.metadata = self.metadata.loc[
-                self.metadata.loc[:, batch_col].isin(selected_batches)
-            ]
-            logging.debug(
-                "Subset data to selected batches: {}".format(selected_batches)
-            )
 
         logging.debug(
-            "Label counts: %s", dict(Counter(np.array(self.metadata[self.label_col]))),
+            "Label counts: %s",
+            self.metadata[self.label_col].value_counts(sort=False).to_dict(),
         )
 
-        # Numpy data type problem leads to strings being cutoff when applying along axis
-        self.image_locs = np.apply_along_axis(
-            combine_path,
-            0,
+        self.image_locs = combine_paths(
             [
-                np.repeat(image_dir, len(self.metadata)).astype(str),
-                np.array(self.metadata.loc[:, self.plate_col], dtype=str),
-                np.array(self.metadata.loc[:, self.image_file_col], dtype=str),
-            ],
-        ).astype(object)
+                image_dir,
+                self.metadata.loc[:, self.plate_col],
+                self.metadata.loc[:, self.image_file_col],
+            ]
+        )
 
         if len(self.metadata) != len(self.image_locs):
             raise RuntimeError(
@@ -201,7 +267,13 @@ class TorchImageSlideDataset(LabeledSlideDataset):
 
         if nmco_feature_file is not None:
             self.nmco_feature_file = nmco_feature_file
-            self.nmco_features = pd.read_csv(self.nmco_feature_file, index_col=0)
+            if target_list is not None and label_col in get_table_columns(
+                self.nmco_feature_file
+            ):
+                filters = {label_col: target_list}
+            else:
+                filters = None
+            self.nmco_features = read_table(self.nmco_feature_file, filters=filters)
             # Ensure that metadata and additional features are aligned
             self.nmco_features.index = np.array(
                 self.nmco_features.loc[:, image_file_col]
@@ -221,30 +293,29 @@ class TorchImageSlideDataset(LabeledSlideDataset):
         else:
             self.nmco_features = None
 
-        self.labels = np.array(self.metadata.loc[:, label_col])
-        le = LabelEncoder()
+        # The labels are integer-coded via categoricals which is equivalent to a label encoder with the given classes
+        labels = pd.Categorical(self.metadata.loc[:, label_col])
+        present_labels = list(labels.categories[np.unique(labels.codes[labels.codes >= 0])])
         if self.train_target_list is not None and self.target_list is None:
-            unique_labels = self.train_target_list + sorted(
-                list(set(self.labels) - set(self.train_target_list))
+            classes = self.train_target_list + sorted(
+                list(set(present_labels) - set(self.train_target_list))
             )
-            le.classes_ = np.array(unique_labels)
         elif self.train_target_list is None and self.target_list is None:
-            le.fit(self.labels)
+            classes = sorted(present_labels)
         else:
-            le.classes_ = np.array(self.target_list)
-        self.labels = le.transform(self.labels)
-        self.target_list = np.array(list(le.classes_))
+            classes = list(self.target_list)
+        self.labels = encode_labels(labels, classes)
+        self.target_list = np.array(classes)
 
         if self.batch_col in self.metadata.columns:
-            self.batch_labels = np.array(self.metadata.loc[:, batch_col])
-            batch_counter = Counter(self.batch_labels)
-            batch_categories = [
-                sorted(batch_counter, key=batch_counter.get, reverse=True)
-            ]
-            batch_ohe = OneHotEncoder(categories=batch_categories)
-            self.batch_labels = batch_ohe.fit_transform(
-                self.batch_labels.reshape(-1, 1)
-            ).toarray()
+            # One-hot encoding of the batches ordered by their number of samples
+            batch_codes, _ = pd.factorize(
+                self.metadata.loc[:, batch_col], use_na_sentinel=False
+            )
+            batch_order = np.argsort(-np.bincount(batch_codes), kind="stable")
+            batch_ranks = np.empty_like(batch_order)
+            batch_ranks[batch_order] = np.arange(len(batch_order))
+            self.batch_labels = np.eye(len(batch_order))[batch_ranks[batch_codes]]
 
         if nuclei_density_col in self.metadata.columns:
             self.nuclei_densities = np.array(
@@ -262,7 +333,7 @@ class TorchImageSlideDataset(LabeledSlideDataset):
             len(self.labels) / np.unique(self.labels, return_counts=True)[1]
         )
         self.label_weights /= np.sum(self.label_weights)
-        le_name_mapping = dict(zip(le.classes_, le.transform(le.classes_)))
+        le_name_mapping = dict(zip(classes, range(len(classes))))
         logging.debug("Classes are coded as follows: %s", le_name_mapping)
         # self.set_transform_pipeline(transform_pipeline)
         self.pseudo_rgb = pseudo_rgb
@@ -275,12 +346,76 @@ class TorchImageSlideDataset(LabeledSlideDataset):
             self.slide_image_names = np.array(self.metadata.loc[:, image_file_col])
         super().create_slide_image_nuclei_dict_labels()
 
+        # If a cache size (in bytes) is given, the nuclear crops are decoded and normalized only once into a cache
+        # shared by all data loader workers and only the transforms are applied in every epoch. The crops are assumed
+        # to be padded to the shape of the first crop, crops of other shapes are not cached.
+        if image_cache_size is not None and len(self.image_locs) > 0:
+            image_shape = self.normalize_image(self.load_image(self.image_locs[0])).shape
+            self.image_cache = SharedImageCache(
+                n_items=len(self.image_locs),
+                image_shape=image_shape,
+                max_bytes=int(image_cache_size),
+            )
+            logging.debug(
+                "Cache up to {} of {} images in {}.".format(
+                    self.image_cache.n_slots,
+                    len(self.image_locs),
+                    self.image_cache.file_path,
+                )
+            )
+        else:
+            self.image_cache = None
+
+    def read_metadata(
+        self,
+        metadata_cols: List,
+        target_list: List = None,
+        n_control_samples: int = None,
+        selected_batches: List = None,
+    ) -> pd.DataFrame:
+        if target_list is not None:
+            filters = {self.label_col: target_list}
+        else:
+            filters = None
+        metadata = read_table(
+            self.metadata_file,
+            columns=[
+                col
+                for col in get_table_columns(self.metadata_file)
+                if col in metadata_cols
+            ],
+            filters=filters,
+        )
+
+        if target_list is not None:
+            metadata = metadata.loc[metadata[self.label_col].isin(target_list), :]
+        if n_control_samples is not None and "EMPTY_nan" in list(
+            metadata[self.label_col]
+        ):
+            idc = np.array(list(range(len(metadata)))).reshape(-1, 1)
+            labels = metadata[self.label_col]
+            target_n_samples = dict(Counter(labels))
+            target_n_samples["EMPTY_nan"] = n_control_samples
+            idc, _ = RandomUnderSampler(
+                sampling_strategy=target_n_samples, random_state=1234
+            ).fit_resample(idc, labels)
+            metadata = metadata.iloc[idc.flatten(), :]
+
+        if selected_batches is not None and self.batch_col in metadata.columns:
+            metadata = metadata.loc[
+                metadata.loc[:, self.batch_col].isin(selected_batches)
+            ]
+            logging.debug(
+                "Subset data to selected batches: {}".format(selected_batches)
+            )
+        return metadata
+
     def __len__(self):
         return len(self.image_locs)
 
     def __getitem__(self, idx):
         image_loc = self.image_locs[idx]
-        image = self.process_image(image_loc)
+        image = self.process_image(image_loc, idx=idx)
         gene_label = self.labels[idx]
 
         sample = {
@@ -321,17 +456,26 @@ class TorchImageSlideDataset(LabeledSlideDataset):
         transform_pipeline: transforms.Compose = None,
         mask_loc=None,
         centroid=None,
+        idx: int = None,
+    ) -> Tensor:
+        if idx is not None and self.image_cache is not None:
+            image = self.image_cache.get(idx)
+            if image is None:
+                image = self.normalize_image(self.load_image(image_loc))
+                self.image_cache.put(idx, image)
+        else:
+            image = self.normalize_image(self.load_image(image_loc))
+        return self.transform_image(
+            image, Image.fromarray(image), transform_pipeline, centroid
+        )
+
+    def transform_image(
+        self,
+        image: np.ndarray,
+        pil_image: Image.Image,
+        transform_pipeline: transforms.Compose = None,
+        centroid=None,
     ) -> Tensor:
-        image = imread(image_loc)
-        if (image > 255).any():
-            image_min = np.percentile(image, 0.1)
-            image_max = np.percentile(image, 99.9)
-            if image_max > 255:
-                image = image - image_min
-                image = image / image_max
-            image = np.clip(image, 0, 1) * 255
-            image = np.uint8(image)
-        pil_image = Image.fromarray(image)
         if transform_pipeline is None:
             if centroid is not None:
                 tensor_image = self.transform_pipeline(pil_image, centroid)
@@ -346,8 +490,20 @@ class TorchImageSlideDataset(LabeledSlideDataset):
             tensor_image = image[0, :, :]
         return tensor_image
 
+    @staticmethod
+    def normalize_image(image: np.ndarray) -> np.ndarray:
+        return normalize_image_to_uint8(image)
+
+    def load_image(self, image_loc: str) -> np.ndarray:
+        if self.crop_store is not None and image_loc.startswith(self.image_dir + "/"):
+            return self.crop_store[image_loc[len(self.image_dir) + 1 :]]
+        else:
+            return imread(image_loc)
+
 
 class TorchMultiImageSlideDataset(TorchImageSlideDataset):
+    metadata_cols = ["centroid_0", "centroid_1"]
+
     def __init__(
         self,
         nuclei_image_dir,
@@ -369,6 +525,10 @@ class TorchMultiImageSlideDataset(TorchImageSlideDataset):
         transform_pipeline: transforms.Compose = None,
         pseudo_rgb: bool = False,
         nmco_feature_file: str = None,
+        image_cache_size: int = None,
+        slide_cache_size: int = 64,
+        slide_patch_dir: str = None,
+        index_cache_dir: str = None,
     ):
         super().__init__(
             image_dir=nuclei_image_dir,
@@ -387,6 +547,8 @@ class TorchMultiImageSlideDataset(TorchImageSlideDataset):
             nmco_feature_file=nmco_feature_file,
             batch_col=batch_col,
             selected_batches=selected_batches,
+            image_cache_size=image_cache_size,
+            index_cache_dir=index_cache_dir,
         )
         self.nuclei_image_dir = nuclei_image_dir
         self.nuclei_metadata = self.metadata
@@ -396,28 +558,53 @@ class TorchMultiImageSlideDataset(TorchImageSlideDataset):
         self.nuclei_image_transform_pipeline = None
         self.slide_image_transform_pipeline = None
 
+        # Every process (e.g. data loader worker) keeps the last used slide images such that nuclei of the same slide
+        # image that are sampled close to each other, e.g. by a SlideGroupedBatchSampler, are served from one decode.
+        # The cache should hold the slide images of a window of the sampler (64 by default).
+        self.slide_cache_size = slide_cache_size
+        self.slide_image_cache = OrderedDict()
+
+        # If a directory of slide context patches (see save_slide_context_patches of the image preprocessors) is
+        # given, the patches are read instead of the slide images. The slide image transform pipeline should then
+        # not crop the patches again, e.g. the "slide_context_patch" pipeline.
+        if slide_patch_dir is not None:
+            self.slide_patch_store = PackedCropStore(slide_patch_dir)
+            slide_patch_keys = [
+                "{}/{}".format(plate, image_file)
+                for plate, image_file in zip(
+                    self.metadata.loc[:, self.plate_col],
+                    self.metadata.loc[:, self.image_file_col],
+                )
+            ]
+            missing = [key for key in slide_patch_keys if key not in self.slide_patch_store]
+            if len(missing) > 0:
+                raise RuntimeError(
+                    "No slide context patches found for {} nuclei, e.g. {}.".format(
+                        len(missing), missing[0]
+                    )
+                )
+            self.slide_patch_positions = np.array(
+                [self.slide_patch_store.key_positions[key] for key in slide_patch_keys]
+            )
+        else:
+            self.slide_patch_store = None
+
         self.nuclei_image_locs = self.image_locs
-        self.slide_image_locs = np.apply_along_axis(
-            combine_path,
-            0,
+        self.slide_image_locs = combine_paths(
             [
-                np.repeat(self.slide_image_dir, len(self.metadata)).astype(str),
-                np.array(self.metadata.loc[:, self.plate_col], dtype=str),
-                np.array(self.metadata.loc[:, self.slide_image_name_col], dtype=str),
-            ],
-        ).astype(object)
+                self.slide_image_dir,
+                self.metadata.loc[:, self.plate_col],
+                self.metadata.loc[:, self.slide_image_name_col],
+            ]
+        )
         if self.slide_mask_dir is not None:
-            self.slide_mask_locs = np.apply_along_axis(
-                combine_path,
-                0,
+            self.slide_mask_locs = combine_paths(
                 [
-                    np.repeat(self.slide_mask_dir, len(self.metadata)).astype(str),
-                    np.array(self.metadata.loc[:, self.plate_col], dtype=str),
-                    np.array(
-                        self.metadata.loc[:, self.slide_image_name_col], dtype=str
-                    ),
-                ],
-            ).astype(object)
+                    self.slide_mask_dir,
+                    self.metadata.loc[:, self.plate_col],
+                    self.metadata.loc[:, self.slide_image_name_col],
+                ]
+            )
         else:
             self.slide_mask_locs = None
 
@@ -436,14 +623,19 @@ class TorchMultiImageSlideDataset(TorchImageSlideDataset):
         else:
             slide_mask_loc = None
         nuclei_image = self.process_image(
-            nuclei_image_loc, self.nuclei_image_transform_pipeline
-        )
-        slide_image = self.process_image(
-            slide_image_loc,
-            self.slide_image_transform_pipeline,
-            mask_loc=slide_mask_loc,
-            centroid=centroid,
+            nuclei_image_loc, self.nuclei_image_transform_pipeline, idx=idx
         )
+        if self.slide_patch_store is not None:
+            slide_image = self.process_slide_patch(
+                idx, self.slide_image_transform_pipeline, centroid=centroid
+            )
+        else:
+            slide_image = self.process_image(
+                slide_image_loc,
+                self.slide_image_transform_pipeline,
+                mask_loc=slide_mask_loc,
+                centroid=centroid,
+            )
         gene_label = self.labels[idx]
         # binary_nuclei_image = (nuclei_image > 0).float()
         # binary_slide_image = (binary_nuclei_image >0).float()
@@ -498,28 +690,72 @@ class TorchMultiImageSlideDataset(TorchImageSlideDataset):
         transform_pipeline: transforms.Compose = None,
         mask_loc=None,
         centroid=None,
+        idx: int = None,
     ) -> Tensor:
-        return super().process_image(
-            image_loc,
-            transform_pipeline=transform_pipeline,
-            mask_loc=mask_loc,
-            centroid=centroid,
+        if centroid is None or self.slide_cache_size < 1:
+            return super().process_image(
+                image_loc,
+                transform_pipeline=transform_pipeline,
+                mask_loc=mask_loc,
+                centroid=centroid,
+                idx=idx,
+            )
+        image, pil_image = self.get_slide_image(image_loc)
+        return self.transform_image(image, pil_image, transform_pipeline, centroid)
+
+    def process_slide_patch(
+        self, idx: int, transform_pipeline: transforms.Compose = None, centroid=None
+    ) -> Tensor:
+        image = np.asarray(self.slide_patch_store.get_crop(self.slide_patch_positions[idx]))
+        return self.transform_image(
+            image, Image.fromarray(image), transform_pipeline, centroid
         )
 
+    def get_slide_image(self, image_loc: str) -> Tuple[np.ndarray, Image.Image]:
+        if image_loc in self.slide_image_cache:
+            self.slide_image_cache.move_to_end(image_loc)
+        else:
+            image = self.normalize_image(self.load_image(image_loc))
+            self.slide_image_cache[image_loc] = image, Image.fromarray(image)
+            if len(self.slide_image_cache) > self.slide_cache_size:
+                self.slide_image_cache.popitem(last=False)
+        return self.slide_image_cache[image_loc]
+
+    def __getstate__(self):
+        # The cached slide images are not copied e.g. to the data loader workers
+        state = self.__dict__.copy()
+        state["slide_image_cache"] = OrderedDict()
+        return state
+
+
+def copy_dataset(dataset: Dataset) -> Dataset:
+    # Shallow copy of the dataset such that the copy has its own transform pipeline while the metadata, paths, features
+    # and labels are shared with the dataset. These must thus not be modified in place. The datasets underlying a
+    # subset or a concatenation of datasets are copied as well as they hold the transform pipelines.
+    dataset_copy = copy.copy(dataset)
+    if isinstance(dataset, Subset):
+        dataset_copy.dataset = copy_dataset(dataset.dataset)
+    elif isinstance(dataset, ConcatDataset):
+        dataset_copy.datasets = [copy_dataset(d) for d in dataset.datasets]
+    return dataset_copy
+
 
 class TorchTransformableSubset(Subset):
     def __init__(self, dataset: LabeledSlideDataset, indices):
         super().__init__(dataset=dataset, indices=indices)
-        # Hacky way to create a independent dataset instance such changes to the dataset of the subset instance are not
-        # passed through --> might increase CPU/GPU memory usage linearly
-        self.dataset = copy.deepcopy(self.dataset)
+        # The subset has its own transform pipeline but shares the data with the dataset and all other subsets
+        self.dataset = copy_dataset(self.dataset)
+        self.indices = np.asarray(indices)
         self.transform_pipeline = None
 
     def set_transform_pipeline(
         self, transform_pipelines: List[transforms.Compose]
     ) -> None:
         try:
-            if len(transform_pipelines) == 1:
+            # Subsets and concatenations of datasets select the transform pipelines of their datasets themselves
+            if len(transform_pipelines) == 1 and not isinstance(
+                self.dataset, (Subset, ConcatDataset)
+            ):
                 self.dataset.set_transform_pipeline(transform_pipelines[0])
             else:
                 self.dataset.set_transform_pipeline(transform_pipelines)
@@ -535,14 +771,21 @@ class TorchTransformableSuperset(ConcatDataset):
     def __init__(self, datasets: Iterable[LabeledSlideDataset]):
         super().__init__(datasets=datasets)
         self.tranform_pipeline = None
-        self.datasets = copy.deepcopy(self.datasets)
-        self.label_weights = self.datasets[0].label_weights
-        self.target_list = self.datasets[0].target_list
+        # Shallow copies of the datasets that share their data (see TorchTransformableSubset)
+        self.datasets = [copy_dataset(dataset) for dataset in self.datasets]
+        dataset = self.datasets[0]
+        while isinstance(dataset, Subset):
+            dataset = dataset.dataset
+        self.label_weights = dataset.label_weights
+        self.target_list = dataset.target_list
 
     def set_transform_pipeline(self, transform_pipelines: List[transforms.Compose]):
         for dataset in self.datasets:
             try:
-                if len(transform_pipelines) == 1:
+                # Subsets and concatenations of datasets select the transform pipelines of their datasets themselves
+                if len(transform_pipelines) == 1 and not isinstance(
+                    dataset, (Subset, ConcatDataset)
+                ):
                     dataset.set_transform_pipeline(transform_pipelines[0])
                 else:
                     dataset.set_transform_pipeline(transform_pipelines)
@@ -552,7 +795,7 @@ class TorchTransformableSuperset(ConcatDataset):
                     "Object must implement a subset of a dataset type that implements"
                     " the set_transform_pipeline method."
                 )
-            raise exception
+                raise exception
 
 
 class IndexedTensorDataset(Dataset):
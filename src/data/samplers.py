@@ -0,0 +1,106 @@
+from typing import Iterable
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+
+class SlideGroupedBatchSampler(Sampler):
+    r"""Batch sampler that shuffles the nuclei within windows of a few randomly chosen slide images.
+
+    The slide images are randomly distributed over n_streams streams, one per data loader worker. Every stream visits
+    its slide images in a random order in windows of n_slides_per_window slide images whose nuclei are shuffled
+    together. The batches are taken from the streams in turn such that, as the data loader assigns the batches to its
+    workers in turn, every worker only needs to decode the slide images of its current window. Every nucleus is
+    sampled exactly once per epoch and the batches have the given batch size as for a random sampler, but each batch
+    only contains nuclei of about n_slides_per_window slide images.
+
+    The batches are thus not comparable to the ones of uniform shuffling: the nuclei of a batch share few slide images
+    and hence few labels and imaging conditions, which increases the variance of the gradients and
+    makes statistics computed over a batch (e.g. of batch normalization layers) less representative. A batch contains
+    about n_slides_per_window * (1 - exp(-batch_size / n_slides_per_window)) distinct slide images, e.g. about 41 for
+    batches of 64 nuclei and the default windows of 64 slide images compared to about 63 for uniform shuffling of many
+    slide images, but only about 8 for windows of 8 slide images.
+
+    Parameters
+    ----------
+    slide_image_names : Iterable
+        Slide image of every sample of the data set.
+    batch_size : int
+        Size of the batches.
+    drop_last : bool
+        If True, the last batch is dropped if it is smaller than the batch size.
+    n_slides_per_window : int
+        Number of slide images whose nuclei are shuffled together. Larger windows bring the sampling closer to uniform
+        shuffling but require larger slide image caches of the workers, which should hold the slide images of a window
+        (see slide_cache_size of the TorchMultiImageSlideDataset).
+    n_streams : int
+        Number of streams, which should be the number of data loader workers.
+    generator : torch.Generator
+        Generator used to seed the shuffling of every epoch.
+    """
+
+    def __init__(
+        self,
+        slide_image_names: Iterable,
+        batch_size: int,
+        drop_last: bool = False,
+        n_slides_per_window: int = 64,
+        n_streams: int = 1,
+        generator: torch.Generator = None,
+    ):
+        _, self.slide_codes = np.unique(
+            np.array(slide_image_names, dtype=str), return_inverse=True
+        )
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.n_slides_per_window = n_slides_per_window
+        self.n_streams = max(1, n_streams)
+        self.generator = generator
+        self.slide_nuclei = np.split(
+            np.argsort(self.slide_codes, kind="stable"),
+            np.cumsum(np.bincount(self.slide_codes))[:-1],
+        )
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.slide_codes) // self.batch_size
+        else:
+            return (len(self.slide_codes) + self.batch_size - 1) // self.batch_size
+
+    def get_stream(self, slides: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+        windows = []
+        for i in range(0, len(slides), self.n_slides_per_window):
+            window = np.concatenate(
+                [self.slide_nuclei[slide] for slide in slides[i : i + self.n_slides_per_window]]
+            )
+            windows.append(rng.permutation(window))
+        return np.concatenate(windows) if len(windows) > 0 else np.array([], dtype=int)
+
+    def __iter__(self):
+        if self.generator is None:
+            seed = int(torch.empty((), dtype=torch.int64).random_().item())
+        else:
+            seed = int(
+                torch.empty((), dtype=torch.int64).random_(generator=self.generator).item()
+            )
+        rng = np.random.default_rng(seed)
+        slides = rng.permutation(len(self.slide_nuclei))
+        streams = [
+            self.get_stream(slides[i :: self.n_streams], rng)
+            for i in range(self.n_streams)
+        ]
+
+        # The full batches of the streams are interleaved, the incomplete remainders of the streams are appended
+        chunks = []
+        n_full_batches = [len(stream) // self.batch_size for stream in streams]
+        for i in range(max(n_full_batches)):
+            for stream, n in zip(streams, n_full_batches):
+                if i < n:
+                    chunks.append(stream[i * self.batch_size : (i + 1) * self.batch_size])
+        for stream, n in zip(streams, n_full_batches):
+            chunks.append(stream[n * self.batch_size :])
+        order = np.concatenate(chunks)
+
+        for i in range(len(self)):
+            yield order[i * self.batch_size : (i + 1) * self.batch_size].tolist()
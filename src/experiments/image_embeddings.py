@@ -33,6 +33,7 @@ from src.utils.torch.model import (
     get_nuclei_image_transformations_dict,
     get_randomflips_transformation_dict,
     get_slide_image_transformations_dict,
+    get_slide_context_patch_transformations_dict,
     get_model_from_model_dict,
     get_batch_model_configuration, get_binary_nuclei_image_transformations_dict,
     get_binary_slide_image_transformations_dict,
@@ -102,6 +103,10 @@ class BaseImageEmbeddingExperiment:
                 self.data_transform_pipeline_dicts.append(
                     get_slide_image_transformations_dict(224)
                 )
+            elif data_transform_pipeline == "slide_context_patch":
+                self.data_transform_pipeline_dicts.append(
+                    get_slide_context_patch_transformations_dict(224)
+                )
             elif data_transform_pipeline == "nuclei_image":
                 self.data_transform_pipeline_dicts.append(
                     get_nuclei_image_transformations_dict(224)
@@ -343,7 +348,12 @@ class ImageEmbeddingExperiment(BaseExperiment, BaseImageEmbeddingExperiment):
             data_transform_pipelines=data_transform_pipelines
         )
 
-    def initialize_data_loader_dict(self, drop_last_batch: bool = True):
+    def initialize_data_loader_dict(
+        self,
+        drop_last_batch: bool = True,
+        slide_grouped_sampling: bool = False,
+        n_slides_per_window: int = 64,
+    ):
 
         dh = DataHandler(
             dataset=self.data_set,
@@ -352,6 +362,8 @@ class ImageEmbeddingExperiment(BaseExperiment, BaseImageEmbeddingExperiment):
             random_state=self.random_state,
             transformation_dicts=self.data_transform_pipeline_dicts,
             drop_last_batch=drop_last_batch,
+            slide_grouped_sampling=slide_grouped_sampling,
+            n_slides_per_window=n_slides_per_window,
         )
         dh.stratified_train_val_test_split(splits=self.train_val_test_split)
         dh.get_data_loader_dict(shuffle=True)
@@ -520,7 +532,12 @@ class ImageEmbeddingExperimentCustomSplit(ImageEmbeddingExperiment):
             data_transform_pipelines=data_transform_pipelines
         )
 
-    def initialize_data_loader_dict(self, drop_last_batch: bool = True):
+    def initialize_data_loader_dict(
+        self,
+        drop_last_batch: bool = True,
+        slide_grouped_sampling: bool = False,
+        n_slides_per_window: int = 64,
+    ):
         dh = DataHandler(
             dataset=self.data_set,
             batch_size=self.batch_size,
@@ -528,6 +545,8 @@ class ImageEmbeddingExperimentCustomSplit(ImageEmbeddingExperiment):
             random_state=self.random_state,
             transformation_dicts=self.data_transform_pipeline_dicts,
             drop_last_batch=drop_last_batch,
+            slide_grouped_sampling=slide_grouped_sampling,
+            n_slides_per_window=n_slides_per_window,
         )
 
         dh.train_val_test_datasets_dict = {
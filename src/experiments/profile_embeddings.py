@@ -1,3 +1,4 @@
+import os
 from typing import List
 
 import torch
@@ -189,6 +190,11 @@ class BaseProfileEmbeddingExperimentCustomSplit(BaseProfileEmbeddingExperiment):
             "test_profile_metadata_file"
         )
 
+        # The scaler fitted on the training profiles is saved and reused for the validation and test profiles
+        if "scaler_file" not in self.data_config:
+            self.data_config["scaler_file"] = os.path.join(
+                self.output_dir, "profile_scaler.json"
+            )
         self.data_config["feature_label_file"] = self.train_profile_metadata_file
         self.train_data_set = init_profile_dataset(**self.data_config)
 
@@ -4,9 +4,18 @@ from typing import Iterable, List
 import numpy as np
 import torch
 from sklearn.model_selection import train_test_split, StratifiedKFold
-from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
+from torch.utils.data import DataLoader, RandomSampler, SequentialSampler, Subset
 
 from src.data.datasets import LabeledSlideDataset, TorchTransformableSubset
+from src.data.samplers import SlideGroupedBatchSampler
+
+
+def get_slide_image_names(dataset) -> np.ndarray:
+    # Slide image names of the samples of a data set or of a subset of a data set
+    if isinstance(dataset, Subset):
+        return get_slide_image_names(dataset.dataset)[np.array(dataset.indices)]
+    else:
+        return np.array(dataset.slide_image_names)
 
 
 class BaseDataHandler(object):
@@ -37,6 +46,8 @@ class DataHandler(BaseDataHandler):
         random_state: int = 42,
         drop_last_batch: bool = True,
         split_on_slide_level: bool = True,
+        slide_grouped_sampling: bool = False,
+        n_slides_per_window: int = 64,
     ):
         super().__init__(
             dataset=dataset,
@@ -49,6 +60,16 @@ class DataHandler(BaseDataHandler):
         self.train_val_test_datasets_dict = None
         self.data_loader_dict = None
         self.split_on_slide_level = split_on_slide_level
+        # If set, the training samples are shuffled within windows of n_slides_per_window slide images such that the
+        # data loader workers can serve the nuclei of a slide image from a single decode of the slide image. Every
+        # batch then only contains nuclei of about n_slides_per_window slide images instead of a uniform sample of all
+        # slide images, which correlates the samples of a batch (e.g. w.r.t. the label and the imaging conditions).
+        # Larger windows make the batches closer to the ones of uniform shuffling at the cost of larger slide image
+        # caches (see slide_cache_size of the TorchMultiImageSlideDataset). The default window of 64 slide images
+        # yields about 41 distinct slide images per batch of 64 nuclei compared to about 63 for uniform shuffling
+        # (see SlideGroupedBatchSampler).
+        self.slide_grouped_sampling = slide_grouped_sampling
+        self.n_slides_per_window = n_slides_per_window
 
     def stratified_train_val_test_split(self, splits: Iterable) -> None:
         train_portion, val_portion, test_portion = splits[0], splits[1], splits[2]
@@ -127,13 +148,27 @@ class DataHandler(BaseDataHandler):
                     )
         data_loader_dict = {}
         for k, dataset in self.train_val_test_datasets_dict.items():
-            data_loader_dict[k] = DataLoader(
-                dataset=dataset,
-                batch_size=self.batch_size,
-                shuffle=shuffle and k == "train",
-                num_workers=self.num_workers,
-                drop_last=self.drop_last_batch,
-            )
+            if shuffle and k == "train" and self.slide_grouped_sampling:
+                batch_sampler = SlideGroupedBatchSampler(
+                    slide_image_names=get_slide_image_names(dataset),
+                    batch_size=self.batch_size,
+                    drop_last=self.drop_last_batch,
+                    n_slides_per_window=self.n_slides_per_window,
+                    n_streams=self.num_workers,
+                )
+                data_loader_dict[k] = DataLoader(
+                    dataset=dataset,
+                    batch_sampler=batch_sampler,
+                    num_workers=self.num_workers,
+                )
+            else:
+                data_loader_dict[k] = DataLoader(
+                    dataset=dataset,
+                    batch_size=self.batch_size,
+                    shuffle=shuffle and k == "train",
+                    num_workers=self.num_workers,
+                    drop_last=self.drop_last_batch,
+                )
 
         self.data_loader_dict = data_loader_dict
 
@@ -1,19 +1,146 @@
-from scipy.stats import median_absolute_deviation
-from sklearn.base import BaseEstimator, TransformerMixin
+import json
+
 import numpy as np
+from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.preprocessing import StandardScaler
+
+
+def get_weighted_quantiles(values, weights, quantiles):
+    r"""Computes the quantiles of every column of a weighted sample.
+
+    Each value is placed at the midpoint of its cumulative weight and the quantiles are linearly interpolated between
+    these positions, which for unit weights is equivalent to numpy's median. NaN values are ignored.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        Array of shape (n_samples, n_features).
+    weights : np.ndarray
+        Non-negative weights of the values of shape (n_samples, n_features).
+    quantiles : np.ndarray
+        Quantiles in [0, 1] to compute.
+
+    Returns
+    -------
+    quantile_values : np.ndarray
+        Array of shape (n_quantiles, n_features) of the quantiles of every feature. The quantiles of features without
+        any valid value are NaN.
+    """
+    n_samples, n_features = values.shape
+    quantiles = np.asarray(quantiles, dtype=np.float64)
+    # NaN values are sorted last and given a weight of zero
+    order = np.argsort(values, axis=0, kind="stable")
+    values = np.take_along_axis(values, order, axis=0)
+    weights = np.where(
+        np.isnan(values), 0, np.take_along_axis(weights, order, axis=0)
+    ).astype(np.float64)
+    n_valid = (~np.isnan(values)).sum(axis=0)
+    total_weights = weights.sum(axis=0)
+    positions = (np.cumsum(weights, axis=0) - weights / 2) / np.maximum(
+        total_weights, 1e-300
+    )
+    positions[np.arange(n_samples)[:, None] >= n_valid[None, :]] = 1
+
+    # The positions of every feature are non-decreasing in [0, 1], such that offsetting every feature by two yields a
+    # single sorted array that is searched for the quantiles of all features at once
+    offsets = 2 * np.arange(n_features)
+    flat_positions = (positions + offsets[None, :]).T.ravel()
+    idc = (
+        np.searchsorted(
+            flat_positions, quantiles[:, None] + offsets[None, :], side="right"
+        )
+        - np.arange(n_features)[None, :] * n_samples
+    )
+    upper = np.clip(idc, 1, np.maximum(n_valid - 1, 1)[None, :])
+    lower = upper - 1
+    upper = np.minimum(upper, np.maximum(n_valid - 1, 0)[None, :])
+    columns = np.arange(n_features)[None, :]
+    lower_positions = positions[lower, columns]
+    upper_positions = positions[upper, columns]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        t = np.clip(
+            (quantiles[:, None] - lower_positions)
+            / (upper_positions - lower_positions),
+            0,
+            1,
+        )
+    t[~np.isfinite(t)] = 0
+    quantile_values = (1 - t) * values[lower, columns] + t * values[upper, columns]
+    quantile_values[:, n_valid == 0] = np.nan
+    return quantile_values
+
+
+class QuantileSketch(object):
+    r"""Mergeable quantile summary of a stream of samples with vectorized updates for all features.
+
+    Every chunk is summarized by at most n_quantiles values per feature. The summaries are organized in levels as in
+    a binary counter: two summaries of the same level are merged and compressed into one summary of the next level,
+    such that every sample takes part in a logarithmic number of compressions. The rank error of the quantiles is thus
+    bounded by about log2(n_chunks) / (2 * n_quantiles).
+
+    Parameters
+    ----------
+    n_quantiles : int
+        Number of values per feature kept by every summary.
+    """
+
+    def __init__(self, n_quantiles: int = 1000):
+        self.n_quantiles = n_quantiles
+        # Summaries given by the values of shape (n, n_features) and the weight of every value of a feature
+        self.levels = {}
+
+    def compress(self, values, weights):
+        total_weights = np.where(np.isnan(values), 0, weights).sum(axis=0)
+        quantiles = (np.arange(self.n_quantiles) + 0.5) / self.n_quantiles
+        values = get_weighted_quantiles(values, weights, quantiles)
+        return values, total_weights / self.n_quantiles
+
+    def update(self, X):
+        X = np.asarray(X, dtype=np.float64)
+        summary = X, np.ones(X.shape[1])
+        level = 0
+        if len(X) > self.n_quantiles:
+            summary = self.compress(*self.merge([summary]))
+        while level in self.levels:
+            summary = self.compress(*self.merge([summary, self.levels.pop(level)]))
+            level += 1
+        self.levels[level] = summary
+
+    @staticmethod
+    def merge(summaries):
+        values = np.concatenate([values for values, _ in summaries])
+        weights = np.concatenate(
+            [
+                np.broadcast_to(weights, values.shape)
+                for values, weights in summaries
+            ]
+        )
+        return values, weights
+
+    def get_summary(self):
+        return self.merge(list(self.levels.values()))
 
 
 class RobustMAD(BaseEstimator, TransformerMixin):
     """Class to perform a "Robust" normalization with respect to median and mad
         scaled = (x - median) / mad
+    The median and mad are computed exactly by fit and approximately from a quantile sketch if the scaler is fitted
+    in chunks by partial_fit. NaN values are ignored in both cases.
     Attributes
     ----------
     epsilon : float
         fudge factor parameter
+    scale : float
+        factor of the mad, the default makes the mad a consistent estimator of the standard deviation of normally
+        distributed data
+    n_quantiles : int
+        number of values per feature of the summaries of the quantile sketch used by partial_fit
     """
 
-    def __init__(self, epsilon=1e-18):
+    def __init__(self, epsilon=1e-18, scale=1.4826, n_quantiles=1000):
         self.epsilon = epsilon
+        self.scale = scale
+        self.n_quantiles = n_quantiles
 
     def fit(self, X, y=None):
         """Compute the median and mad to be used for later scaling.
@@ -26,11 +153,63 @@ class RobustMAD(BaseEstimator, TransformerMixin):
         self
             With computed median and mad attributes
         """
-        # Get the mean of the features (columns) and center if specified
-        self.median = np.median(X, axis=0)
-        self.mad = median_absolute_deviation(X, nan_policy="omit")
+        X = np.asarray(X, dtype=np.float64)
+        self.median = np.nanmedian(X, axis=0)
+        self.mad = self.scale * np.nanmedian(np.abs(X - self.median), axis=0)
+        self.n_samples_seen = (~np.isnan(X)).sum(axis=0)
+        self.sketch = None
         return self
 
+    def partial_fit(self, X, y=None):
+        """Update the median and mad with a chunk of samples.
+        Parameters
+        ----------
+        X : pandas.core.frame.DataFrame
+            chunk of the data
+        Returns
+        -------
+        self
+            With updated median and mad attributes
+        """
+        if getattr(self, "sketch", None) is None:
+            self.sketch = QuantileSketch(n_quantiles=self.n_quantiles)
+            self.n_samples_seen = 0
+        X = np.asarray(X, dtype=np.float64)
+        self.sketch.update(X)
+        self.n_samples_seen = self.n_samples_seen + (~np.isnan(X)).sum(axis=0)
+        # The median and mad are computed from the sketch when they are accessed next
+        self._median, self._mad = None, None
+        return self
+
+    def update_params_from_sketch(self):
+        # The mad is the median of the absolute deviations of the summarized values from the median
+        values, weights = self.sketch.get_summary()
+        self._median = get_weighted_quantiles(values, weights, [0.5])[0]
+        self._mad = (
+            self.scale
+            * get_weighted_quantiles(np.abs(values - self._median), weights, [0.5])[0]
+        )
+
+    @property
+    def median(self):
+        if self._median is None:
+            self.update_params_from_sketch()
+        return self._median
+
+    @median.setter
+    def median(self, median):
+        self._median = median
+
+    @property
+    def mad(self):
+        if self._mad is None:
+            self.update_params_from_sketch()
+        return self._mad
+
+    @mad.setter
+    def mad(self, mad):
+        self._mad = mad
+
     def transform(self, X, copy=None):
         """Apply the RobustMAD calculation
         Parameters
@@ -42,4 +221,110 @@ class RobustMAD(BaseEstimator, TransformerMixin):
         pandas.core.frame.DataFrame
             RobustMAD transformed dataframe
         """
+        if isinstance(X, np.ndarray) and X.dtype == np.float32:
+            return (
+                (X - self.median.astype(np.float32))
+                / (self.mad + self.epsilon).astype(np.float32)
+            )
         return (X - self.median) / (self.mad + self.epsilon)
+
+    def get_fitted_params(self):
+        return {
+            "median": self.median,
+            "mad": self.mad,
+            "n_samples_seen": self.n_samples_seen,
+        }
+
+    def set_fitted_params(self, params):
+        self.median = np.array(params["median"], dtype=np.float64)
+        self.mad = np.array(params["mad"], dtype=np.float64)
+        self.n_samples_seen = np.array(params["n_samples_seen"])
+        self.sketch = None
+
+
+class ProfileStandardScaler(StandardScaler):
+    r"""Standard scaler whose fitted parameters can be saved and loaded with the ones of the RobustMAD scaler.
+
+    The scaler supports the fitting in chunks by partial_fit and ignores NaN values as its parent class.
+    """
+
+    def get_fitted_params(self):
+        return {
+            "mean": self.mean_,
+            "var": self.var_,
+            "scale": self.scale_,
+            "n_samples_seen": self.n_samples_seen_,
+        }
+
+    def set_fitted_params(self, params):
+        self.mean_ = np.array(params["mean"], dtype=np.float64)
+        self.var_ = np.array(params["var"], dtype=np.float64)
+        self.scale_ = np.array(params["scale"], dtype=np.float64)
+        self.n_samples_seen_ = np.array(params["n_samples_seen"])
+        self.n_features_in_ = len(self.mean_)
+
+
+scalers = {"standard": ProfileStandardScaler, "robust_mad": RobustMAD}
+
+
+def save_scaler(scaler, file_path: str, feature_names=None):
+    r"""Saves the type, the hyperparameters and the fitted parameters of a scaler in a json file.
+
+    Parameters
+    ----------
+    scaler : ProfileStandardScaler or RobustMAD
+        The fitted scaler.
+    file_path : str
+        Path to the json file.
+    feature_names : list
+        Names of the features the scaler was fitted on, which are checked when the scaler is loaded.
+    """
+    scaler_type = [
+        name for name, scaler_class in scalers.items() if type(scaler) is scaler_class
+    ][0]
+    params = {
+        key: np.asarray(value).tolist()
+        for key, value in scaler.get_fitted_params().items()
+    }
+    with open(file_path, "w") as f:
+        json.dump(
+            {
+                "type": scaler_type,
+                "hyperparameters": scaler.get_params(),
+                "params": params,
+                "feature_names": None if feature_names is None else list(feature_names),
+            },
+            f,
+        )
+
+
+def load_scaler(file_path: str, feature_names=None):
+    r"""Loads a scaler saved by save_scaler.
+
+    Parameters
+    ----------
+    file_path : str
+        Path to the json file.
+    feature_names : list
+        Names of the features the scaler is applied to. If given, these must match the ones the scaler was fitted on.
+
+    Returns
+    -------
+    scaler : ProfileStandardScaler or RobustMAD
+        The fitted scaler.
+    """
+    with open(file_path, "r") as f:
+        config = json.load(f)
+    if (
+        feature_names is not None
+        and config["feature_names"] is not None
+        and list(feature_names) != config["feature_names"]
+    ):
+        raise ValueError(
+            "The features do not match the ones the scaler in {} was fitted on.".format(
+                file_path
+            )
+        )
+    scaler = scalers[config["type"]](**config["hyperparameters"])
+    scaler.set_fitted_params(config["params"])
+    return scaler
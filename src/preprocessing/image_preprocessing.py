@@ -1,50 +1,714 @@
+import hashlib
+import json
 import logging
 import os
-from shutil import copyfile
+import time
 from typing import List, Tuple
 
 import cv2
 import numpy as np
 import pandas as pd
+from PIL import Image
 from joblib import Parallel, delayed
 from skimage.io import imread
-from skimage.measure import regionprops, label
-from skimage.morphology import remove_small_objects, remove_small_holes
+from skimage.measure import regionprops, regionprops_table
 from sklearn.mixture import GaussianMixture
 from tifffile import tifffile
 from tqdm import tqdm
 
-from src.utils.basic.feature_extraction import compute_nuclear_chromatin_features
-from src.utils.basic.io import get_file_list
-from src.utils.basic.segmentation import get_mask_image_from_outline, pad_image
+from src.utils.basic.cache import (
+    NuclearFeatureCache,
+    StageCache,
+    get_files_fingerprint,
+    get_params_key,
+)
+from src.utils.basic.feature_extraction import (
+    NMCO_FEATURE_VERSION,
+    compute_carpenter_profiles,
+    compute_nuclear_chromatin_features,
+)
+from src.utils.basic.io import (
+    TableWriter,
+    get_file_list,
+    index_files,
+    read_table,
+    save_table,
+    stage_file,
+    update_common_dtypes,
+)
+from src.utils.basic.segmentation import (
+    get_centered_crop,
+    get_label_image_from_outline,
+    normalize_image_to_uint8,
+    pad_and_normalize_image,
+)
+from src.utils.basic.storage import (
+    PackedCropStore,
+    PackedCropWriter,
+    TablePartWriter,
+)
 
 import warnings
 
 warnings.filterwarnings("ignore")
 
 
-class ImageDatasetPreprocessor:
+def open_image(image_file_path: str) -> np.ndarray:
+    # Uncompressed TIFF files are memory-mapped such that only the accessed parts of the image are read.
+    if image_file_path.lower().endswith((".tif", ".tiff")):
+        try:
+            return tifffile.memmap(image_file_path, mode="r")
+        except ValueError:
+            pass
+    return imread(image_file_path)
+
+
+def get_tile_size(
+    image: np.ndarray,
+    label_image: np.ndarray,
+    memory_budget: float,
+    tile_halo: int,
+    extract_ncmo_features: bool = True,
+) -> int:
+    # Approximate number of bytes required per pixel of a tile window (copies of the image and label image plus the
+    # normalized intensity image used for the nmco features) given the memory budget in MB.
+    bytes_per_pixel = 2 * (image.itemsize + label_image.itemsize)
+    if extract_ncmo_features:
+        bytes_per_pixel += 16
+    window_size = int(np.sqrt(memory_budget * 2 ** 20 / bytes_per_pixel))
+    if window_size >= max(image.shape):
+        return None
+    tile_size = window_size - 2 * tile_halo
+    if tile_size < tile_halo:
+        raise ValueError(
+            "Memory budget of {} MB is too small for tiles with a halo of {} pixels.".format(
+                memory_budget, tile_halo
+            )
+        )
+    return tile_size
+
+
+def get_tile_windows(image_shape: Tuple[int], tile_size: int = None, tile_halo: int = 0):
+    # Returns the tile windows (i.e. the tiles extended by the halo) and the tiles themselves as (row_start, row_end,
+    # col_start, col_end) with respect to the image.
+    if tile_size is None:
+        tile_size = max(image_shape)
+    windows = []
+    for row_start in range(0, image_shape[0], tile_size):
+        for col_start in range(0, image_shape[1], tile_size):
+            tile = (
+                row_start,
+                min(row_start + tile_size, image_shape[0]),
+                col_start,
+                min(col_start + tile_size, image_shape[1]),
+            )
+            window = (
+                max(tile[0] - tile_halo, 0),
+                min(tile[1] + tile_halo, image_shape[0]),
+                max(tile[2] - tile_halo, 0),
+                min(tile[3] + tile_halo, image_shape[1]),
+            )
+            windows.append((window, tile))
+    return windows
+
+
+def select_nuclear_regions(
+    props: dict,
+    label_image: np.ndarray,
+    min_area: int = None,
+    max_area: int = None,
+    max_bbarea: int = None,
+    max_eccentricity: float = None,
+    min_solidity: float = None,
+    min_aspect_ratio: float = None,
+    candidates: np.ndarray = None,
+) -> np.ndarray:
+    # Returns the mask of the regions (given by their properties as obtained by regionprops_table, which must include
+    # label, area, bbox, eccentricity, minor_axis_length and major_axis_length) that pass the crop quality filters.
+    # The filters are applied as masks and the solidity (requiring the convex hull) is only computed for the candidate
+    # regions that passed all other filters.
+    if candidates is None:
+        selected = np.ones(len(props["label"]), dtype=bool)
+    else:
+        selected = candidates.copy()
+    widths = props["bbox-2"] - props["bbox-0"]
+    heights = props["bbox-3"] - props["bbox-1"]
+    if min_area is not None:
+        selected &= props["area"] >= min_area
+    if max_area is not None:
+        selected &= props["area"] <= max_area
+    if max_eccentricity is not None:
+        selected &= props["eccentricity"] <= max_eccentricity
+    if max_bbarea is not None:
+        selected &= widths * heights <= max_bbarea
+    if min_aspect_ratio is not None:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            selected &= (
+                props["minor_axis_length"] / props["major_axis_length"]
+            ) >= min_aspect_ratio
+    if min_solidity is not None:
+        regions = regionprops(label_image)
+        for k in np.flatnonzero(selected):
+            selected[k] = regions[k].solidity >= min_solidity
+    return selected
+
+
+def update_incomplete_regions(incomplete_regions: dict, new_incomplete_regions: dict):
+    # Merges the (truncated) bounding boxes of the nuclei found to be incomplete in different windows
+    for region_label, bbox in new_incomplete_regions.items():
+        if region_label in incomplete_regions:
+            old_bbox = incomplete_regions[region_label]
+            bbox = (
+                min(bbox[0], old_bbox[0]),
+                max(bbox[1], old_bbox[1]),
+                min(bbox[2], old_bbox[2]),
+                max(bbox[3], old_bbox[3]),
+            )
+        incomplete_regions[region_label] = bbox
+
+
+def get_nuclear_crops_in_window(
+    image: np.ndarray,
+    label_image: np.ndarray,
+    window: Tuple[int],
+    tile: Tuple[int] = None,
+    region_labels: List[int] = None,
+    min_area: int = None,
+    max_area: int = None,
+    max_bbarea: int = None,
+    max_eccentricity: float = None,
+    min_solidity: float = None,
+    min_aspect_ratio: float = None,
+    convex_crop: bool = False,
+    extract_ncmo_features: bool = True,
+    target_size: Tuple[int] = None,
+    intensity_range: Tuple[float] = None,
+    ncmo_n_jobs: int = 1,
+    ncmo_cache: dict = None,
+    profile_type: str = "nmco",
+) -> Tuple[dict, pd.DataFrame, List[np.ndarray], dict]:
+    # Extracts the nuclei of the given window of the image whose centroid lies within the given tile (or which are
+    # given by region_labels). Nuclei touching a window border that is not an image border are not extracted but
+    # returned with their (truncated) bounding box such that they can be extracted from a larger window. As the
+    # centroid of such a truncated nucleus is not the one of the whole nucleus, they are returned irrespective of the
+    # tile. The labels of the complete nuclei in the tile are returned as well as these are settled by the window.
+    window_slice = (slice(window[0], window[1]), slice(window[2], window[3]))
+    image = np.asarray(image[window_slice])
+    label_image_shape = label_image.shape
+    label_image = np.asarray(label_image[window_slice])
+
+    # The properties used for filtering are computed once for all regions and the filters are applied as masks.
+    # Only the solidity (requiring the convex hull) is computed for the regions that passed all other filters.
+    props = regionprops_table(
+        label_image,
+        properties=[
+            "label",
+            "area",
+            "bbox",
+            "eccentricity",
+            "minor_axis_length",
+            "major_axis_length",
+            "centroid",
+        ],
+    )
+    props["centroid-0"] = props["centroid-0"] + window[0]
+    props["centroid-1"] = props["centroid-1"] + window[2]
+    widths = props["bbox-2"] - props["bbox-0"]
+    heights = props["bbox-3"] - props["bbox-1"]
+
+    considered = np.ones(len(props["label"]), dtype=bool)
+    if region_labels is not None:
+        considered &= np.isin(props["label"], region_labels)
+    incomplete = (
+        ((props["bbox-0"] == 0) & (window[0] > 0))
+        | ((props["bbox-1"] == 0) & (window[2] > 0))
+        | ((props["bbox-2"] == label_image.shape[0]) & (window[1] < label_image_shape[0]))
+        | ((props["bbox-3"] == label_image.shape[1]) & (window[3] < label_image_shape[1]))
+    )
+    incomplete_regions = {
+        props["label"][k]: (
+            props["bbox-0"][k] + window[0],
+            props["bbox-2"][k] + window[0],
+            props["bbox-1"][k] + window[2],
+            props["bbox-3"][k] + window[2],
+        )
+        for k in np.flatnonzero(considered & incomplete)
+    }
+    if tile is not None:
+        considered &= (
+            (props["centroid-0"] >= tile[0])
+            & (props["centroid-0"] < tile[1])
+            & (props["centroid-1"] >= tile[2])
+            & (props["centroid-1"] < tile[3])
+        )
+    complete_labels = props["label"][considered & ~incomplete]
+
+    selected = select_nuclear_regions(
+        props,
+        label_image,
+        min_area=min_area,
+        max_area=max_area,
+        max_bbarea=max_bbarea,
+        max_eccentricity=max_eccentricity,
+        min_solidity=min_solidity,
+        min_aspect_ratio=min_aspect_ratio,
+        candidates=considered & ~incomplete,
+    )
+    if convex_crop:
+        regions = regionprops(label_image)
+
+    # Only the nuclei passing the filters are featurized
+    if extract_ncmo_features and selected.any() and profile_type == "carpenter":
+        nmco_features = compute_carpenter_profiles(
+            label_image=label_image,
+            intensity_image=image,
+            intensity_range=intensity_range,
+            labels=props["label"][selected],
+            offset=(window[0], window[2]),
+        )
+    elif extract_ncmo_features and selected.any():
+        nmco_features = compute_nuclear_chromatin_features(
+            label_image=label_image,
+            intensity_image=image,
+            intensity_range=intensity_range,
+            n_jobs=ncmo_n_jobs,
+            feature_cache=get_nuclear_feature_cache(ncmo_cache),
+            labels=props["label"][selected],
+        )
+        nmco_features["centroid-0"] += window[0]
+        nmco_features["centroid-1"] += window[2]
+    else:
+        nmco_features = None
+
+    crops = []
+    for k in np.flatnonzero(selected):
+        bbox_slice = (
+            slice(props["bbox-0"][k], props["bbox-2"][k]),
+            slice(props["bbox-1"][k], props["bbox-3"][k]),
+        )
+        # returns convex crop of the segmented object.
+        if convex_crop:
+            cropped = image[bbox_slice] * regions[k].convex_image
+        else:
+            cropped = image[bbox_slice] * (label_image[bbox_slice] == props["label"][k])
+
+        # If a target size is given, the crops are directly padded and normalized and crops exceeding the target
+        # size are not saved.
+        if target_size is not None:
+            if widths[k] > target_size[0] or heights[k] > target_size[1]:
+                cropped = None
+            else:
+                cropped = pad_and_normalize_image(cropped, target_size)
+        crops.append(cropped)
+
+    nuclei_props = {
+        "label": props["label"][selected],
+        "bb_width": widths[selected],
+        "bb_height": heights[selected],
+        "minor_axis_length": props["minor_axis_length"][selected],
+        "major_axis_length": props["major_axis_length"][selected],
+        "centroid_0": props["centroid-0"][selected],
+        "centroid_1": props["centroid-1"][selected],
+    }
+    return nuclei_props, nmco_features, crops, incomplete_regions, complete_labels
+
+
+def get_nuclear_crops_for_single_image(
+    image_file_path: str,
+    label_image_file_path: str,
+    plate_output_dir: str,
+    min_area: int = None,
+    max_area: int = None,
+    max_bbarea: int = None,
+    max_eccentricity: float = None,
+    min_solidity: float = None,
+    min_aspect_ratio: float = None,
+    convex_crop: bool = False,
+    extract_ncmo_features: bool = True,
+    crop_format: str = "tiff",
+    target_size: Tuple[int] = None,
+    outline_segmentation_params: dict = None,
+    tile_size: int = None,
+    tile_halo: int = 128,
+    memory_budget: float = None,
+    ncmo_n_jobs: int = 1,
+    ncmo_cache: dict = None,
+    profile_type: str = "nmco",
+) -> Tuple[pd.DataFrame, pd.DataFrame, List[np.ndarray]]:
+    image_file_name = os.path.split(image_file_path)[1]
+    fname_start = image_file_name[: image_file_name.index(".")]
+    fname_ending = image_file_name[image_file_name.index(".") :]
+
+    # If outline segmentation parameters are given, the label image is obtained from the outline image found at
+    # label_image_file_path instead of being read from disk. As this requires the full image, it is not memory-mapped.
+    if outline_segmentation_params is not None:
+        image = imread(image_file_path)
+        label_image = get_label_image_from_outline(
+            imread(label_image_file_path), **outline_segmentation_params
+        )
+    else:
+        image = open_image(image_file_path)
+        label_image = open_image(label_image_file_path)
+
+    # In tiled mode, the image is processed in tiles extended by a halo and every nucleus is extracted from the tile
+    # containing its centroid. The tile size is either given or derived from the memory budget (in MB).
+    if tile_size is None and memory_budget is not None:
+        tile_size = get_tile_size(
+            image,
+            label_image,
+            memory_budget=memory_budget,
+            tile_halo=tile_halo,
+            extract_ncmo_features=extract_ncmo_features,
+        )
+    if tile_size is None:
+        windows = get_tile_windows(image.shape)
+        intensity_range = None
+    else:
+        windows = get_tile_windows(image.shape, tile_size, tile_halo)
+        # The intensities are normalized w.r.t. the full image for the nmco features
+        tile_ranges = [
+            (np.min(image[t[0] : t[1], t[2] : t[3]]), np.max(image[t[0] : t[1], t[2] : t[3]]))
+            for _, t in windows
+        ]
+        intensity_range = (
+            min([r[0] for r in tile_ranges]),
+            max([r[1] for r in tile_ranges]),
+        )
+    window_params = {
+        "min_area": min_area,
+        "max_area": max_area,
+        "max_bbarea": max_bbarea,
+        "max_eccentricity": max_eccentricity,
+        "min_solidity": min_solidity,
+        "min_aspect_ratio": min_aspect_ratio,
+        "convex_crop": convex_crop,
+        "extract_ncmo_features": extract_ncmo_features,
+        "target_size": target_size,
+        "intensity_range": intensity_range,
+        "ncmo_n_jobs": ncmo_n_jobs,
+        "ncmo_cache": ncmo_cache,
+        "profile_type": profile_type,
+    }
+
+    results = []
+    incomplete_regions = {}
+    complete_labels = set()
+    for window, tile in windows:
+        res = get_nuclear_crops_in_window(
+            image, label_image, window, tile, **window_params
+        )
+        results.append(res[:3])
+        update_incomplete_regions(incomplete_regions, res[3])
+        complete_labels.update(res[4])
+    # Nuclei that exceed the halo and were not complete in the window of the tile containing their centroid are
+    # extracted once from windows around their bounding box that are enlarged until the nuclei are fully contained.
+    incomplete_regions = {
+        region_label: bbox
+        for region_label, bbox in incomplete_regions.items()
+        if region_label not in complete_labels
+    }
+    halo = tile_halo
+    while len(incomplete_regions) > 0:
+        halo *= 2
+        still_incomplete_regions = {}
+        for region_label, bbox in incomplete_regions.items():
+            window = (
+                max(bbox[0] - halo, 0),
+                min(bbox[1] + halo, image.shape[0]),
+                max(bbox[2] - halo, 0),
+                min(bbox[3] + halo, image.shape[1]),
+            )
+            res = get_nuclear_crops_in_window(
+                image, label_image, window, region_labels=[region_label], **window_params
+            )
+            results.append(res[:3])
+            update_incomplete_regions(still_incomplete_regions, res[3])
+        incomplete_regions = still_incomplete_regions
+
+    nuclei_props = {
+        key: np.concatenate([res[0][key] for res in results])
+        for key in results[0][0].keys()
+    }
+    crops = [crop for res in results for crop in res[2]]
+    nmco_features = [res[1] for res in results if res[1] is not None]
+    nmco_features = (
+        pd.concat(nmco_features, ignore_index=True) if len(nmco_features) > 0 else None
+    )
+
+    # Nuclei are ordered by their label as when processing the image as a whole
+    if len(results) > 1:
+        order = np.argsort(nuclei_props["label"], kind="stable")
+        nuclei_props = {key: value[order] for key, value in nuclei_props.items()}
+        crops = [crops[k] for k in order]
+        if nmco_features is not None:
+            nmco_features = nmco_features.sort_values(
+                "label", kind="stable"
+            ).reset_index(drop=True)
+
+    output_file_names = [
+        fname_start + "_{}".format(region_label) + fname_ending
+        for region_label in nuclei_props["label"]
+    ]
+    if crop_format == "tiff":
+        if not os.path.exists(plate_output_dir):
+            os.makedirs(plate_output_dir, exist_ok=True)
+        for output_file_name, cropped in zip(output_file_names, crops):
+            if cropped is not None:
+                tifffile.imsave(
+                    os.path.join(plate_output_dir, output_file_name), cropped
+                )
+        crops = None
+
+    nuclei_crops = pd.DataFrame(
+        {
+            "image_file": output_file_names,
+            "slide_image_name": np.repeat(
+                fname_start + fname_ending, len(output_file_names)
+            ),
+            "bb_width": nuclei_props["bb_width"],
+            "bb_height": nuclei_props["bb_height"],
+            "minor_axis_length": nuclei_props["minor_axis_length"],
+            "major_axis_length": nuclei_props["major_axis_length"],
+            "centroid_0": nuclei_props["centroid_0"],
+            "centroid_1": nuclei_props["centroid_1"],
+        }
+    )
+    return nuclei_crops, nmco_features, crops
+
+
+def save_label_image_from_outline(
+    outline_file_path: str,
+    label_image_file_path: str,
+    min_area: int = None,
+    fill_holes: int = 16,
+):
+    outline_image = imread(outline_file_path)
+    label_image = get_label_image_from_outline(
+        outline_image, min_area=min_area, fill_holes=fill_holes
+    )
+    os.makedirs(os.path.split(label_image_file_path)[0], exist_ok=True)
+    tifffile.imsave(label_image_file_path, label_image)
+
+
+# Crop stores and nmco feature caches opened by the current (worker) process
+crop_stores = {}
+feature_caches = {}
+
+
+def get_nuclear_feature_cache(ncmo_cache: dict = None) -> NuclearFeatureCache:
+    if ncmo_cache is None:
+        return None
+    if ncmo_cache["cache_file"] not in feature_caches:
+        feature_caches[ncmo_cache["cache_file"]] = NuclearFeatureCache(
+            ncmo_cache["cache_file"],
+            max_size=ncmo_cache["max_size"],
+            version=NMCO_FEATURE_VERSION,
+        )
+    return feature_caches[ncmo_cache["cache_file"]]
+
+
+def load_crop(crop_loc: str, crop_store_dir: str = None):
+    if crop_store_dir is not None:
+        if crop_store_dir not in crop_stores:
+            crop_stores[crop_store_dir] = PackedCropStore(crop_store_dir)
+        plate, file_name = crop_loc.split("/")
+        image = crop_stores[crop_store_dir][crop_loc]
+    else:
+        image = imread(crop_loc)
+        dir_name, file_name = os.path.split(crop_loc)
+        plate = os.path.split(dir_name)[1]
+    return plate, file_name, image
+
+
+def save_padded_crop(
+    crop_loc: str,
+    output_dir: str,
+    target_size: Tuple[int],
+    crop_store_dir: str = None,
+    crop_format: str = "tiff",
+) -> Tuple[str, str, bool, np.ndarray]:
+    plate, file_name, image = load_crop(crop_loc, crop_store_dir)
+    width, height = image.shape
+    if width > target_size[0] or height > target_size[1]:
+        return plate, file_name, True, None
+
+    padded_image = pad_and_normalize_image(image, target_size)
+    if crop_format == "packed":
+        return plate, file_name, False, padded_image
+    plate_output_dir = os.path.join(output_dir, plate)
+    os.makedirs(plate_output_dir, exist_ok=True)
+    tifffile.imsave(os.path.join(plate_output_dir, file_name), padded_image)
+    return plate, file_name, False, None
+
+
+def save_resized_crop(
+    crop_loc: str,
+    output_dir: str,
+    target_size: Tuple[int],
+    crop_store_dir: str = None,
+    crop_format: str = "tiff",
+) -> Tuple[str, str, np.ndarray]:
+    plate, file_name, image = load_crop(crop_loc, crop_store_dir)
+    resized_image = cv2.resize(np.asarray(image), dsize=tuple(target_size))
+    if crop_format == "packed":
+        return plate, file_name, resized_image
+    plate_output_dir = os.path.join(output_dir, plate)
+    os.makedirs(plate_output_dir, exist_ok=True)
+    tifffile.imsave(os.path.join(plate_output_dir, file_name), resized_image)
+    return plate, file_name, None
+
+
+def get_slide_context_patches(
+    slide_image_file: str,
+    centroids: np.ndarray,
+    patch_size: int,
+    target_size: int = None,
+) -> List[np.ndarray]:
+    # The patches are computed as by the slide image pipeline of the multi-image data set: the normalized slide image
+    # is padded with its 1st percentile, cropped around the nuclei and resized bilinearly
+    image = normalize_image_to_uint8(imread(slide_image_file))
+    fill = int(np.percentile(image, 1))
+    patches = []
+    for centroid in centroids:
+        patch = get_centered_crop(image, centroid, size=patch_size, fill=fill)
+        if target_size is not None:
+            patch = np.asarray(
+                Image.fromarray(patch).resize(
+                    (target_size, target_size), Image.BILINEAR
+                )
+            )
+        patches.append(patch)
+    return patches
+
+
+class NuclearCropResultStream(object):
+    r"""Results of the nuclear crop extraction that are streamed to disk batch by batch.
+
+    The nuclei metadata and the nmco features are appended to part-wise on-disk tables. Only the statistics required
+    to compute the derived nuclei metadata and to select the nmco features in a final pass are kept in memory.
+    """
+
+    def __init__(self, stream_dir: str):
+        self.stream_dir = stream_dir
+        self.nuclei_metadata = TablePartWriter(
+            os.path.join(stream_dir, "nuclei_metadata")
+        )
+        self.nmco_features = TablePartWriter(os.path.join(stream_dir, "nmco_features"))
+        self.image_metadata = []
+
+        # Aspect ratios and slide images (as codes) of all nuclei
+        self.aspect_ratios = []
+        self.slide_codes = []
+        self.slide_image_names = {}
+        self.max_width = 0
+        self.max_height = 0
+        # Common dtypes of the columns of all parts
+        self.dtypes = {"nuclei_metadata": {}, "nmco_features": {}}
+        # Columns of the nmco features in order of their appearance and the ones that contain missing values or
+        # differ from the first row
+        self.nmco_cols = {}
+        self.nmco_first_row = None
+        self.nmco_na_cols = set()
+        self.nmco_varying_cols = set()
+
+    def append(
+        self,
+        nuclei_metadata: pd.DataFrame,
+        image_metadata: pd.DataFrame,
+        nmco_features: pd.DataFrame = None,
+    ):
+        self.image_metadata.append(image_metadata)
+        if len(nuclei_metadata) > 0:
+            self.nuclei_metadata.append(nuclei_metadata)
+            self.aspect_ratios.append(
+                np.array(
+                    nuclei_metadata["minor_axis_length"]
+                    / nuclei_metadata["major_axis_length"]
+                )
+            )
+            codes, slide_image_names = pd.factorize(
+                nuclei_metadata["slide_image_name"]
+            )
+            global_codes = np.array(
+                [
+                    self.slide_image_names.setdefault(name, len(self.slide_image_names))
+                    for name in slide_image_names
+                ],
+                dtype=np.int64,
+            )
+            self.slide_codes.append(global_codes[codes])
+            self.max_width = max(self.max_width, nuclei_metadata["bb_width"].max())
+            self.max_height = max(
+                self.max_height, nuclei_metadata["bb_height"].max()
+            )
+            update_common_dtypes(self.dtypes["nuclei_metadata"], nuclei_metadata)
+
+        if nmco_features is not None and len(nmco_features) > 0:
+            nmco_features = nmco_features.drop(columns="label")
+            self.nmco_features.append(nmco_features)
+            if self.nmco_first_row is None:
+                self.nmco_first_row = nmco_features.iloc[0]
+            # Columns missing in some parts contain missing values in the merged features
+            for col in nmco_features.columns:
+                if col not in self.nmco_cols:
+                    self.nmco_cols[col] = True
+                    if len(self.nmco_features) > 1:
+                        self.nmco_na_cols.add(col)
+            self.nmco_na_cols.update(set(self.nmco_cols) - set(nmco_features.columns))
+            self.nmco_na_cols.update(
+                nmco_features.columns[nmco_features.isna().any()]
+            )
+            self.nmco_varying_cols.update(
+                nmco_features.columns[
+                    (
+                        nmco_features
+                        != self.nmco_first_row.reindex(nmco_features.columns)
+                    ).any()
+                ]
+            )
+            update_common_dtypes(self.dtypes["nmco_features"], nmco_features)
+
+    def remove(self):
+        self.nuclei_metadata.remove()
+        self.nmco_features.remove()
+        os.rmdir(self.stream_dir)
+
+
+class BaseImageDatasetPreprocessor:
+    # Metadata columns kept for the nuclei metadata and their new names
+    selected_cols = []
+    new_selected_cols = []
+
     def __init__(
         self,
         image_input_dir: str,
         metadata_file: str,
         output_dir: str,
-        raw_image_col_name: str = "Image_FileName_OrigHoechst",
-        illum_image_col_name: str = "Image_FileName_IllumHoechst",
-        plate_col_name: str = "Image_Metadata_Plate",
-        well_col_name: str = "Image_Metadata_Well",
+        illum_image_col_name: str,
+        plate_col_name: str,
+        well_col_name: str,
+        cache_dir: str = None,
+        content_hash: bool = False,
+        table_format: str = "csv",
     ):
         self.image_input_dir = image_input_dir
         self.output_dir = output_dir
+        # If a cache directory is given, the outputs of the preprocessing stages are kept there together with the
+        # fingerprints of their inputs such that later runs only process new or changed inputs.
+        self.cache_dir = cache_dir
+        self.content_hash = content_hash
+        # The nuclei metadata and features are saved as gzipped CSV (table_format="csv") or as compressed HDF5 tables
+        # (table_format="hdf") whose rows can be selected by gene symbol and plate without reading the full table.
+        if table_format not in ["csv", "hdf"]:
+            raise ValueError("Unknown table format: {}".format(table_format))
+        self.table_format = table_format
 
-        self.raw_image_col_name = raw_image_col_name
         self.illum_image_col_name = illum_image_col_name
         self.plate_col_name = plate_col_name
         self.well_col_name = well_col_name
 
         self.metadata = pd.read_csv(metadata_file)
         self.processed_image_metadata = None
-        self.nuclei_metadata = None
 
         self.nuclei_metadata_file = None
         self.processed_image_metadata_file = None
@@ -52,116 +716,55 @@ class ImageDatasetPreprocessor:
         self.nuclei_dir = None
         self.pad_size = None
 
-    def add_image_illumination_col(self, posfix: str = "_illum_corrected"):
-        orig_image_file_names = list(self.metadata[self.raw_image_col_name])
-        illum_corrected_image_file_names = []
-        for orig_image_file_name in orig_image_file_names:
-            idx = orig_image_file_name.index(".")
-            illum_corrected_image_file_name = (
-                orig_image_file_name[:idx] + posfix + orig_image_file_name[idx:]
-            )
-            illum_corrected_image_file_names.append(illum_corrected_image_file_name)
-        self.metadata[self.illum_image_col_name] = illum_corrected_image_file_names
-
-    def filter_out_qc_flagged_images(
-        self,
-        blurry_col="Image_Metadata_QCFlag_isBlurry",
-        saturated_col="Image_Metadata_QCFlag_isSaturated",
-    ):
-        self.metadata = self.metadata.loc[
-            (self.metadata[blurry_col] == 0) & (self.metadata[saturated_col] == 0)
-        ]
-
-    def remove_outlier_images(
-        self,
-        outlier_plates: List = None,
-        outlier_plate_wells: List = None,
-        outlier_wells: List = None,
-    ):
-        if outlier_plates is not None:
-            for outlier_plate in outlier_plates:
-                self.metadata = self.metadata.loc[
-                    self.metadata[self.plate_col_name] != outlier_plate
-                ]
-        if outlier_plate_wells is not None:
-            for outlier_plate_well in outlier_plate_wells:
-                self.metadata = self.metadata.loc[
-                    (self.metadata[self.plate_col_name] != outlier_plate_well[0])
-                    | (self.metadata[self.well_col_name] != outlier_plate_well[1])
-                ]
-        if outlier_wells is not None:
-            for outlier_well in outlier_wells:
-                self.metadata = self.metadata.loc[
-                    self.metadata[self.well_col_name] != outlier_well
-                ]
-        self.metadata.to_csv(
-            os.path.join(self.output_dir, "filtered_image_metadata.csv")
-        )
-
-    def save_filtered_images(self,):
-        output_dir = os.path.join(self.output_dir, "filtered")
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-        n = len(self.metadata)
-        for i in tqdm(range(n), desc="Copying filtered images"):
-            plate = self.metadata.iloc[
-                i, list(self.metadata.columns).index(self.plate_col_name)
-            ]
-            filename = self.metadata.iloc[
-                i, list(self.metadata.columns).index(self.illum_image_col_name)
+        self.label_image_dir = None
+        self.outline_segmentation = None
+
+        # Numbers of items (e.g. images, nuclei) processed by the last pipeline step, reported in the resource usage
+        # summary of the ExperimentRunner
+        self.item_counts = {}
+
+    def get_image_locs(
+        self, label_image_input_dir: str, label_image_col_name: str = None
+    ) -> Tuple[List[str], List[str], List[str]]:
+        raise NotImplementedError
+
+    def get_table_file(self, name: str) -> str:
+        if self.table_format == "hdf":
+            return os.path.join(self.output_dir, "{}.h5".format(name))
+        return os.path.join(self.output_dir, "{}.csv.gz".format(name))
+
+    def save_table(self, data: pd.DataFrame, file_path: str):
+        save_table(data, file_path, data_columns=["gene_symbol", "plate"])
+
+    def get_stage_output_dir(self, name: str) -> str:
+        # Stage outputs are kept in the cache directory to be reused by later runs
+        if self.cache_dir is not None:
+            return os.path.join(self.cache_dir, name)
+        return os.path.join(self.output_dir, name)
+
+    def get_nuclear_crop_shards(
+        self, shard_by_plate: bool = False, shard_size: int = None
+    ) -> List[Tuple[str, np.ndarray]]:
+        idc = np.arange(len(self.metadata))
+        if shard_by_plate:
+            plates = np.array(self.metadata.loc[:, self.plate_col_name], dtype=str)
+            groups = [
+                ("plate_{}".format(plate), idc[plates == plate])
+                for plate in np.unique(plates)
             ]
-
-            plate_output_dir = os.path.join(output_dir, str(plate))
-            plate_input_dir = os.path.join(self.image_input_dir, str(plate))
-            if not os.path.exists(plate_output_dir):
-                os.makedirs(plate_output_dir)
-
-            plate_output_file = os.path.join(plate_output_dir, filename)
-            plate_input_file = os.path.join(plate_input_dir, filename)
-
-            try:
-                copyfile(plate_input_file, plate_output_file)
-            except FileNotFoundError as e:
-                logging.error(e)
-        logging.debug(
-            "Images (n={}) copied to {}.".format(len(self.metadata), output_dir)
-        )
-
-    def segment_all_images_given_outlines(
-        self,
-        outline_input_dir,
-        nuclei_outline_col_name: str = "Image_FileName_NucleiOutlines",
-        min_area: int = None,
-        fill_holes: int = 16,
-    ):
-        output_dir = os.path.join(self.output_dir, "label_images")
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-
-        for i in tqdm(range(len(self.metadata)), desc="Segment images using outlines"):
-            plate = str(self.metadata.iloc[i, :][self.plate_col_name])
-
-            image_file_name = self.metadata.iloc[i, :][self.illum_image_col_name]
-
-            outline_file_name = self.metadata.iloc[i, :][nuclei_outline_col_name]
-            outline_file_path = os.path.join(
-                outline_input_dir, plate, outline_file_name
-            )
-            outline_image = imread(outline_file_path)
-            plate_output_dir = os.path.join(output_dir, plate)
-
-            if not os.path.exists(plate_output_dir):
-                os.makedirs(plate_output_dir)
-
-            label_image_file_path = os.path.join(plate_output_dir, image_file_name)
-
-            mask_image = get_mask_image_from_outline(outline_image)
-
-            mask_image = remove_small_holes(mask_image, area_threshold=fill_holes)
-            mask_image = remove_small_objects(mask_image, min_size=min_area)
-            label_image = label(mask_image)
-
-            tifffile.imsave(label_image_file_path, label_image)
+        else:
+            groups = [("all", idc)]
+        if shard_size is None:
+            return groups
+
+        shards = []
+        for group_name, group_idc in groups:
+            for k, start in enumerate(range(0, len(group_idc), shard_size)):
+                shard_name = "chunk_{:05d}".format(k)
+                if shard_by_plate:
+                    shard_name = group_name + "_" + shard_name
+                shards.append((shard_name, group_idc[start : start + shard_size]))
+        return shards
 
     def get_nuclear_crops(
         self,
@@ -177,300 +780,692 @@ class ImageDatasetPreprocessor:
         convex_crop: bool = False,
         extract_ncmo_features: bool = True,
         n_jobs: int = 5,
+        shard_by_plate: bool = False,
+        shard_size: int = None,
+        shard_dir: str = None,
+        crop_format: str = "tiff",
+        batch_size: int = 256,
+        target_size: Tuple[int] = None,
+        tile_size: int = None,
+        tile_halo: int = 128,
+        memory_budget: float = None,
+        ncmo_n_jobs: int = 1,
+        ncmo_cache_file: str = None,
+        ncmo_cache_size: float = 1024,
+        profile_type: str = "nmco",
     ):
-        nuclei_counts = []
-        nuclei_counts_rep = []
-        slide_image_names = []
-        image_metadata = self.metadata.copy()
-        all_nmco_features = []
-
-        nuclei_widths = []
-        nuclei_heights = []
-        nuclei_minor_axis_lengths = []
-        nuclei_major_axis_lengths = []
-        nuclei_centroids_0 = []
-        nuclei_centroids_1 = []
-
-        metadata_cols = list(self.metadata.columns)
-
-        if output_dir is None:
-            output_dir = os.path.join(self.output_dir, "nuclei_images")
+        r"""Extracts the crops of the segmented nuclei and their metadata and nmco features.
+
+        Parameters
+        ----------
+        label_image_input_dir : str
+            Directory of the label images. If not given, the label images of a previous segmentation step are used.
+        output_dir : str
+            Output directory of the crops, by default the nuclei_images (or padded_nuclei) stage directory.
+        nuclei_count_col_name : str
+            Column of the metadata holding the number of nuclei per image.
+        min_area, max_area, max_bbarea, max_eccentricity, min_solidity, min_aspect_ratio : float
+            Filters of the nuclei (see get_nuclear_crops_for_single_image).
+        convex_crop : bool
+            If True, the crops are restricted to the convex hull of the nuclei.
+        extract_ncmo_features : bool
+            If True, the nuclear profiles given by profile_type are computed.
+        n_jobs : int
+            Number of workers processing the images.
+        shard_by_plate, shard_size, shard_dir
+            Sharding options, see get_nuclear_crop_sharding.
+        crop_format : str
+            The crops are saved as individual TIFF files (``"tiff"``) or packed per shard in a memory-mappable crop
+            store located at output_dir (``"packed"``).
+        batch_size : int
+            Number of images whose results are held in memory at a time.
+        target_size : tuple
+            If given, the crops are padded to that size and normalized to uint8 directly after their extraction
+            (yielding the same images as save_padded_images) and only the padded crops are saved.
+        tile_size, tile_halo, memory_budget
+            If tile_size or memory_budget (in MB per worker) are given, the (memory-mapped) images are processed in
+            tiles extended by tile_halo pixels to bound the memory required per worker.
+        ncmo_n_jobs : int
+            Number of workers computing the nmco features of the nuclei of an image (e.g. for dense fields of view).
+        ncmo_cache_file, ncmo_cache_size
+            Cache of the nmco features of individual nuclei, see get_ncmo_cache.
+        profile_type : str
+            Either ``"nmco"`` or ``"carpenter"`` for CellProfiler-style profiles (see compute_carpenter_profiles) that
+            are saved to nuclei_carpenter_profiles in the same format.
+        """
+        if nuclei_count_col_name not in self.metadata.columns:
+            self.metadata.loc[:, nuclei_count_col_name] = -1
 
+        if output_dir is None and target_size is None:
+            output_dir = self.get_stage_output_dir("nuclei_images")
+        elif output_dir is None:
+            output_dir = self.get_stage_output_dir("padded_nuclei")
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
 
-        def get_image_crops_for_single_image(
-            i, extract_ncmo_features: bool = True, center_crop_slide_dir: bool = False
-        ):
-            slide_image_names = []
-            widths = []
-            heights = []
-            minor_axis_lengths = []
-            major_axis_lengths = []
-            centroids_0 = []
-            centroids_1 = []
-            nuclei_metadata = []
-            nuclei_count = 0
-            plate = str(self.metadata.iloc[i, :][self.plate_col_name])
-
-            image_file_name = self.metadata.iloc[i, :][self.illum_image_col_name]
-            label_image_file_name = image_file_name
+        crop_params = self.get_nuclear_crop_params(
+            min_area=min_area,
+            max_area=max_area,
+            max_bbarea=max_bbarea,
+            max_eccentricity=max_eccentricity,
+            min_solidity=min_solidity,
+            min_aspect_ratio=min_aspect_ratio,
+            convex_crop=convex_crop,
+            extract_ncmo_features=extract_ncmo_features,
+            crop_format=crop_format,
+            target_size=target_size,
+            tile_size=tile_size,
+            tile_halo=tile_halo,
+            memory_budget=memory_budget,
+            ncmo_n_jobs=ncmo_n_jobs,
+            profile_type=profile_type,
+        )
+        shards, shard_dir = self.get_nuclear_crop_sharding(
+            shard_by_plate=shard_by_plate, shard_size=shard_size, shard_dir=shard_dir
+        )
+        ncmo_cache = self.get_ncmo_cache(
+            extract_ncmo_features=extract_ncmo_features,
+            profile_type=profile_type,
+            ncmo_cache_file=ncmo_cache_file,
+            ncmo_cache_size=ncmo_cache_size,
+        )
+        images = self.get_nuclear_crop_inputs(label_image_input_dir, crop_params)
+        params_key = get_params_key([output_dir, crop_params])
+
+        # The results are streamed to disk batch by batch such that only the results of the current batch are held
+        # in memory. The derived nuclei metadata and the selected nmco features are saved in a final pass.
+        stream = NuclearCropResultStream(self.get_stage_output_dir("nuclei_stream"))
+        with Parallel(n_jobs=n_jobs) as parallel:
+            for shard_name, idc in shards:
+                self.process_nuclear_crop_shard(
+                    parallel,
+                    stream,
+                    shard_name,
+                    idc,
+                    images=images,
+                    output_dir=output_dir,
+                    crop_params=crop_params,
+                    ncmo_cache=ncmo_cache,
+                    batch_size=batch_size,
+                    nuclei_count_col_name=nuclei_count_col_name,
+                    shard_dir=shard_dir,
+                    params_key=params_key,
+                )
 
-            image_file_path = os.path.join(self.image_input_dir, plate, image_file_name)
-            label_image_file_path = os.path.join(
-                label_image_input_dir, plate, label_image_file_name
+        logging.debug("Nuclei segmentation complete.")
+        logging.debug(
+            "Maximum image dimensions: ({}, {})".format(
+                stream.max_width, stream.max_height
             )
+        )
+        self.pad_size = stream.max_width + 1, stream.max_height + 1
+        self.nuclei_dir = output_dir
+        self.nuclei_metadata_file = self.get_table_file("processed_nuclei_metadata")
+        self.processed_image_metadata_file = self.get_table_file(
+            "processed_image_metadata"
+        )
+        if target_size is not None:
+            padded_nuclei_metadata_file = self.get_table_file("padded_nuclei_metadata")
+        else:
+            padded_nuclei_metadata_file = None
+        self.save_nuclear_crop_results(
+            stream,
+            padded_nuclei_metadata_file=padded_nuclei_metadata_file,
+            target_size=target_size,
+        )
+        if extract_ncmo_features:
+            if profile_type == "carpenter":
+                profile_file = self.get_table_file("nuclei_carpenter_profiles")
+            else:
+                profile_file = self.get_table_file("nuclei_ncmo_features")
+            self.save_nmco_features(stream, profile_file)
+        self.item_counts = {
+            "images": len(self.processed_image_metadata),
+            "nuclei": sum([len(part) for part in stream.aspect_ratios]),
+        }
+        stream.remove()
+        if target_size is not None:
+            self.nuclei_metadata_file = padded_nuclei_metadata_file
+
+    @staticmethod
+    def get_nuclear_crop_params(
+        crop_format: str = "tiff", profile_type: str = "nmco", **kwargs
+    ) -> dict:
+        # Validates the options of get_nuclear_crops and returns the parameters of get_nuclear_crops_for_single_image
+        # that determine the results of an image
+        if crop_format not in ["tiff", "packed"]:
+            raise ValueError("Unknown crop format: {}".format(crop_format))
+        if profile_type not in ["nmco", "carpenter"]:
+            raise ValueError("Unknown profile type: {}".format(profile_type))
+        crop_params = {
+            key: kwargs[key]
+            for key in [
+                "min_area",
+                "max_area",
+                "max_bbarea",
+                "max_eccentricity",
+                "min_solidity",
+                "min_aspect_ratio",
+                "convex_crop",
+                "extract_ncmo_features",
+            ]
+        }
+        crop_params.update(
+            {
+                "crop_format": crop_format,
+                "target_size": kwargs["target_size"],
+                "outline_segmentation_params": None,
+                "tile_size": kwargs["tile_size"],
+                "tile_halo": kwargs["tile_halo"],
+                "memory_budget": kwargs["memory_budget"],
+                "ncmo_n_jobs": kwargs["ncmo_n_jobs"],
+                "profile_type": profile_type,
+            }
+        )
+        return crop_params
 
-            image = imread(image_file_path)
-            label_image = imread(label_image_file_path)
+    def get_nuclear_crop_sharding(
+        self,
+        shard_by_plate: bool = False,
+        shard_size: int = None,
+        shard_dir: str = None,
+    ) -> Tuple[List[Tuple[str, np.ndarray]], str]:
+        # If sharding is requested, the metadata is processed in plate- and/or chunk-sized shards whose results are
+        # written to shard_dir as soon as a shard is complete. Re-running get_nuclear_crops with the same shard_dir
+        # (and output_dir) skips all shards that have been completed before. If a cache directory is set, the results
+        # are sharded by plate by default. Returns the shards and the shard directory (None if not sharded).
+        if self.cache_dir is not None and shard_size is None:
+            shard_by_plate = True
+        if shard_by_plate or shard_size is not None:
+            if shard_dir is None:
+                shard_dir = self.get_stage_output_dir("nuclei_shards")
+            if not os.path.exists(shard_dir):
+                os.makedirs(shard_dir)
+        else:
+            shard_dir = None
+        shards = self.get_nuclear_crop_shards(
+            shard_by_plate=shard_by_plate, shard_size=shard_size
+        )
+        return shards, shard_dir
 
-            image_metadata.iloc[i, metadata_cols.index(nuclei_count_col_name)] = len(
-                np.unique(label_image)
+    def get_ncmo_cache(
+        self,
+        extract_ncmo_features: bool = True,
+        profile_type: str = "nmco",
+        ncmo_cache_file: str = None,
+        ncmo_cache_size: float = 1024,
+    ) -> dict:
+        # The nmco features of individual nuclei are cached in ncmo_cache_file (with a size of at most ncmo_cache_size
+        # MB) which is located in the cache directory by default such that they are not recomputed for identical
+        # nuclei when re-running get_nuclear_crops e.g. with different crop settings.
+        if ncmo_cache_file is None and self.cache_dir is not None:
+            ncmo_cache_file = os.path.join(self.cache_dir, "nmco_feature_cache.sqlite")
+        if (
+            extract_ncmo_features
+            and profile_type == "nmco"
+            and ncmo_cache_file is not None
+        ):
+            return {"cache_file": ncmo_cache_file, "max_size": ncmo_cache_size}
+        return None
+
+    def get_nuclear_crop_inputs(
+        self, label_image_input_dir: str, crop_params: dict
+    ) -> dict:
+        # Returns the plates, image and label image files and (if a cache directory is set) the fingerprints of the
+        # images. Without label image directory, the label images of a previous segmentation step are used which are
+        # either read from disk or computed from the nuclei outlines on the fly if they were not saved (in which case
+        # the segmentation parameters are added to the crop parameters).
+        if label_image_input_dir is None:
+            label_image_input_dir = self.label_image_dir
+        if label_image_input_dir is None and self.outline_segmentation is not None:
+            plates, image_file_paths, label_image_file_paths = self.get_image_locs(
+                self.outline_segmentation["outline_input_dir"],
+                label_image_col_name=self.outline_segmentation[
+                    "nuclei_outline_col_name"
+                ],
             )
-
-            regions = regionprops(label_image=label_image, intensity_image=image)
-            if extract_ncmo_features and len(regions) > 0:
-                nmco_features = compute_nuclear_chromatin_features(
-                    label_image=label_image, intensity_image=image
+            crop_params["outline_segmentation_params"] = {
+                "min_area": self.outline_segmentation["min_area"],
+                "fill_holes": self.outline_segmentation["fill_holes"],
+            }
+        else:
+            plates, image_file_paths, label_image_file_paths = self.get_image_locs(
+                label_image_input_dir
+            )
+        if self.cache_dir is not None:
+            fingerprints = [
+                get_files_fingerprint(
+                    [image_file_path, label_image_file_path],
+                    content_hash=self.content_hash,
                 )
-            else:
-                nmco_features = None
-                
-
-            for region in regions:
-                width, height = region.image.shape
-
-                fname_start = image_file_name[: image_file_name.index(".")]
-                fname_ending = image_file_name[image_file_name.index(".") :]
-                plate_output_dir = os.path.join(output_dir, plate)
-
-                if not os.path.exists(plate_output_dir):
-                    os.makedirs(plate_output_dir)
-
-                if (
-                    (min_area is None or region.area >= min_area)
-                    and (max_area is None or region.area <= max_area)
-                    and (
-                        max_eccentricity is None
-                        or region.eccentricity <= max_eccentricity
-                    )
-                    and (max_bbarea is None or width * height <= max_bbarea)
-                    and (min_solidity is None or region.solidity >= min_solidity)
-                    and (
-                        min_aspect_ratio is None
-                        or (region.minor_axis_length / region.major_axis_length)
-                        >= min_aspect_ratio
-                    )
-                ):
-                    widths.append(width)
-                    heights.append(height)
-
-                    minor_axis_lengths.append(region.minor_axis_length)
-                    major_axis_lengths.append(region.major_axis_length)
-
-                    centroids_0.append(region.centroid[0])
-                    centroids_1.append(region.centroid[1])
-
-                    output_file_name = os.path.join(
-                        plate_output_dir,
-                        fname_start + "_{}".format(region.label) + fname_ending,
+                for image_file_path, label_image_file_path in zip(
+                    image_file_paths, label_image_file_paths
+                )
+            ]
+        else:
+            fingerprints = [None] * len(image_file_paths)
+        return {
+            "plates": plates,
+            "image_file_paths": image_file_paths,
+            "label_image_file_paths": label_image_file_paths,
+            "fingerprints": fingerprints,
+        }
+
+    def get_unchanged_nuclear_crop_results(
+        self,
+        shard_name: str,
+        idc: np.ndarray,
+        images: dict,
+        output_dir: str,
+        crop_format: str,
+        shard_dir: str,
+        params_key: str,
+    ) -> List:
+        # Returns the results of the images of the shard that did not change since the shard was last processed and
+        # None for the other images whose outdated crops are removed
+        res = [None] * len(idc)
+        if self.cache_dir is None:
+            return res
+        cached_res = self.load_cached_nuclear_crop_results(
+            shard_dir,
+            shard_name,
+            params_key,
+            crop_store_dir=output_dir if crop_format == "packed" else None,
+        )
+        for j, i in enumerate(idc):
+            cached = cached_res.get(images["image_file_paths"][i])
+            if cached is not None and cached[0] == images["fingerprints"][i]:
+                res[j] = cached[1:]
+            elif cached is not None and crop_format == "tiff":
+                # Remove outdated crops as the image might now yield fewer nuclei
+                for crop_file_name in cached[1].loc[:, "image_file"]:
+                    crop_file = os.path.join(
+                        output_dir, images["plates"][i], crop_file_name
                     )
+                    if os.path.exists(crop_file):
+                        os.remove(crop_file)
+        todo = [j for j in range(len(idc)) if res[j] is None]
+        if len(todo) < len(idc):
+            logging.debug(
+                "Shard {}: {} of {} images unchanged, process {} images.".format(
+                    shard_name, len(idc) - len(todo), len(idc), len(todo)
+                )
+            )
+        return res
 
-                    # returns convex crop of the segmented object.
-                    if convex_crop:
-                        xmin, ymin, xmax, ymax = region.bbox
-                        cropped = image[xmin:xmax, ymin:ymax] * region.convex_image
-                    else:
-                        cropped = region.intensity_image
-                        # cropped = image
-
-                    tifffile.imsave(output_file_name, cropped)
-                    nucleus_metadata = list(self.metadata.iloc[i, :])
-                    nucleus_metadata[
-                        metadata_cols.index(self.illum_image_col_name)
-                    ] = os.path.split(output_file_name)[1]
-                    slide_image_names.append(fname_start + fname_ending)
-                    nuclei_metadata.append(nucleus_metadata)
-
-                    nuclei_count += 1
-                else:
-                    if extract_ncmo_features and len(regions) > 0:
-                        nmco_features = nmco_features.loc[
-                            nmco_features["label"] != region.label
-                        ]
-                    else:
-                        nmco_features = None
-            return (
-                nuclei_metadata,
-                slide_image_names,
-                nuclei_count,
-                widths,
-                heights,
-                minor_axis_lengths,
-                major_axis_lengths,
-                centroids_0,
-                centroids_1,
-                nmco_features,
-            )
-
-        res = Parallel(n_jobs=15)(
-            delayed(get_image_crops_for_single_image)(i, extract_ncmo_features)
-            for i in tqdm(range(len(self.metadata)))
-        )
-        nuclei_metadata = []
-        for item in res:
-            nuclei_metadata.extend(item[0])
-            slide_image_names.extend(item[1])
-            nuclei_counts.append(item[2])
-            nuclei_counts_rep.extend([item[2]] * item[2])
-            nuclei_widths.extend(item[3])
-            nuclei_heights.extend(item[4])
-            nuclei_minor_axis_lengths.extend(item[5])
-            nuclei_major_axis_lengths.extend(item[6])
-            nuclei_centroids_0.extend(item[7])
-            nuclei_centroids_1.extend(item[8])
-            if item[9] is not None:
-                all_nmco_features.append(item[9])
-        if extract_ncmo_features:
-            all_nmco_features = pd.concat(all_nmco_features)
-
-        nuclei_metadata = pd.DataFrame(np.array(nuclei_metadata), columns=metadata_cols)
-        selected_cols = [
-            "Image_Metadata_Plate",
-            "Image_Metadata_Well",
-            "Image_FileName_IllumHoechst",
-            "Image_Metadata_GeneID",
-            "Image_Metadata_GeneSymbol",
-            "Image_Metadata_IsLandmark",
-            "Image_Metadata_AlleleDesc",
-            "Image_Metadata_ExpressionVector",
-            "Image_Metadata_FlaggedForToxicity",
-            "Image_Metadata_IE_Blast_noBlast",
-            "Image_Metadata_IntendedOrfMismatch",
-            "Image_Metadata_OpenOrClosed",
-            "Image_Metadata_RNAiVirusPlateName",
-            "Image_Metadata_Site",
-            "Image_Metadata_Type",
-            "Image_Metadata_Virus_Vol_ul",
-            "Image_Metadata_TimePoint_Hours",
-            "Image_Metadata_ASSAY_WELL_ROLE",
-        ]
-        new_selected_cols = [
-            "plate",
-            "well",
-            "image_file",
-            "gene_id",
-            "gene_symbol",
-            "is_landmark",
-            "allele",
-            "expr_vec",
-            "toxicity",
-            "ie_blast",
-            "intended_orf_mismatch",
-            "open_closed",
-            "rnai_plate",
-            "site",
-            "type",
-            "virus_vol",
-            "timepoint",
-            "assay_well_role",
-        ]
-
-        nuclei_widths = np.array(nuclei_widths)
-        nuclei_heights = np.array(nuclei_heights)
-
-        nuclei_minor_axis_lengths = np.array(nuclei_minor_axis_lengths)
-        nuclei_major_axis_lengths = np.array(nuclei_major_axis_lengths)
-
-        nuclei_centroids_0 = np.array(nuclei_centroids_0)
-        nuclei_centroids_1 = np.array(nuclei_centroids_1)
-
-        nuclei_metadata = nuclei_metadata.loc[:, selected_cols]
-        nuclei_metadata.columns = new_selected_cols
-        nuclei_metadata["bb_width"] = nuclei_widths
-        nuclei_metadata["bb_height"] = nuclei_heights
-
-        nuclei_metadata["minor_axis_length"] = nuclei_minor_axis_lengths
-        nuclei_metadata["major_axis_length"] = nuclei_major_axis_lengths
-        nuclei_metadata["aspect_ratio"] = (
-            nuclei_minor_axis_lengths / nuclei_major_axis_lengths
+    def process_nuclear_crop_shard(
+        self,
+        parallel: Parallel,
+        stream: NuclearCropResultStream,
+        shard_name: str,
+        idc: np.ndarray,
+        images: dict,
+        output_dir: str,
+        crop_params: dict,
+        ncmo_cache: dict = None,
+        batch_size: int = 256,
+        nuclei_count_col_name: str = "Image_Count_Nuclei",
+        shard_dir: str = None,
+        params_key: str = None,
+    ):
+        # Processes the images of a shard batch by batch and appends the results to the stream. If a shard directory
+        # is given, the results are saved as shard as well and a shard that has been completed before is loaded.
+        plates = images["plates"]
+        crop_format = crop_params["crop_format"]
+        if shard_dir is not None:
+            shard_key = hashlib.sha1(
+                json.dumps(
+                    [
+                        [images["image_file_paths"][i] for i in idc],
+                        [images["label_image_file_paths"][i] for i in idc],
+                        [images["fingerprints"][i] for i in idc],
+                        output_dir,
+                        crop_params,
+                    ]
+                ).encode()
+            ).hexdigest()
+            shard_parts = self.load_nuclear_crop_shard(shard_dir, shard_name, shard_key)
+            if shard_parts is not None:
+                logging.debug(
+                    "Shard {} already complete, skip processing.".format(shard_name)
+                )
+                stream.append(*shard_parts)
+                return
+
+        res = self.get_unchanged_nuclear_crop_results(
+            shard_name,
+            idc,
+            images,
+            output_dir=output_dir,
+            crop_format=crop_format,
+            shard_dir=shard_dir,
+            params_key=params_key,
         )
+        if crop_format == "packed":
+            crop_writer = PackedCropWriter(output_dir, part_name=shard_name)
+        else:
+            crop_writer = None
+        if shard_dir is not None:
+            # The shard files are only overwritten after the unchanged results have been loaded
+            shard_writers = self.get_nuclear_crop_shard_writers(shard_dir, shard_name)
+        for start in tqdm(
+            range(0, len(idc), batch_size), desc="Crop nuclei ({})".format(shard_name),
+        ):
+            batch = list(range(start, min(start + batch_size, len(idc))))
+            batch_todo = [j for j in batch if res[j] is None]
+            batch_res = parallel(
+                delayed(get_nuclear_crops_for_single_image)(
+                    image_file_path=images["image_file_paths"][i],
+                    label_image_file_path=images["label_image_file_paths"][i],
+                    plate_output_dir=os.path.join(output_dir, plates[i]),
+                    ncmo_cache=ncmo_cache,
+                    **crop_params
+                )
+                for i in idc[batch_todo]
+            )
+            for j, item in zip(batch_todo, batch_res):
+                res[j] = item
+            if crop_writer is not None:
+                for j in batch:
+                    for crop_file_name, crop in zip(
+                        res[j][0].loc[:, "image_file"], res[j][2]
+                    ):
+                        if crop is not None:
+                            crop_writer.add(plates[idc[j]], crop_file_name, crop)
+            batch_parts = self.assemble_nuclear_crop_results(
+                idc[batch], [res[j][:2] for j in batch], nuclei_count_col_name
+            )
+            for j in batch:
+                res[j] = None
+            if shard_dir is not None:
+                batch_parts[0].index = np.arange(
+                    shard_writers["nuclei_metadata"].n_rows,
+                    shard_writers["nuclei_metadata"].n_rows + len(batch_parts[0]),
+                )
+                for name, part in zip(
+                    ["nuclei_metadata", "image_metadata", "nmco_features"], batch_parts,
+                ):
+                    if part is not None:
+                        shard_writers[name].append(part)
+            stream.append(*batch_parts)
+        if crop_writer is not None:
+            crop_writer.close()
+        if shard_dir is not None:
+            self.save_nuclear_crop_shard(
+                shard_dir,
+                shard_name,
+                shard_key,
+                shard_writers,
+                params_key=params_key,
+                images={
+                    "paths": [images["image_file_paths"][i] for i in idc],
+                    "plates": [plates[i] for i in idc],
+                    "fingerprints": [images["fingerprints"][i] for i in idc],
+                },
+            )
+
+    def save_nuclear_crop_results(
+        self,
+        stream: NuclearCropResultStream,
+        padded_nuclei_metadata_file: str = None,
+        target_size: Tuple[int] = None,
+    ):
+        # The aspect ratio clusters are fitted on all nuclei and averaged per slide image. The nuclei metadata is then
+        # completed and saved part by part.
+        aspect_ratios = np.concatenate(stream.aspect_ratios)
+        slide_codes = np.concatenate(stream.slide_codes)
         gmm_ar = GaussianMixture(n_components=2, random_state=1234)
-        nuclei_metadata["aspect_ratio_cluster"] = gmm_ar.fit_predict(
-            np.array(nuclei_metadata["aspect_ratio"]).reshape(-1, 1)
+        aspect_ratio_clusters = gmm_ar.fit_predict(aspect_ratios.reshape(-1, 1))
+        aspect_ratio_cluster_ratios = np.bincount(
+            slide_codes, aspect_ratio_clusters
+        ) / np.bincount(slide_codes)
+
+        nuclei_metadata_cols = self.new_selected_cols + [
+            "bb_width",
+            "bb_height",
+            "minor_axis_length",
+            "major_axis_length",
+            "aspect_ratio",
+            "aspect_ratio_cluster",
+            "nuclei_count_image",
+            "slide_image_name",
+            "aspect_ratio_cluster_ratio",
+            "centroid_0",
+            "centroid_1",
+        ]
+        data_columns = ["gene_symbol", "plate"]
+        nuclei_metadata_writer = TableWriter(
+            self.nuclei_metadata_file,
+            data_columns=data_columns,
+            dtypes=stream.dtypes["nuclei_metadata"],
         )
+        if padded_nuclei_metadata_file is not None:
+            padded_nuclei_metadata_writer = TableWriter(
+                padded_nuclei_metadata_file,
+                data_columns=data_columns,
+                dtypes=stream.dtypes["nuclei_metadata"],
+            )
+        n_skipped = 0
+        for nuclei_metadata in stream.nuclei_metadata:
+            start = nuclei_metadata_writer.n_rows
+            end = start + len(nuclei_metadata)
+            nuclei_metadata.index = np.arange(start, end)
+            nuclei_metadata["aspect_ratio"] = aspect_ratios[start:end]
+            nuclei_metadata["aspect_ratio_cluster"] = aspect_ratio_clusters[start:end]
+            nuclei_metadata[
+                "aspect_ratio_cluster_ratio"
+            ] = aspect_ratio_cluster_ratios[slide_codes[start:end]]
+            nuclei_metadata = nuclei_metadata.loc[:, nuclei_metadata_cols]
+            nuclei_metadata_writer.append(nuclei_metadata)
+
+            if padded_nuclei_metadata_file is not None:
+                exceeds_target_size = (
+                    nuclei_metadata["bb_width"] > target_size[0]
+                ) | (nuclei_metadata["bb_height"] > target_size[1])
+                n_skipped += exceeds_target_size.sum()
+                padded_nuclei_metadata_writer.append(
+                    nuclei_metadata.loc[~exceeds_target_size]
+                )
+        if padded_nuclei_metadata_file is not None:
+            logging.debug(
+                "Padding complete: {} image were skipped as they exceeded the target"
+                " dimensions.".format(n_skipped)
+            )
 
-        nuclei_metadata["nuclei_count_image"] = np.array(nuclei_counts_rep)
-        nuclei_metadata["slide_image_name"] = np.array(slide_image_names)
-        nuclei_metadata["aspect_ratio_cluster_ratio"] = np.repeat(
-            np.nan, len(nuclei_metadata)
+        self.processed_image_metadata = pd.concat(stream.image_metadata)
+        self.save_table(
+            self.processed_image_metadata, self.processed_image_metadata_file
         )
 
-        nuclei_metadata["centroid_0"] = nuclei_centroids_0
-        nuclei_metadata["centroid_1"] = nuclei_centroids_1
+    def save_nmco_features(self, stream: NuclearCropResultStream, profile_file: str):
+        # Invariant features and features with missing values are removed
+        selected_cols = [
+            col
+            for col in stream.nmco_cols
+            if col not in stream.nmco_na_cols and col in stream.nmco_varying_cols
+        ]
+        nmco_feature_writer = TableWriter(
+            profile_file,
+            data_columns=["gene_symbol", "plate"],
+            dtypes=stream.dtypes["nmco_features"],
+        )
+        for nmco_features in stream.nmco_features:
+            nmco_feature_writer.append(nmco_features.loc[:, selected_cols])
+
+    def assemble_nuclear_crop_results(
+        self, idc: np.ndarray, res: List, nuclei_count_col_name: str
+    ) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+        nuclei_crops = []
+        nmco_features = []
+        nuclei_counts = []
+        for item in res:
+            nuclei_crops.append(item[0])
+            nuclei_counts.append(len(item[0]))
+            if item[1] is not None:
+                nmco_features.append(item[1])
+        nuclei_crops = pd.concat(nuclei_crops, ignore_index=True)
+        nuclei_counts = np.array(nuclei_counts)
+
+        # Image-level metadata of every nucleus with the image file replaced by the one of the nuclear crop
+        nuclei_metadata = self.metadata.iloc[np.repeat(idc, nuclei_counts)]
+        nuclei_metadata = nuclei_metadata.loc[:, self.selected_cols]
+        nuclei_metadata.columns = self.new_selected_cols
+        nuclei_metadata = nuclei_metadata.reset_index(drop=True)
+        nuclei_metadata["image_file"] = np.array(nuclei_crops["image_file"])
+        for col in nuclei_crops.columns.drop("image_file"):
+            nuclei_metadata[col] = np.array(nuclei_crops[col])
+        nuclei_metadata["nuclei_count_image"] = np.repeat(nuclei_counts, nuclei_counts)
+
+        image_metadata = self.metadata.iloc[idc]
+        image_metadata = image_metadata.loc[
+            :, self.selected_cols + [nuclei_count_col_name]
+        ]
+        image_metadata.columns = self.new_selected_cols + ["nuclei_count"]
+        image_metadata.loc[:, "nuclei_count"] = nuclei_counts
 
-        if extract_ncmo_features:
-            # all_nmco_features = pd.concat(all_nmco_features)
-            all_nmco_features["image_file"] = np.array(
-                nuclei_metadata.loc[:, "image_file"]
+        if len(nmco_features) > 0:
+            nmco_features = pd.concat(nmco_features)
+            nmco_features["image_file"] = np.array(nuclei_metadata["image_file"])
+            nmco_features["gene_symbol"] = np.array(nuclei_metadata["gene_symbol"])
+            nmco_features["slide_image_name"] = np.array(
+                nuclei_metadata["slide_image_name"]
             )
-            all_nmco_features["gene_symbol"] = np.array(
-                nuclei_metadata.loc[:, "gene_symbol"]
+        else:
+            nmco_features = None
+        return nuclei_metadata, image_metadata, nmco_features
+
+    def get_nuclear_crop_shard_writers(self, shard_dir: str, shard_name: str) -> dict:
+        # The manifest of a previous version of the shard is removed first as its files are overwritten
+        manifest_file = os.path.join(shard_dir, "{}_manifest.json".format(shard_name))
+        if os.path.exists(manifest_file):
+            os.remove(manifest_file)
+        return {
+            name: TableWriter(
+                os.path.join(shard_dir, "{}_{}.csv.gz".format(shard_name, name))
             )
-            all_nmco_features["slide_image_name"] = np.array(slide_image_names)
-            all_nmco_features = all_nmco_features.drop(columns="label")
+            for name in ["nuclei_metadata", "image_metadata", "nmco_features"]
+        }
 
-            # Remove invariant and na features
-            all_nmco_features = all_nmco_features.dropna(axis=1)
-            all_nmco_features = all_nmco_features.loc[
-                :, (all_nmco_features != all_nmco_features.iloc[0]).any()
-            ]
-
-        slide_image_names = list(np.unique(slide_image_names))
-        for slide_image_name in tqdm(
-            slide_image_names, desc="Add aspect ratio cluster information"
-        ):
-            nuclei_metadata.loc[
-                nuclei_metadata["slide_image_name"] == slide_image_name,
-                "aspect_ratio_cluster_ratio",
-            ] = np.mean(
-                np.array(
-                    nuclei_metadata.loc[
-                        nuclei_metadata["slide_image_name"] == slide_image_name,
-                        "aspect_ratio_cluster",
-                    ]
+    def save_nuclear_crop_shard(
+        self,
+        shard_dir: str,
+        shard_name: str,
+        shard_key: str,
+        shard_writers: dict,
+        params_key: str = None,
+        images: dict = None,
+    ):
+        shard_files = {
+            name: os.path.split(writer.file_path)[1] if writer.n_appends > 0 else None
+            for name, writer in shard_writers.items()
+        }
+
+        # The manifest is written last such that its existence marks a complete shard
+        manifest = {
+            "shard": shard_name,
+            "key": shard_key,
+            "n_images": shard_writers["image_metadata"].n_rows,
+            "n_nuclei": shard_writers["nuclei_metadata"].n_rows,
+            "files": shard_files,
+            "params_key": params_key,
+            "images": images,
+        }
+        manifest_file = os.path.join(shard_dir, "{}_manifest.json".format(shard_name))
+        with open(manifest_file + ".tmp", "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(manifest_file + ".tmp", manifest_file)
+
+    def load_nuclear_crop_shard(
+        self, shard_dir: str, shard_name: str, shard_key: str
+    ) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+        manifest_file = os.path.join(shard_dir, "{}_manifest.json".format(shard_name))
+        if not os.path.exists(manifest_file):
+            return None
+        with open(manifest_file, "r") as f:
+            manifest = json.load(f)
+        if manifest["key"] != shard_key:
+            logging.debug(
+                "Inputs or parameters of shard {} changed, recompute shard.".format(
+                    shard_name
                 )
             )
+            return None
 
-        max_width, max_height = nuclei_widths.max(), nuclei_heights.max()
-
-        image_metadata = image_metadata.loc[:, selected_cols + [nuclei_count_col_name]]
-        image_metadata.columns = new_selected_cols + [
-            "nuclei_count",
-        ]
-
-        image_metadata.loc[:, "nuclei_count"] = nuclei_counts
-        logging.debug("Nuclei segmentation complete.")
-        logging.debug(
-            "Maximum image dimensions: ({}, {})".format(max_width, max_height)
-        )
-        self.pad_size = max_width + 1, max_height + 1
-        self.nuclei_dir = output_dir
-        self.nuclei_metadata = nuclei_metadata
-        self.processed_image_metadata = image_metadata
-        self.nuclei_metadata_file = os.path.join(
-            self.output_dir, "processed_nuclei_metadata.csv.gz"
+        shard_files = manifest["files"]
+        nuclei_metadata = pd.read_csv(
+            os.path.join(shard_dir, shard_files["nuclei_metadata"]), index_col=0
         )
-        self.processed_image_metadata_file = os.path.join(
-            self.output_dir, "processed_image_metadata.csv.gz"
+        image_metadata = pd.read_csv(
+            os.path.join(shard_dir, shard_files["image_metadata"]), index_col=0
         )
-        if extract_ncmo_features:
-            all_nmco_features.to_csv(
-                os.path.join(self.output_dir, "nuclei_ncmo_features.csv.gz")
+        if shard_files["nmco_features"] is not None:
+            nmco_features = pd.read_csv(
+                os.path.join(shard_dir, shard_files["nmco_features"]), index_col=0
             )
+        else:
+            nmco_features = None
+        return nuclei_metadata, image_metadata, nmco_features
 
-        self.nuclei_metadata.to_csv(self.nuclei_metadata_file)
-        self.processed_image_metadata.to_csv(self.processed_image_metadata_file)
+    def load_cached_nuclear_crop_results(
+        self,
+        shard_dir: str,
+        shard_name: str,
+        params_key: str,
+        crop_store_dir: str = None,
+    ) -> dict:
+        # Splits the results of a previously processed shard into the results of the individual images which are
+        # returned together with the fingerprints of the images. The crops are only returned (as in-memory copies)
+        # for packed crop stores as the part of the shard is overwritten once the shard is processed again.
+        manifest_file = os.path.join(shard_dir, "{}_manifest.json".format(shard_name))
+        if not os.path.exists(manifest_file):
+            return {}
+        with open(manifest_file, "r") as f:
+            manifest = json.load(f)
+        if manifest.get("params_key") != params_key or manifest.get("images") is None:
+            return {}
+        nuclei_metadata, image_metadata, nmco_features = self.load_nuclear_crop_shard(
+            shard_dir, shard_name, manifest["key"]
+        )
+        if crop_store_dir is not None:
+            crop_store = PackedCropStore(crop_store_dir, part_names=[shard_name])
+
+        crop_cols = [
+            "image_file",
+            "slide_image_name",
+            "bb_width",
+            "bb_height",
+            "minor_axis_length",
+            "major_axis_length",
+            "centroid_0",
+            "centroid_1",
+        ]
+        ends = np.cumsum(np.array(image_metadata.loc[:, "nuclei_count"]))
+        starts = ends - np.array(image_metadata.loc[:, "nuclei_count"])
+        cached_res = {}
+        for k, (path, plate, fingerprint) in enumerate(
+            zip(
+                manifest["images"]["paths"],
+                manifest["images"]["plates"],
+                manifest["images"]["fingerprints"],
+            )
+        ):
+            nuclei_crops = nuclei_metadata.iloc[starts[k] : ends[k]]
+            nuclei_crops = nuclei_crops.loc[:, crop_cols].reset_index(drop=True)
+            if nmco_features is not None:
+                image_nmco_features = nmco_features.iloc[starts[k] : ends[k]].drop(
+                    columns=["image_file", "gene_symbol", "slide_image_name"]
+                )
+            else:
+                image_nmco_features = None
+            if crop_store_dir is not None:
+                crops = []
+                for crop_file_name in nuclei_crops.loc[:, "image_file"]:
+                    key = plate + "/" + crop_file_name
+                    crops.append(np.array(crop_store[key]) if key in crop_store else None)
+            else:
+                crops = None
+            cached_res[path] = (fingerprint, nuclei_crops, image_nmco_features, crops)
+        return cached_res
 
     def save_padded_images(
         self,
@@ -478,449 +1473,566 @@ class ImageDatasetPreprocessor:
         target_size: Tuple[int] = None,
         input_dir: str = None,
         image_file_col: str = "image_file",
+        crop_format: str = None,
+        n_jobs: int = 5,
+        batch_size: int = 4096,
     ):
-
-        if nuclei_metadata_file is None and self.nuclei_metadata_file is not None:
+        if nuclei_metadata_file is None:
+            if self.nuclei_metadata_file is None:
+                raise RuntimeError("No nuclei metadata file given.")
             nuclei_metadata_file = self.nuclei_metadata_file
-        else:
-            raise RuntimeError("No nuclei metadata file given.")
 
-        nuclei_metadata = pd.read_csv(nuclei_metadata_file, index_col=0)
+        nuclei_metadata = read_table(nuclei_metadata_file)
         if input_dir is None:
             input_dir = self.nuclei_dir
         if target_size is None:
             target_size = self.pad_size
-        file_list = get_file_list(input_dir)
-        output_dir = os.path.join(self.output_dir, "padded_nuclei")
-        n_skipped = 0
+        # The padded crops are saved in the format of the input crops unless specified otherwise
+        crop_store_dir, crop_locs, crop_fingerprints = self.get_crop_locs(input_dir)
+        if crop_format is None:
+            crop_format = "tiff" if crop_store_dir is None else "packed"
+        output_dir = self.get_stage_output_dir("padded_nuclei")
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
-        for i in tqdm(range(len(file_list)), desc="Save padded images"):
-            file = file_list[i]
-            image = imread(file)
-            dir_name, file_name = os.path.split(file)
-
-            width, height = image.shape
-            if width > target_size[0] or height > target_size[1]:
-                n_skipped += 1
-                nuclei_metadata = nuclei_metadata.loc[
-                    nuclei_metadata[image_file_col] != file_name, :
+        crop_writer = PackedCropWriter(output_dir) if crop_format == "packed" else None
+
+        skipped_file_names = set()
+        # Individual TIFF crops that did not change since they were last padded are not padded again
+        todo_crop_locs = crop_locs
+        stage_cache = None
+        if self.cache_dir is not None and crop_store_dir is None and crop_format == "tiff":
+            stage_cache = StageCache(
+                self.cache_dir,
+                "padding",
+                {"input_dir": input_dir, "target_size": [int(size) for size in target_size]},
+                content_hash=self.content_hash,
+            )
+            todo_crop_locs = []
+            for crop_loc in set(stage_cache.items) - set(crop_locs):
+                # Padded images of crops that no longer exist are removed
+                dir_name, file_name = os.path.split(crop_loc)
+                output_file = os.path.join(
+                    output_dir, os.path.split(dir_name)[1], file_name
+                )
+                if os.path.exists(output_file):
+                    os.remove(output_file)
+                del stage_cache.items[crop_loc]
+            # The fingerprints of the file index are used unless the content of the crops is hashed
+            if crop_fingerprints is None or self.content_hash:
+                crop_fingerprints = [
+                    stage_cache.get_fingerprint([crop_loc]) for crop_loc in crop_locs
                 ]
-            else:
-                plate = os.path.split(dir_name)[1]
-                plate_output_dir = os.path.join(output_dir, plate)
-                if not os.path.exists(plate_output_dir):
-                    os.makedirs(plate_output_dir)
-                padded_image = pad_image(image, target_size)
-                padded_image = padded_image.astype(np.uint16)
-                padded_image = padded_image - padded_image.min()
-                padded_image = padded_image / padded_image.max()
-                padded_image = np.clip(padded_image, 0, 1)
-                padded_image = (padded_image * 255).astype(np.uint8)
-                tifffile.imsave(os.path.join(plate_output_dir, file_name), padded_image)
+            for crop_loc, fingerprint in zip(crop_locs, crop_fingerprints):
+                dir_name, file_name = os.path.split(crop_loc)
+                output_file = os.path.join(
+                    output_dir, os.path.split(dir_name)[1], file_name
+                )
+                if not stage_cache.is_current(crop_loc, fingerprint):
+                    todo_crop_locs.append(crop_loc)
+                elif stage_cache.get(crop_loc):
+                    skipped_file_names.add(file_name)
+                elif not os.path.exists(output_file):
+                    todo_crop_locs.append(crop_loc)
+            logging.debug(
+                "{} of {} padded images are up to date.".format(
+                    len(crop_locs) - len(todo_crop_locs), len(crop_locs)
+                )
+            )
+
+        start_time = time.time()
+        # Crops are processed in batches to bound the number of crops in flight
+        with Parallel(n_jobs=n_jobs) as parallel:
+            for start in tqdm(
+                range(0, len(todo_crop_locs), batch_size), desc="Save padded images"
+            ):
+                res = parallel(
+                    delayed(save_padded_crop)(
+                        crop_loc=crop_loc,
+                        output_dir=output_dir,
+                        target_size=target_size,
+                        crop_store_dir=crop_store_dir,
+                        crop_format=crop_format,
+                    )
+                    for crop_loc in todo_crop_locs[start : start + batch_size]
+                )
+                for crop_loc, (plate, file_name, skipped, padded_image) in zip(
+                    todo_crop_locs[start : start + batch_size], res
+                ):
+                    if skipped:
+                        skipped_file_names.add(file_name)
+                    elif crop_writer is not None:
+                        crop_writer.add(plate, file_name, padded_image)
+                    if stage_cache is not None:
+                        stage_cache.update(
+                            crop_loc, stage_cache.get_fingerprint([crop_loc]), skipped
+                        )
+        if crop_writer is not None:
+            crop_writer.close()
+        if stage_cache is not None:
+            stage_cache.save()
+        nuclei_metadata = nuclei_metadata.loc[
+            ~nuclei_metadata[image_file_col].isin(skipped_file_names), :
+        ]
+        self.log_throughput("Padding", len(todo_crop_locs), time.time() - start_time)
 
         logging.debug(
             "Padding complete: {} image were skipped as they exceeded the target"
-            " dimensions.".format(n_skipped)
+            " dimensions.".format(len(skipped_file_names))
         )
-        self.nuclei_metadata_file = os.path.join(
-            self.output_dir, "padded_nuclei_metadata.csv.gz"
-        )
-        nuclei_metadata.to_csv(self.nuclei_metadata_file)
+        self.nuclei_metadata_file = self.get_table_file("padded_nuclei_metadata")
+        self.save_table(nuclei_metadata, self.nuclei_metadata_file)
 
-    def resize_and_save_images(self, target_size: Tuple[int], input_dir: str = None):
+    def resize_and_save_images(
+        self,
+        target_size: Tuple[int],
+        input_dir: str = None,
+        crop_format: str = None,
+        n_jobs: int = 5,
+        batch_size: int = 4096,
+    ):
         if input_dir is None:
             input_dir = self.nuclei_dir
-        file_list = get_file_list(input_dir)
-        output_dir = os.path.join(self.output_dir, "resized_images")
+        crop_store_dir, crop_locs, _ = self.get_crop_locs(input_dir)
+        if crop_format is None:
+            crop_format = "tiff" if crop_store_dir is None else "packed"
+        output_dir = self.get_stage_output_dir("resized_images")
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
-        for i in tqdm(range(len(file_list)), desc="Save resized images"):
-            file = file_list[i]
-            image = imread(file)
-            dir_name, file_name = os.path.split(file)
-            plate = os.path.split(dir_name)[1]
-            plate_output_dir = os.path.join(output_dir, plate)
-            if not os.path.exists(plate_output_dir):
-                os.makedirs(plate_output_dir)
-            resized_image = cv2.resize(image, dsize=target_size)
-            tifffile.imsave(os.path.join(plate_output_dir, file_name), resized_image)
-
-
-class ImageJUMPDatasetPreprocessor:
+        crop_writer = PackedCropWriter(output_dir) if crop_format == "packed" else None
+
+        start_time = time.time()
+        with Parallel(n_jobs=n_jobs) as parallel:
+            for start in tqdm(
+                range(0, len(crop_locs), batch_size), desc="Save resized images"
+            ):
+                res = parallel(
+                    delayed(save_resized_crop)(
+                        crop_loc=crop_loc,
+                        output_dir=output_dir,
+                        target_size=target_size,
+                        crop_store_dir=crop_store_dir,
+                        crop_format=crop_format,
+                    )
+                    for crop_loc in crop_locs[start : start + batch_size]
+                )
+                if crop_writer is not None:
+                    for plate, file_name, resized_image in res:
+                        crop_writer.add(plate, file_name, resized_image)
+        if crop_writer is not None:
+            crop_writer.close()
+        self.log_throughput("Resizing", len(crop_locs), time.time() - start_time)
+
+    def save_slide_context_patches(
+        self,
+        nuclei_metadata_file: str = None,
+        slide_image_dir: str = None,
+        patch_size: int = 448,
+        target_size: int = 224,
+        image_file_col: str = "image_file",
+        slide_image_name_col: str = "slide_image_name",
+        n_jobs: int = 5,
+        batch_size: int = 64,
+    ):
+        # The context patches of the slide images centered on the nuclei are saved to a packed crop store keyed as
+        # the nuclear crops such that the multi-image data set can read them instead of cropping the slide images.
+        if nuclei_metadata_file is None:
+            if self.nuclei_metadata_file is None:
+                raise RuntimeError("No nuclei metadata file given.")
+            nuclei_metadata_file = self.nuclei_metadata_file
+        if slide_image_dir is None:
+            slide_image_dir = self.image_input_dir
+        nuclei_metadata = read_table(
+            nuclei_metadata_file,
+            columns=[
+                "plate",
+                image_file_col,
+                slide_image_name_col,
+                "centroid_0",
+                "centroid_1",
+            ],
+        )
+        output_dir = self.get_stage_output_dir("slide_context_patches")
+        crop_writer = PackedCropWriter(output_dir)
+
+        slides = list(
+            nuclei_metadata.groupby(["plate", slide_image_name_col], sort=True).indices.items()
+        )
+        start_time = time.time()
+        with Parallel(n_jobs=n_jobs) as parallel:
+            for start in tqdm(
+                range(0, len(slides), batch_size), desc="Save slide context patches"
+            ):
+                res = parallel(
+                    delayed(get_slide_context_patches)(
+                        slide_image_file=os.path.join(
+                            slide_image_dir, str(plate), slide_image_name
+                        ),
+                        centroids=np.array(
+                            nuclei_metadata.iloc[idc].loc[:, ["centroid_0", "centroid_1"]]
+                        ),
+                        patch_size=patch_size,
+                        target_size=target_size,
+                    )
+                    for (plate, slide_image_name), idc in slides[
+                        start : start + batch_size
+                    ]
+                )
+                for ((plate, _), idc), patches in zip(
+                    slides[start : start + batch_size], res
+                ):
+                    for image_file, patch in zip(
+                        nuclei_metadata.iloc[idc].loc[:, image_file_col], patches
+                    ):
+                        crop_writer.add(str(plate), image_file, patch)
+        crop_writer.close()
+        self.log_throughput(
+            "Slide context patch extraction", len(slides), time.time() - start_time
+        )
+        self.item_counts["nuclei"] = len(nuclei_metadata)
+
+    def get_crop_locs(self, input_dir: str) -> Tuple[str, List[str], List[str]]:
+        # Returns the crop store or the crop files of the input directory together with the fingerprints of the files
+        # (see get_file_fingerprint) if known. If a cache directory is given, the file index of the input directory
+        # is kept there such that unchanged subdirectories are not listed again, while every file is still stat-ed.
+        if PackedCropStore.is_store(input_dir):
+            return input_dir, list(PackedCropStore(input_dir).keys), None
+        elif self.cache_dir is None:
+            return None, get_file_list(input_dir), None
+        else:
+            manifest_file = os.path.join(
+                self.cache_dir,
+                "{}_file_index.json".format(os.path.basename(os.path.normpath(input_dir))),
+            )
+            file_index = index_files(input_dir, manifest_file=manifest_file)
+            fingerprints = [
+                "{}:{}".format(size, mtime_ns)
+                for size, mtime_ns in zip(file_index["size"], file_index["mtime_ns"])
+            ]
+            return None, list(file_index["path"]), fingerprints
+
+    def log_throughput(self, stage: str, n_images: int, run_time: float):
+        self.item_counts["images"] = n_images
+        logging.debug(
+            "{} of {} images took {:.1f}s ({:.1f} images/s).".format(
+                stage, n_images, run_time, n_images / max(run_time, 1e-9)
+            )
+        )
+
+
+class ImageDatasetPreprocessor(BaseImageDatasetPreprocessor):
+    selected_cols = [
+        "Image_Metadata_Plate",
+        "Image_Metadata_Well",
+        "Image_FileName_IllumHoechst",
+        "Image_Metadata_GeneID",
+        "Image_Metadata_GeneSymbol",
+        "Image_Metadata_IsLandmark",
+        "Image_Metadata_AlleleDesc",
+        "Image_Metadata_ExpressionVector",
+        "Image_Metadata_FlaggedForToxicity",
+        "Image_Metadata_IE_Blast_noBlast",
+        "Image_Metadata_IntendedOrfMismatch",
+        "Image_Metadata_OpenOrClosed",
+        "Image_Metadata_RNAiVirusPlateName",
+        "Image_Metadata_Site",
+        "Image_Metadata_Type",
+        "Image_Metadata_Virus_Vol_ul",
+        "Image_Metadata_TimePoint_Hours",
+        "Image_Metadata_ASSAY_WELL_ROLE",
+    ]
+    new_selected_cols = [
+        "plate",
+        "well",
+        "image_file",
+        "gene_id",
+        "gene_symbol",
+        "is_landmark",
+        "allele",
+        "expr_vec",
+        "toxicity",
+        "ie_blast",
+        "intended_orf_mismatch",
+        "open_closed",
+        "rnai_plate",
+        "site",
+        "type",
+        "virus_vol",
+        "timepoint",
+        "assay_well_role",
+    ]
+
     def __init__(
         self,
         image_input_dir: str,
-        illum_image_dir: str,
         metadata_file: str,
         output_dir: str,
-        illum_image_col_name: str = "IllumImageLoc",
+        raw_image_col_name: str = "Image_FileName_OrigHoechst",
+        illum_image_col_name: str = "Image_FileName_IllumHoechst",
         plate_col_name: str = "Image_Metadata_Plate",
         well_col_name: str = "Image_Metadata_Well",
+        cache_dir: str = None,
+        content_hash: bool = False,
+        table_format: str = "csv",
     ):
-        print(metadata_file)
-        self.image_input_dir = image_input_dir
-        self.illum_image_dir = illum_image_dir
-        self.output_dir = output_dir
-
-        self.illum_image_col_name = illum_image_col_name
-        self.plate_col_name = plate_col_name
-        self.well_col_name = well_col_name
-
-        self.metadata = pd.read_csv(metadata_file)
-        self.processed_image_metadata = None
-        self.nuclei_metadata = None
-
-        self.nuclei_metadata_file = None
-        self.processed_image_metadata_file = None
+        super().__init__(
+            image_input_dir=image_input_dir,
+            metadata_file=metadata_file,
+            output_dir=output_dir,
+            illum_image_col_name=illum_image_col_name,
+            plate_col_name=plate_col_name,
+            well_col_name=well_col_name,
+            cache_dir=cache_dir,
+            content_hash=content_hash,
+            table_format=table_format,
+        )
+        self.raw_image_col_name = raw_image_col_name
 
-        self.nuclei_dir = None
-        self.pad_size = None
+    def add_image_illumination_col(self, posfix: str = "_illum_corrected"):
+        orig_image_file_names = list(self.metadata[self.raw_image_col_name])
+        illum_corrected_image_file_names = []
+        for orig_image_file_name in orig_image_file_names:
+            idx = orig_image_file_name.index(".")
+            illum_corrected_image_file_name = (
+                orig_image_file_name[:idx] + posfix + orig_image_file_name[idx:]
+            )
+            illum_corrected_image_file_names.append(illum_corrected_image_file_name)
+        self.metadata[self.illum_image_col_name] = illum_corrected_image_file_names
 
-    def get_nuclear_crops(
+    def filter_out_qc_flagged_images(
         self,
-        label_image_input_dir: str = None,
-        output_dir: str = None,
-        nuclei_count_col_name: str = "Image_Count_Nuclei",
-        min_area: int = None,
-        max_area: int = None,
-        max_bbarea: int = None,
-        max_eccentricity: float = None,
-        min_solidity: float = None,
-        min_aspect_ratio: float = None,
-        convex_crop: bool = False,
-        extract_ncmo_features: bool = True,
-        n_jobs: int = 5,
+        blurry_col="Image_Metadata_QCFlag_isBlurry",
+        saturated_col="Image_Metadata_QCFlag_isSaturated",
     ):
-        nuclei_counts = []
-        nuclei_counts_rep = []
-        slide_image_names = []
-        image_metadata = self.metadata.copy()
-        all_nmco_features = []
-
-        nuclei_widths = []
-        nuclei_heights = []
-        nuclei_minor_axis_lengths = []
-        nuclei_major_axis_lengths = []
-        nuclei_centroids_0 = []
-        nuclei_centroids_1 = []
-
-        metadata_cols = list(self.metadata.columns)
-
-        if nuclei_count_col_name not in metadata_cols:
-            image_metadata.loc[:, nuclei_count_col_name] = -1
-            self.metadata.loc[:, nuclei_count_col_name] = -1
-            metadata_cols.append(nuclei_count_col_name)
+        self.metadata = self.metadata.loc[
+            (self.metadata[blurry_col] == 0) & (self.metadata[saturated_col] == 0)
+        ]
 
-        if output_dir is None:
-            output_dir = os.path.join(self.output_dir, "nuclei_images")
+    def remove_outlier_images(
+        self,
+        outlier_plates: List = None,
+        outlier_plate_wells: List = None,
+        outlier_wells: List = None,
+    ):
+        if outlier_plates is not None:
+            for outlier_plate in outlier_plates:
+                self.metadata = self.metadata.loc[
+                    self.metadata[self.plate_col_name] != outlier_plate
+                ]
+        if outlier_plate_wells is not None:
+            for outlier_plate_well in outlier_plate_wells:
+                self.metadata = self.metadata.loc[
+                    (self.metadata[self.plate_col_name] != outlier_plate_well[0])
+                    | (self.metadata[self.well_col_name] != outlier_plate_well[1])
+                ]
+        if outlier_wells is not None:
+            for outlier_well in outlier_wells:
+                self.metadata = self.metadata.loc[
+                    self.metadata[self.well_col_name] != outlier_well
+                ]
+        self.metadata.to_csv(
+            os.path.join(self.output_dir, "filtered_image_metadata.csv")
+        )
 
+    def save_filtered_images(self, link_mode: str = "copy", n_jobs: int = 5):
+        output_dir = self.get_stage_output_dir("filtered")
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
 
-        def get_image_crops_for_single_image(
-            i, extract_ncmo_features: bool = True, center_crop_slide_dir: bool = False
-        ):
-            slide_image_names = []
-            widths = []
-            heights = []
-            minor_axis_lengths = []
-            major_axis_lengths = []
-            centroids_0 = []
-            centroids_1 = []
-            nuclei_metadata = []
-            nuclei_count = 0
-            plate = str(self.metadata.iloc[i, :][self.plate_col_name])
-
-            image_file_path = self.metadata.iloc[i, :][self.illum_image_col_name]
-            image_file_name = os.path.split(image_file_path)[1]
-            image_file_path = os.path.join(self.illum_image_dir, image_file_path)
-            label_image_file_name = "/".join(image_file_path.split("/")[-2:])
-            label_image_file_path = os.path.join(
-                label_image_input_dir, label_image_file_name
-            )
-
-            image = imread(image_file_path)
-            label_image = imread(label_image_file_path)
-
-            image_metadata.iloc[i, metadata_cols.index(nuclei_count_col_name)] = len(
-                np.unique(label_image)
-            )
-
-            regions = regionprops(label_image=label_image, intensity_image=image)
-            if extract_ncmo_features and len(regions) > 0:
-                nmco_features = compute_nuclear_chromatin_features(
-                    label_image=label_image, intensity_image=image
-                )
-            else:
-                nmco_features = None
-
-            for region in regions:
-                width, height = region.image.shape
-
-                fname_start = image_file_name[: image_file_name.index(".")]
-                fname_ending = image_file_name[image_file_name.index(".") :]
-                plate_output_dir = os.path.join(output_dir, plate)
-
-                if not os.path.exists(plate_output_dir):
-                    os.makedirs(plate_output_dir)
-
-                if (
-                    (min_area is None or region.area >= min_area)
-                    and (max_area is None or region.area <= max_area)
-                    and (
-                        max_eccentricity is None
-                        or region.eccentricity <= max_eccentricity
-                    )
-                    and (max_bbarea is None or width * height <= max_bbarea)
-                    and (min_solidity is None or region.solidity >= min_solidity)
-                    and (
-                        min_aspect_ratio is None
-                        or (region.minor_axis_length / region.major_axis_length)
-                        >= min_aspect_ratio
-                    )
-                ):
-                    widths.append(width)
-                    heights.append(height)
-
-                    minor_axis_lengths.append(region.minor_axis_length)
-                    major_axis_lengths.append(region.major_axis_length)
-
-                    centroids_0.append(region.centroid[0])
-                    centroids_1.append(region.centroid[1])
-
-                    output_file_name = os.path.join(
-                        plate_output_dir,
-                        fname_start + "_{}".format(region.label) + fname_ending,
-                    )
-
-                    # returns convex crop of the segmented object.
-                    if convex_crop:
-                        xmin, ymin, xmax, ymax = region.bbox
-                        cropped = image[xmin:xmax, ymin:ymax] * region.convex_image
-                    else:
-                        cropped = region.intensity_image
-                        # cropped = image
-
-                    tifffile.imsave(output_file_name, cropped)
-                    nucleus_metadata = list(self.metadata.iloc[i, :])
-                    nucleus_metadata[
-                        metadata_cols.index(self.illum_image_col_name)
-                    ] = os.path.split(output_file_name)[1]
-                    slide_image_names.append(fname_start + fname_ending)
-                    nuclei_metadata.append(nucleus_metadata)
-
-                    nuclei_count += 1
-                else:
-                    if extract_ncmo_features and len(regions) > 0:
-                        nmco_features = nmco_features.loc[
-                            nmco_features["label"] != region.label
-                        ]
-                    else:
-                        nmco_features = None
-            return (
-                nuclei_metadata,
-                slide_image_names,
-                nuclei_count,
-                widths,
-                heights,
-                minor_axis_lengths,
-                major_axis_lengths,
-                centroids_0,
-                centroids_1,
-                nmco_features,
-            )
-
-        res = Parallel(n_jobs=n_jobs)(
-            delayed(get_image_crops_for_single_image)(i, extract_ncmo_features)
-            for i in tqdm(range(len(self.metadata)))
-            # for i in tqdm(range(3))
-        )
-        nuclei_metadata = []
-        for item in res:
-            nuclei_metadata.extend(item[0])
-            slide_image_names.extend(item[1])
-            nuclei_counts.append(item[2])
-            nuclei_counts_rep.extend([item[2]] * item[2])
-            nuclei_widths.extend(item[3])
-            nuclei_heights.extend(item[4])
-            nuclei_minor_axis_lengths.extend(item[5])
-            nuclei_major_axis_lengths.extend(item[6])
-            nuclei_centroids_0.extend(item[7])
-            nuclei_centroids_1.extend(item[8])
-            if item[9] is not None:
-                all_nmco_features.append(item[9])
-        if extract_ncmo_features:
-            all_nmco_features = pd.concat(all_nmco_features)
-
-        nuclei_metadata = pd.DataFrame(np.array(nuclei_metadata), columns=metadata_cols)
-        selected_cols = [
-            "Metadata_Source",
-            "Metadata_Batch",
-            "Metadata_Plate",
-            "Metadata_Well",
-            "Metadata_Site",
-            "IllumImageLoc",
-            "Metadata_Symbol",
-        ]
-        new_selected_cols = [
-            "source",
-            "batch",
-            "plate",
-            "well",
-            "site",
-            "image_file",
-            "gene_symbol",
-        ]
-
-        nuclei_widths = np.array(nuclei_widths)
-        nuclei_heights = np.array(nuclei_heights)
-
-        nuclei_minor_axis_lengths = np.array(nuclei_minor_axis_lengths)
-        nuclei_major_axis_lengths = np.array(nuclei_major_axis_lengths)
-
-        nuclei_centroids_0 = np.array(nuclei_centroids_0)
-        nuclei_centroids_1 = np.array(nuclei_centroids_1)
-
-        nuclei_metadata = nuclei_metadata.loc[:, selected_cols]
-        nuclei_metadata.columns = new_selected_cols
-        nuclei_metadata["bb_width"] = nuclei_widths
-        nuclei_metadata["bb_height"] = nuclei_heights
-
-        nuclei_metadata["minor_axis_length"] = nuclei_minor_axis_lengths
-        nuclei_metadata["major_axis_length"] = nuclei_major_axis_lengths
-        nuclei_metadata["aspect_ratio"] = (
-            nuclei_minor_axis_lengths / nuclei_major_axis_lengths
+        plates = np.array(self.metadata.loc[:, self.plate_col_name], dtype=str)
+        filenames = list(self.metadata.loc[:, self.illum_image_col_name])
+        for plate in np.unique(plates):
+            os.makedirs(os.path.join(output_dir, plate), exist_ok=True)
+
+        # Staging is I/O-bound, hence threads are sufficient
+        res = Parallel(n_jobs=n_jobs, prefer="threads")(
+            delayed(stage_file)(
+                input_file=os.path.join(self.image_input_dir, plate, filename),
+                output_file=os.path.join(output_dir, plate, filename),
+                link_mode=link_mode,
+            )
+            for plate, filename in tqdm(
+                zip(plates, filenames), total=len(plates), desc="Staging filtered images"
+            )
         )
-        gmm_ar = GaussianMixture(n_components=2, random_state=1234)
-        nuclei_metadata["aspect_ratio_cluster"] = gmm_ar.fit_predict(
-            np.array(nuclei_metadata["aspect_ratio"]).reshape(-1, 1)
+        actions = pd.Series([action for action, _ in res], dtype=str)
+        n_bytes = np.array([n_bytes for _, n_bytes in res], dtype=np.int64)
+        n_bytes_avoided = n_bytes[np.array(actions != "copied")].sum()
+        self.item_counts["images"] = len(res)
+        logging.debug(
+            "Images (n={}) staged to {} ({}): {}. {:.2f} GB of {:.2f} GB were not copied.".format(
+                len(self.metadata),
+                output_dir,
+                link_mode,
+                dict(actions.value_counts()),
+                n_bytes_avoided / 1e9,
+                n_bytes.sum() / 1e9,
+            )
         )
 
-        nuclei_metadata["nuclei_count_image"] = np.array(nuclei_counts_rep)
-        nuclei_metadata["slide_image_name"] = np.array(slide_image_names)
-        nuclei_metadata["aspect_ratio_cluster_ratio"] = np.repeat(
-            np.nan, len(nuclei_metadata)
-        )
+    def segment_all_images_given_outlines(
+        self,
+        outline_input_dir,
+        nuclei_outline_col_name: str = "Image_FileName_NucleiOutlines",
+        min_area: int = None,
+        fill_holes: int = 16,
+        n_jobs: int = 5,
+        save_label_images: bool = True,
+    ):
+        # If the label images are not saved, the segmentation is performed on the fly by the workers of a subsequent
+        # get_nuclear_crops step that is not given a label image directory.
+        if not save_label_images:
+            self.outline_segmentation = {
+                "outline_input_dir": outline_input_dir,
+                "nuclei_outline_col_name": nuclei_outline_col_name,
+                "min_area": min_area,
+                "fill_holes": fill_holes,
+            }
+            self.label_image_dir = None
+            logging.debug(
+                "Label images will be computed from the outlines during the nuclear"
+                " crop extraction."
+            )
+            return
 
-        nuclei_metadata["centroid_0"] = nuclei_centroids_0
-        nuclei_metadata["centroid_1"] = nuclei_centroids_1
+        output_dir = self.get_stage_output_dir("label_images")
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
 
-        if extract_ncmo_features:
-            # all_nmco_features = pd.concat(all_nmco_features)
-            all_nmco_features["image_file"] = np.array(
-                nuclei_metadata.loc[:, "image_file"]
-            )
-            all_nmco_features["gene_symbol"] = np.array(
-                nuclei_metadata.loc[:, "gene_symbol"]
+        plates, image_file_paths, outline_file_paths = self.get_image_locs(
+            outline_input_dir, label_image_col_name=nuclei_outline_col_name
+        )
+        label_image_file_paths = [
+            os.path.join(output_dir, plate, os.path.split(image_file_path)[1])
+            for plate, image_file_path in zip(plates, image_file_paths)
+        ]
+        # Label images whose outline image did not change since they were last computed are not computed again
+        if self.cache_dir is not None:
+            stage_cache = StageCache(
+                self.cache_dir,
+                "segmentation",
+                {"min_area": min_area, "fill_holes": fill_holes},
+                content_hash=self.content_hash,
             )
-            all_nmco_features["slide_image_name"] = np.array(slide_image_names)
-            all_nmco_features = all_nmco_features.drop(columns="label")
-
-            # Remove invariant and na features
-            all_nmco_features = all_nmco_features.dropna(axis=1)
-            all_nmco_features = all_nmco_features.loc[
-                :, (all_nmco_features != all_nmco_features.iloc[0]).any()
+            fingerprints = [
+                stage_cache.get_fingerprint([outline_file_path])
+                for outline_file_path in outline_file_paths
             ]
-
-        slide_image_names = list(np.unique(slide_image_names))
-        for slide_image_name in tqdm(
-            slide_image_names, desc="Add aspect ratio cluster information"
-        ):
-            nuclei_metadata.loc[
-                nuclei_metadata["slide_image_name"] == slide_image_name,
-                "aspect_ratio_cluster_ratio",
-            ] = np.mean(
-                np.array(
-                    nuclei_metadata.loc[
-                        nuclei_metadata["slide_image_name"] == slide_image_name,
-                        "aspect_ratio_cluster",
-                    ]
+            outdated = [
+                not stage_cache.is_current(label_image_file_path, fingerprint)
+                or not os.path.exists(label_image_file_path)
+                for label_image_file_path, fingerprint in zip(
+                    label_image_file_paths, fingerprints
+                )
+            ]
+            logging.debug(
+                "{} of {} label images are up to date.".format(
+                    len(outdated) - sum(outdated), len(outdated)
                 )
             )
-
-        max_width, max_height = nuclei_widths.max(), nuclei_heights.max()
-
-        image_metadata = image_metadata.loc[:, selected_cols + [nuclei_count_col_name]]
-        image_metadata.columns = new_selected_cols + [
-            "nuclei_count",
-        ]
-
-        image_metadata.loc[:, "nuclei_count"] = nuclei_counts
-        logging.debug("Nuclei segmentation complete.")
-        logging.debug(
-            "Maximum image dimensions: ({}, {})".format(max_width, max_height)
-        )
-        self.pad_size = max_width + 1, max_height + 1
-        self.nuclei_dir = output_dir
-        self.nuclei_metadata = nuclei_metadata
-        self.processed_image_metadata = image_metadata
-        self.nuclei_metadata_file = os.path.join(
-            self.output_dir, "processed_nuclei_metadata.csv.gz"
-        )
-        self.processed_image_metadata_file = os.path.join(
-            self.output_dir, "processed_image_metadata.csv.gz"
-        )
-        if extract_ncmo_features:
-            all_nmco_features.to_csv(
-                os.path.join(self.output_dir, "nuclei_ncmo_features.csv.gz")
+            outline_file_paths = list(np.array(outline_file_paths)[outdated])
+            label_image_file_paths = list(np.array(label_image_file_paths)[outdated])
+            fingerprints = list(np.array(fingerprints)[outdated])
+        Parallel(n_jobs=n_jobs)(
+            delayed(save_label_image_from_outline)(
+                outline_file_path=outline_file_path,
+                label_image_file_path=label_image_file_path,
+                min_area=min_area,
+                fill_holes=fill_holes,
             )
+            for outline_file_path, label_image_file_path in tqdm(
+                zip(outline_file_paths, label_image_file_paths),
+                total=len(outline_file_paths),
+                desc="Segment images using outlines",
+            )
+        )
+        if self.cache_dir is not None:
+            for label_image_file_path, fingerprint in zip(
+                label_image_file_paths, fingerprints
+            ):
+                stage_cache.update(label_image_file_path, fingerprint)
+            stage_cache.save()
+        self.item_counts["images"] = len(label_image_file_paths)
+        self.label_image_dir = output_dir
+        self.outline_segmentation = None
+
+    def get_image_locs(
+        self, label_image_input_dir: str, label_image_col_name: str = None
+    ) -> Tuple[List[str], List[str], List[str]]:
+        if label_image_col_name is None:
+            label_image_col_name = self.illum_image_col_name
+        plates = list(np.array(self.metadata.loc[:, self.plate_col_name], dtype=str))
+        image_file_names = list(self.metadata.loc[:, self.illum_image_col_name])
+        label_image_file_names = list(self.metadata.loc[:, label_image_col_name])
+        image_file_paths = [
+            os.path.join(self.image_input_dir, plate, image_file_name)
+            for plate, image_file_name in zip(plates, image_file_names)
+        ]
+        label_image_file_paths = [
+            os.path.join(label_image_input_dir, plate, label_image_file_name)
+            for plate, label_image_file_name in zip(plates, label_image_file_names)
+        ]
+        return plates, image_file_paths, label_image_file_paths
+
+
+class ImageJUMPDatasetPreprocessor(BaseImageDatasetPreprocessor):
+    selected_cols = [
+        "Metadata_Source",
+        "Metadata_Batch",
+        "Metadata_Plate",
+        "Metadata_Well",
+        "Metadata_Site",
+        "IllumImageLoc",
+        "Metadata_Symbol",
+    ]
+    new_selected_cols = [
+        "source",
+        "batch",
+        "plate",
+        "well",
+        "site",
+        "image_file",
+        "gene_symbol",
+    ]
 
-        self.nuclei_metadata.to_csv(self.nuclei_metadata_file)
-        self.processed_image_metadata.to_csv(self.processed_image_metadata_file)
-
-    def save_padded_images(
+    def __init__(
         self,
-        nuclei_metadata_file: str = None,
-        target_size: Tuple[int] = None,
-        input_dir: str = None,
-        image_file_col: str = "image_file",
+        image_input_dir: str,
+        illum_image_dir: str,
+        metadata_file: str,
+        output_dir: str,
+        illum_image_col_name: str = "IllumImageLoc",
+        plate_col_name: str = "Image_Metadata_Plate",
+        well_col_name: str = "Image_Metadata_Well",
+        cache_dir: str = None,
+        content_hash: bool = False,
+        table_format: str = "csv",
     ):
-
-        if nuclei_metadata_file is None and self.nuclei_metadata_file is not None:
-            nuclei_metadata_file = self.nuclei_metadata_file
-        else:
-            raise RuntimeError("No nuclei metadata file given.")
-
-        nuclei_metadata = pd.read_csv(nuclei_metadata_file, index_col=0)
-        if input_dir is None:
-            input_dir = self.nuclei_dir
-        if target_size is None:
-            target_size = self.pad_size
-        file_list = get_file_list(input_dir)
-        output_dir = os.path.join(self.output_dir, "padded_nuclei")
-        n_skipped = 0
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-        for i in tqdm(range(len(file_list)), desc="Save padded images"):
-            file = file_list[i]
-            image = imread(file)
-            dir_name, file_name = os.path.split(file)
-
-            width, height = image.shape
-            if width > target_size[0] or height > target_size[1]:
-                n_skipped += 1
-                nuclei_metadata = nuclei_metadata.loc[
-                    nuclei_metadata[image_file_col] != file_name, :
-                ]
-            else:
-                plate = os.path.split(dir_name)[1]
-                plate_output_dir = os.path.join(output_dir, plate)
-                if not os.path.exists(plate_output_dir):
-                    os.makedirs(plate_output_dir)
-                padded_image = pad_image(image, target_size)
-                padded_image = padded_image.astype(np.uint16)
-                padded_image = padded_image - padded_image.min()
-                padded_image = padded_image / padded_image.max()
-                padded_image = np.clip(padded_image, 0, 1)
-                padded_image = (padded_image * 255).astype(np.uint8)
-                tifffile.imsave(os.path.join(plate_output_dir, file_name), padded_image)
-
-        logging.debug(
-            "Padding complete: {} image were skipped as they exceeded the target"
-            " dimensions.".format(n_skipped)
-        )
-        self.nuclei_metadata_file = os.path.join(
-            self.output_dir, "padded_nuclei_metadata.csv.gz"
+        print(metadata_file)
+        super().__init__(
+            image_input_dir=image_input_dir,
+            metadata_file=metadata_file,
+            output_dir=output_dir,
+            illum_image_col_name=illum_image_col_name,
+            plate_col_name=plate_col_name,
+            well_col_name=well_col_name,
+            cache_dir=cache_dir,
+            content_hash=content_hash,
+            table_format=table_format,
         )
-        nuclei_metadata.to_csv(self.nuclei_metadata_file)
+        self.illum_image_dir = illum_image_dir
+
+    def get_image_locs(
+        self, label_image_input_dir: str, label_image_col_name: str = None
+    ) -> Tuple[List[str], List[str], List[str]]:
+        plates = list(np.array(self.metadata.loc[:, self.plate_col_name], dtype=str))
+        image_file_paths = [
+            os.path.join(self.illum_image_dir, image_file_path)
+            for image_file_path in self.metadata.loc[:, self.illum_image_col_name]
+        ]
+        label_image_file_paths = [
+            os.path.join(
+                label_image_input_dir, "/".join(image_file_path.split("/")[-2:])
+            )
+            for image_file_path in image_file_paths
+        ]
+        return plates, image_file_paths, label_image_file_paths
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+from torch.utils.data import Dataset
+from torchvision import transforms
+
+from src.data.datasets import TorchTransformableSubset, TorchTransformableSuperset
+
+
+class TransformableDataset(Dataset):
+    # Minimal dataset with the interface of the LabeledSlideDataset used by the transformable subsets and supersets
+    def __init__(self, n_samples: int = 10):
+        self.data = np.arange(n_samples)
+        self.label_weights = np.ones(2) / 2
+        self.target_list = ["EMPTY", "GENE1"]
+        self.transform_pipeline = None
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, idx):
+        return self.data[idx], self.transform_pipeline
+
+    def set_transform_pipeline(self, transform_pipeline: transforms.Compose):
+        self.transform_pipeline = transform_pipeline
+
+
+@pytest.mark.parametrize("subsets", [False, True])
+def test_superset_transform_pipeline(subsets):
+    pipeline = transforms.Compose([])
+    datasets = [TransformableDataset(), TransformableDataset(5)]
+    if subsets:
+        datasets = [
+            TorchTransformableSubset(dataset, np.arange(len(dataset) - 1))
+            for dataset in datasets
+        ]
+        for dataset in datasets:
+            dataset.set_transform_pipeline([pipeline])
+    else:
+        for dataset in datasets:
+            dataset.set_transform_pipeline(pipeline)
+    superset = TorchTransformableSuperset(datasets)
+    assert superset.target_list == ["EMPTY", "GENE1"]
+
+    # The superset has its own transform pipeline but shares the data of its datasets
+    superset_pipeline = transforms.Compose([])
+    superset.set_transform_pipeline([superset_pipeline])
+    assert len(superset) == sum([len(dataset) for dataset in datasets])
+    assert all(superset[idx][1] is superset_pipeline for idx in range(len(superset)))
+    assert all(dataset[0][1] is pipeline for dataset in datasets)
+    for dataset, superset_dataset in zip(datasets, superset.datasets):
+        if subsets:
+            dataset, superset_dataset = dataset.dataset, superset_dataset.dataset
+        assert superset_dataset.data is dataset.data
+
+
+def test_superset_subsets_transform_pipeline():
+    # The subsets of a superset, e.g. the training and validation split, have their own transform pipelines
+    superset = TorchTransformableSuperset(
+        [TransformableDataset(), TransformableDataset(5)]
+    )
+    train_subset = TorchTransformableSubset(superset, np.arange(0, 15, 2))
+    val_subset = TorchTransformableSubset(superset, np.arange(1, 15, 2))
+    train_pipeline = transforms.Compose([])
+    val_pipeline = transforms.Compose([])
+    train_subset.set_transform_pipeline([train_pipeline])
+    val_subset.set_transform_pipeline([val_pipeline])
+    assert [train_subset[idx][0] for idx in range(3)] == [0, 2, 4]
+    assert all(
+        train_subset[idx][1] is train_pipeline for idx in range(len(train_subset))
+    )
+    assert all(val_subset[idx][1] is val_pipeline for idx in range(len(val_subset)))
+    assert all(superset[idx][1] is None for idx in range(len(superset)))
@@ -0,0 +1,214 @@
+import glob
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import pytest
+import tifffile
+
+from src.preprocessing.image_preprocessing import ImageDatasetPreprocessor
+from src.utils.basic.io import read_table
+from src.utils.basic.storage import PackedCropStore
+from src.utils.basic.synthetic import generate_synthetic_plates
+
+CROP_PARAMS = {
+    "min_area": 100,
+    "max_area": 4000,
+    "max_bbarea": 6000,
+    "max_eccentricity": 0.99,
+    "min_solidity": 0.1,
+    "min_aspect_ratio": 0.1,
+    "n_jobs": 1,
+}
+TARGET_SIZE = [64, 64]
+
+
+def run_nuclear_crops(
+    data_dir: str,
+    output_dir: str,
+    cache_dir: str = None,
+    table_format: str = "csv",
+    **kwargs
+) -> ImageDatasetPreprocessor:
+    preprocessor = ImageDatasetPreprocessor(
+        image_input_dir=os.path.join(data_dir, "images"),
+        metadata_file=os.path.join(data_dir, "metadata.csv"),
+        output_dir=output_dir,
+        cache_dir=cache_dir,
+        table_format=table_format,
+    )
+    preprocessor.get_nuclear_crops(
+        label_image_input_dir=os.path.join(data_dir, "labels"),
+        **dict(CROP_PARAMS, **kwargs)
+    )
+    return preprocessor
+
+
+def get_results(preprocessor: ImageDatasetPreprocessor, nuclei_dir: str = None) -> dict:
+    # Tables of the nuclei written by the last stage of the preprocessor and the crops in nuclei_dir
+    if nuclei_dir is None:
+        nuclei_dir = preprocessor.nuclei_dir
+    nuclei_metadata = read_table(preprocessor.nuclei_metadata_file)
+    if PackedCropStore.is_store(nuclei_dir):
+        store = PackedCropStore(nuclei_dir)
+        crops = [
+            np.array(store["{}/{}".format(plate, image_file)])
+            for plate, image_file in zip(
+                nuclei_metadata.loc[:, "plate"], nuclei_metadata.loc[:, "image_file"]
+            )
+        ]
+    else:
+        crops = [
+            tifffile.imread(os.path.join(nuclei_dir, str(plate), image_file))
+            for plate, image_file in zip(
+                nuclei_metadata.loc[:, "plate"], nuclei_metadata.loc[:, "image_file"]
+            )
+        ]
+    return {
+        "nuclei_metadata": nuclei_metadata,
+        "image_metadata": read_table(preprocessor.processed_image_metadata_file),
+        "nmco_features": read_table(
+            preprocessor.get_table_file("nuclei_ncmo_features")
+        ),
+        "crops": crops,
+    }
+
+
+def assert_results_equal(results: dict, expected_results: dict):
+    assert results.keys() == expected_results.keys()
+    for name in results:
+        if name == "crops":
+            assert len(results[name]) == len(expected_results[name])
+            for crop, expected_crop in zip(results[name], expected_results[name]):
+                assert crop.dtype == expected_crop.dtype
+                np.testing.assert_array_equal(crop, expected_crop)
+        else:
+            pd.testing.assert_frame_equal(
+                results[name].reset_index(drop=True),
+                expected_results[name].reset_index(drop=True),
+            )
+
+
+@pytest.fixture(scope="module")
+def data_dir(tmp_path_factory):
+    data_dir = str(tmp_path_factory.mktemp("data"))
+    generate_synthetic_plates(
+        data_dir, n_plates=2, n_images_per_plate=3, image_size=256, n_nuclei=12
+    )
+    return data_dir
+
+
+@pytest.fixture(scope="module")
+def expected_results(data_dir, tmp_path_factory):
+    # Results of the default options: individual TIFF crops of all images in a single pass which are padded afterwards
+    preprocessor = run_nuclear_crops(data_dir, str(tmp_path_factory.mktemp("default")))
+    results = get_results(preprocessor)
+    preprocessor.save_padded_images(target_size=TARGET_SIZE, n_jobs=1)
+    padded_results = get_results(
+        preprocessor, nuclei_dir=preprocessor.get_stage_output_dir("padded_nuclei")
+    )
+    assert len(results["crops"]) > 0
+    return results, padded_results
+
+
+@pytest.fixture(scope="module")
+def large_nuclei_data_dir(data_dir, tmp_path_factory):
+    # Synthetic plates with nuclei that exceed the halo of the tiles and cross tile borders. The first one is complete
+    # in the window of the tile containing its centroid while its part in the window of the neighboring tile has its
+    # centroid in that tile.
+    large_nuclei_data_dir = str(tmp_path_factory.mktemp("large_nuclei_data"))
+    shutil.copytree(data_dir, large_nuclei_data_dir, dirs_exist_ok=True)
+    for label_image_file in glob.glob(
+        os.path.join(large_nuclei_data_dir, "labels", "*", "*.tif")
+    ):
+        label_image = tifffile.imread(label_image_file)
+        large_nuclei = np.zeros_like(label_image)
+        large_nuclei[80:110, 60:96] = 1
+        large_nuclei[94:97, 96:230] = 1
+        large_nuclei[150:246, 180:200] = 2
+        # Nuclei overlapping the large nuclei are removed
+        label_image[np.isin(label_image, label_image[large_nuclei > 0])] = 0
+        large_nuclei[large_nuclei > 0] += label_image.max()
+        label_image[large_nuclei > 0] = large_nuclei[large_nuclei > 0]
+        tifffile.imwrite(label_image_file, label_image)
+    return large_nuclei_data_dir
+
+
+def test_sharded_crops(data_dir, expected_results, tmp_path):
+    output_dir = str(tmp_path / "output")
+    shard_dir = str(tmp_path / "shards")
+    preprocessor = run_nuclear_crops(
+        data_dir, output_dir, shard_by_plate=True, shard_size=2, shard_dir=shard_dir
+    )
+    assert_results_equal(get_results(preprocessor), expected_results[0])
+
+    # The completed shards are reused when re-running the method
+    preprocessor = run_nuclear_crops(
+        data_dir, output_dir, shard_by_plate=True, shard_size=2, shard_dir=shard_dir
+    )
+    assert_results_equal(get_results(preprocessor), expected_results[0])
+
+
+def test_packed_crops(data_dir, expected_results, tmp_path):
+    preprocessor = run_nuclear_crops(data_dir, str(tmp_path), crop_format="packed")
+    assert PackedCropStore.is_store(preprocessor.nuclei_dir)
+    assert_results_equal(get_results(preprocessor), expected_results[0])
+
+
+def test_hdf_tables(data_dir, expected_results, tmp_path):
+    preprocessor = run_nuclear_crops(data_dir, str(tmp_path), table_format="hdf")
+    assert preprocessor.nuclei_metadata_file.endswith(".h5")
+    assert_results_equal(get_results(preprocessor), expected_results[0])
+
+
+def test_padded_crops(data_dir, expected_results, tmp_path):
+    preprocessor = run_nuclear_crops(data_dir, str(tmp_path), target_size=TARGET_SIZE)
+    assert_results_equal(get_results(preprocessor), expected_results[1])
+
+
+@pytest.mark.parametrize("large_nuclei", [False, True])
+@pytest.mark.parametrize(
+    "tile_params",
+    [{"tile_size": 96, "tile_halo": 48}, {"memory_budget": 1.0, "tile_halo": 48}],
+)
+def test_tiled_crops(
+    data_dir,
+    large_nuclei_data_dir,
+    expected_results,
+    tmp_path,
+    tile_params,
+    large_nuclei,
+):
+    if large_nuclei:
+        # Every nucleus exceeding the halo is extracted exactly once as when processing the images as a whole
+        data_dir = large_nuclei_data_dir
+        expected_results = get_results(
+            run_nuclear_crops(data_dir, str(tmp_path / "default"))
+        )
+        crop_shapes = [crop.shape for crop in expected_results["crops"]]
+        assert crop_shapes.count((30, 170)) == crop_shapes.count((96, 20)) == 6
+    else:
+        expected_results = expected_results[0]
+    preprocessor = run_nuclear_crops(data_dir, str(tmp_path / "tiled"), **tile_params)
+    assert_results_equal(get_results(preprocessor), expected_results)
+
+
+def test_cached_crops(data_dir, expected_results, tmp_path):
+    # The inputs are copied as one of the images is rewritten such that it is processed again in the second run
+    input_dir = str(tmp_path / "data")
+    shutil.copytree(data_dir, input_dir)
+    output_dir = str(tmp_path / "output")
+    os.makedirs(output_dir)
+    cache_dir = str(tmp_path / "cache")
+    preprocessor = run_nuclear_crops(input_dir, output_dir, cache_dir=cache_dir)
+    assert_results_equal(get_results(preprocessor), expected_results[0])
+
+    image_dir = os.path.join(input_dir, "images")
+    plate_dir = os.path.join(image_dir, sorted(os.listdir(image_dir))[0])
+    image_file = os.path.join(plate_dir, sorted(os.listdir(plate_dir))[0])
+    image = tifffile.imread(image_file)
+    os.remove(image_file)
+    tifffile.imwrite(image_file, image)
+    preprocessor = run_nuclear_crops(input_dir, output_dir, cache_dir=cache_dir)
+    assert_results_equal(get_results(preprocessor), expected_results[0])
@@ -0,0 +1,65 @@
+import inspect
+
+import numpy as np
+import pytest
+import torch
+
+from src.data.samplers import SlideGroupedBatchSampler
+from src.helper.data import DataHandler
+
+
+def get_slide_image_names(n_slides: int = 50, seed: int = 1234) -> np.ndarray:
+    # Slide image names of the samples of slide images with varying numbers of nuclei in a random order
+    rng = np.random.default_rng(seed)
+    n_nuclei = rng.integers(1, 40, size=n_slides)
+    slide_image_names = np.repeat(
+        ["slide_{}.tif".format(i) for i in range(n_slides)], n_nuclei
+    )
+    return rng.permutation(slide_image_names)
+
+
+@pytest.mark.parametrize("drop_last", [False, True])
+@pytest.mark.parametrize("n_streams", [1, 3])
+@pytest.mark.parametrize("n_slides_per_window", [1, 8, 64])
+def test_slide_grouped_batch_sampler(drop_last, n_streams, n_slides_per_window):
+    slide_image_names = get_slide_image_names()
+    batch_size = 64
+    sampler = SlideGroupedBatchSampler(
+        slide_image_names,
+        batch_size=batch_size,
+        drop_last=drop_last,
+        n_slides_per_window=n_slides_per_window,
+        n_streams=n_streams,
+        generator=torch.Generator().manual_seed(0),
+    )
+    for _ in range(2):
+        batches = list(sampler)
+        assert len(batches) == len(sampler)
+        assert all(len(batch) == batch_size for batch in batches[:-1])
+        samples = np.concatenate(batches)
+        # Every sample is drawn at most once and only the samples of the incomplete last batch are dropped
+        assert len(np.unique(samples)) == len(samples)
+        if drop_last:
+            assert len(batches[-1]) == batch_size
+            assert len(samples) == len(slide_image_names) // batch_size * batch_size
+        else:
+            assert 0 < len(batches[-1]) <= batch_size
+            np.testing.assert_array_equal(
+                np.sort(samples), np.arange(len(slide_image_names))
+            )
+
+
+def test_default_window_size():
+    # The batches of the default window contain about as many distinct slide images as documented
+    slide_image_names = get_slide_image_names(n_slides=2000)
+    sampler = SlideGroupedBatchSampler(
+        slide_image_names,
+        batch_size=64,
+        drop_last=True,
+        generator=torch.Generator().manual_seed(0),
+    )
+    assert sampler.n_slides_per_window == 64
+    n_slides = [len(np.unique(slide_image_names[batch])) for batch in sampler]
+    assert 30 < np.mean(n_slides) < 50
+    default_window = inspect.signature(DataHandler).parameters["n_slides_per_window"]
+    assert default_window.default == sampler.n_slides_per_window
@@ -0,0 +1,311 @@
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import sqlite3
+import time
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+
+def get_file_fingerprint(file_path: str, content_hash: bool = False) -> str:
+    r"""Returns a fingerprint of the file that changes whenever the file is modified.
+
+    Parameters
+    ----------
+    file_path : str
+        Path to the file.
+    content_hash : bool
+        If True the SHA1 hash of the file content is used. Otherwise, the fingerprint is given by the size and the
+        modification time of the file which is much cheaper to obtain.
+
+    Returns
+    -------
+    fingerprint : str
+        The fingerprint of the file or None if the file does not exist.
+    """
+    if not os.path.exists(file_path):
+        return None
+    if content_hash:
+        sha1 = hashlib.sha1()
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(2 ** 20), b""):
+                sha1.update(block)
+        return sha1.hexdigest()
+    stat = os.stat(file_path)
+    return "{}:{}".format(stat.st_size, stat.st_mtime_ns)
+
+
+def get_files_fingerprint(file_paths: List[str], content_hash: bool = False) -> str:
+    r"""Returns the combined fingerprint of the given files (see get_file_fingerprint)."""
+    return "|".join(
+        [
+            str(get_file_fingerprint(file_path, content_hash=content_hash))
+            for file_path in file_paths
+        ]
+    )
+
+
+def get_params_key(params) -> str:
+    r"""Returns a key identifying the given JSON-serializable stage parameters."""
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+
+class StageCache(object):
+    r"""Persistent record of the items processed by a pipeline stage.
+
+    For every item (e.g. an output file) the fingerprint of its inputs and an optional JSON-serializable value are
+    stored in ``<cache_dir>/<stage>_cache.json``. All records are invalidated if the stage parameters change.
+    """
+
+    def __init__(self, cache_dir: str, stage: str, params, content_hash: bool = False):
+        self.cache_file = os.path.join(cache_dir, "{}_cache.json".format(stage))
+        self.params_key = get_params_key(params)
+        self.content_hash = content_hash
+        self.items = {}
+
+        os.makedirs(cache_dir, exist_ok=True)
+        if os.path.exists(self.cache_file):
+            with open(self.cache_file, "r") as f:
+                cache = json.load(f)
+            if cache["params_key"] == self.params_key:
+                self.items = cache["items"]
+
+    def get_fingerprint(self, file_paths: List[str]) -> str:
+        return get_files_fingerprint(file_paths, content_hash=self.content_hash)
+
+    def is_current(self, item: str, fingerprint: str) -> bool:
+        return item in self.items and self.items[item][0] == fingerprint
+
+    def get(self, item: str):
+        return self.items[item][1]
+
+    def update(self, item: str, fingerprint: str, value=None):
+        self.items[item] = [fingerprint, value]
+
+    def save(self):
+        with open(self.cache_file + ".tmp", "w") as f:
+            json.dump({"params_key": self.params_key, "items": self.items}, f)
+        os.replace(self.cache_file + ".tmp", self.cache_file)
+
+
+class NuclearFeatureCache(object):
+    r"""Size-bounded on-disk cache of per-nucleus features backed by a SQLite database.
+
+    Entries are keyed by a hash of the nucleus mask, its intensity crop and the version of the feature extractor (see
+    get_key). If the database grows beyond max_size (in MB), the least recently used entries are evicted. The cache
+    can be shared by several processes.
+    """
+
+    def __init__(self, cache_file: str, max_size: float = 1024, version: str = ""):
+        self.cache_file = cache_file
+        self.max_size = max_size
+        self.version = version
+        self.connection = None
+
+        cache_dir = os.path.split(self.cache_file)[0]
+        if cache_dir != "":
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def connect(self) -> sqlite3.Connection:
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.cache_file, timeout=60)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS features (key TEXT PRIMARY KEY, value BLOB, size INTEGER, "
+                "last_used REAL)"
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS features_last_used ON features (last_used)"
+            )
+            self.connection.commit()
+        return self.connection
+
+    def get_key(self, mask: np.ndarray, intensity_image: np.ndarray) -> str:
+        sha1 = hashlib.sha1(self.version.encode())
+        sha1.update(np.array(mask.shape, dtype=np.int64).tobytes())
+        sha1.update(np.packbits(mask).tobytes())
+        sha1.update(intensity_image.dtype.str.encode())
+        sha1.update(np.ascontiguousarray(intensity_image).tobytes())
+        return sha1.hexdigest()
+
+    def get(self, keys: List[str]) -> dict:
+        connection = self.connect()
+        values = {}
+        # Keys are queried in batches as SQLite limits the number of parameters of a statement
+        for start in range(0, len(keys), 500):
+            batch_keys = keys[start : start + 500]
+            rows = connection.execute(
+                "SELECT key, value FROM features WHERE key IN ({})".format(
+                    ",".join("?" * len(batch_keys))
+                ),
+                batch_keys,
+            ).fetchall()
+            values.update({key: pickle.loads(value) for key, value in rows})
+        if len(values) > 0:
+            now = time.time()
+            connection.executemany(
+                "UPDATE features SET last_used = ? WHERE key = ?",
+                [(now, key) for key in values],
+            )
+            connection.commit()
+        return values
+
+    def put(self, values: dict):
+        if len(values) == 0:
+            return
+        connection = self.connect()
+        now = time.time()
+        entries = []
+        for key, value in values.items():
+            value = pickle.dumps(value)
+            entries.append((key, value, len(value), now))
+        connection.executemany(
+            "INSERT OR REPLACE INTO features (key, value, size, last_used) VALUES (?, ?, ?, ?)",
+            entries,
+        )
+        connection.commit()
+        self.evict()
+
+    def get_size(self) -> float:
+        # Size of the used pages of the database in MB
+        connection = self.connect()
+        page_count = connection.execute("PRAGMA page_count").fetchone()[0]
+        freelist_count = connection.execute("PRAGMA freelist_count").fetchone()[0]
+        page_size = connection.execute("PRAGMA page_size").fetchone()[0]
+        return (page_count - freelist_count) * page_size / 2 ** 20
+
+    def evict(self):
+        # Removes the least recently used entries (in steps of 10% of the entries) until the cache fits its size
+        connection = self.connect()
+        while self.get_size() > self.max_size:
+            n_entries = connection.execute("SELECT COUNT(*) FROM features").fetchone()[0]
+            if n_entries == 0:
+                break
+            connection.execute(
+                "DELETE FROM features WHERE key IN (SELECT key FROM features ORDER BY last_used LIMIT ?)",
+                (max(n_entries // 10, 1),),
+            )
+            connection.commit()
+
+    def __len__(self):
+        return self.connect().execute("SELECT COUNT(*) FROM features").fetchone()[0]
+
+    def __getstate__(self):
+        # The connection is reopened lazily e.g. in every worker process
+        state = self.__dict__.copy()
+        state["connection"] = None
+        return state
+
+
+class MetadataIndexCache(object):
+    r"""On-disk cache of the filtered metadata of a data set in a compact column layout.
+
+    For every combination of a metadata file (identified by its fingerprint) and the parameters used to filter it, the
+    filtered metadata is stored in ``<cache_dir>/<key>/`` with one npy file per column. Numeric columns are stored as
+    they are. Object columns (e.g. labels, batches and slide images) are integer-coded and stored as the codes and
+    their distinct values, which are expanded to object columns again when loaded such that the loaded metadata
+    equals the one that was saved. The columns are thus read without parsing any text. The index is written to a
+    temporary directory first and moved in place once complete, such that several processes can build the same index
+    concurrently.
+    """
+
+    def __init__(
+        self, cache_dir: str, metadata_file: str, params, content_hash: bool = False
+    ):
+        self.fingerprint = get_file_fingerprint(metadata_file, content_hash=content_hash)
+        self.params = params
+        self.index_dir = os.path.join(
+            cache_dir,
+            get_params_key(
+                {
+                    "metadata_file": os.path.abspath(metadata_file),
+                    "fingerprint": self.fingerprint,
+                    "params": params,
+                }
+            ),
+        )
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def exists(self) -> bool:
+        return os.path.exists(os.path.join(self.index_dir, "index.json"))
+
+    @staticmethod
+    def save_column(file_prefix: str, values) -> bool:
+        # Returns True if the column is stored integer-coded
+        values = pd.Series(values)
+        if values.dtype.kind in "biufcmM":
+            np.save(file_prefix + ".npy", np.asarray(values))
+            return False
+        codes, categories = pd.factorize(values)
+        np.save(file_prefix + ".npy", codes.astype(np.int32))
+        np.save(
+            file_prefix + "_categories.npy",
+            np.asarray(categories, dtype=object),
+            allow_pickle=True,
+        )
+        return True
+
+    @staticmethod
+    def load_column(file_prefix: str, categorical: bool) -> np.ndarray:
+        values = np.load(file_prefix + ".npy")
+        if not categorical:
+            return values
+        # Missing values are coded as -1 and thus taken from the appended NaN
+        categories = np.load(file_prefix + "_categories.npy", allow_pickle=True)
+        return np.append(categories, np.nan).astype(object)[values]
+
+    def save(self, data: pd.DataFrame):
+        tmp_dir = "{}.{}.tmp".format(self.index_dir, os.getpid())
+        os.makedirs(tmp_dir, exist_ok=True)
+        columns = []
+        for i, col in enumerate(data.columns):
+            columns.append(
+                [
+                    col,
+                    self.save_column(
+                        os.path.join(tmp_dir, "col_{}".format(i)), data[col]
+                    ),
+                ]
+            )
+        index = [
+            data.index.name,
+            self.save_column(os.path.join(tmp_dir, "index"), data.index),
+        ]
+        with open(os.path.join(tmp_dir, "index.json"), "w") as f:
+            json.dump(
+                {
+                    "fingerprint": self.fingerprint,
+                    "params": self.params,
+                    "n_rows": len(data),
+                    "columns": columns,
+                    "index": index,
+                },
+                f,
+            )
+        try:
+            os.replace(tmp_dir, self.index_dir)
+        except OSError:
+            # The index has been completed by another process in the meantime
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def load(self) -> pd.DataFrame:
+        with open(os.path.join(self.index_dir, "index.json"), "r") as f:
+            config = json.load(f)
+        index_name, index_categorical = config["index"]
+        index = pd.Index(
+            self.load_column(os.path.join(self.index_dir, "index"), index_categorical),
+            name=index_name,
+        )
+        data = {
+            col: self.load_column(
+                os.path.join(self.index_dir, "col_{}".format(i)), categorical
+            )
+            for i, (col, categorical) in enumerate(config["columns"])
+        }
+        return pd.DataFrame(
+            data, index=index, columns=[col for col, _ in config["columns"]]
+        )
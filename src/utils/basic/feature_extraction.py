@@ -1,234 +1,385 @@
 # -*- coding: utf-8 -*-
 import copy
-from typing import List
+from typing import List, Tuple
 
 import numpy as np
 import pandas as pd
-from mahotas.features import zernike_moments
+from joblib import Parallel, delayed
 from nmco.nuclear_features import (
     Boundary_global as BG,
     Img_texture as IT,
     Int_dist_features as IDF,
     Boundary_local_curvature as BLC,
 )
+from scipy import ndimage
+from scipy.ndimage import grey_erosion
+from scipy.spatial import cKDTree
 from skimage import measure
-from skimage.measure._regionprops import RegionProperties
-from skimage.morphology import erosion
+from skimage.morphology import disk, reconstruction
+from skimage.segmentation import find_boundaries
+from skimage.transform import rescale, resize
+
+from src.utils.basic.cache import NuclearFeatureCache
+
+# Version of the nmco features which must be changed whenever the computation of the features changes to invalidate
+# cached features
+NMCO_FEATURE_VERSION = "nmco-1"
 
 
 def compute_carpenter_profiles(
-    label_image: np.ndarray, intensity_image: np.ndarray
+    label_image: np.ndarray,
+    intensity_image: np.ndarray,
+    intensity_range: Tuple[float, float] = None,
+    labels: List[int] = None,
+    neighbor_distance: float = 50,
+    granularity_steps: int = 8,
+    granularity_subsample_size: float = 0.25,
+    offset: Tuple[int, int] = (0, 0),
 ) -> pd.DataFrame:
-    raw_image = copy.deepcopy(intensity_image)
-    raw_image -= raw_image.min()
-    raw_image = raw_image / raw_image.max()
-    raw_image = (raw_image * 255).astype(int)
-    # Get features for the individual nuclei in the image
-    props = measure.regionprops(label_image, raw_image)
+    r"""Computes CellProfiler-style profiles of the nuclei in a field of view.
 
-    propstable = measure.regionprops_table(
-        label_image,
-        raw_image,
-        cache=True,
-        properties=[
-            "label",
-            "area",
-            "perimeter",
-            "equivalent_diameter",
-            "major_axis_length",
-            "minor_axis_length",
-            "eccentricity",
-            "orientation",
-            "solidity",
-        ],
-    )
-    propstable = pd.DataFrame(propstable)
+    All features are computed for all nuclei at once by per-label reductions over the image instead of per-nucleus
+    computations.
 
-    propstable = pd.DataFrame(propstable)
+    Parameters
+    ----------
+    label_image : np.ndarray
+        The label image of the nuclei.
+    intensity_image : np.ndarray
+        The corresponding intensity image.
+    intensity_range : tuple
+        Minimum and maximum intensity used for normalization if the images are only a part of the field of view.
+    labels : list
+        Labels of the nuclei to be profiled, all nuclei are profiled if not given. The neighbor features consider
+        all nuclei of the label image.
+    neighbor_distance : float
+        The distance (in pixels) within which other nuclei are counted as neighbors.
+    granularity_steps : int
+        The length of the granularity spectrum.
+    granularity_subsample_size : float
+        The factor by which the image is subsampled to compute the granularity spectrum.
+    offset : tuple
+        Position of the images in the field of view such that the location features are given in its coordinates.
+
+    Returns
+    -------
+    features : pd.DataFrame
+        The profiles of the nuclei ordered by their label.
+    """
+    if intensity_range is None:
+        intensity_range = (intensity_image.min(), intensity_image.max())
+    raw_image = (intensity_image - intensity_range[0]) / (
+        intensity_range[1] - intensity_range[0]
+    )
 
-    areashape_features = compute_area_shape_features(props)
-    granularity_features = compute_granularity_features(props)
-    intensity_features = compute_intensity_features(props)
-    neighbor_features = compute_neighbor_features(props)
-    texture_features = compute_texture_features(props)
-    location_features = compute_location_features(props)
+    all_labels = np.unique(label_image)
+    all_labels = all_labels[all_labels > 0]
+    all_centroids = np.array(
+        ndimage.center_of_mass(np.ones(label_image.shape), label_image, all_labels)
+    ).reshape(-1, 2)
+    if labels is None:
+        labels = all_labels
+    else:
+        labels = np.sort(np.asarray(labels))
+        label_image = np.where(np.isin(label_image, labels), label_image, 0)
+    centroids = all_centroids[np.searchsorted(all_labels, labels)]
 
-    all_features = pd.concat(
-        [
-            propstable,
-            areashape_features,
-            granularity_features,
-            intensity_features,
-            neighbor_features,
-            texture_features,
-            location_features,
-        ]
+    propstable = pd.DataFrame(
+        measure.regionprops_table(
+            label_image,
+            properties=[
+                "label",
+                "area",
+                "perimeter",
+                "bbox_area",
+                "equivalent_diameter",
+                "major_axis_length",
+                "minor_axis_length",
+                "eccentricity",
+                "orientation",
+                "solidity",
+                "feret_diameter_max",
+            ],
+        )
     )
-    return all_features
-
-
-def compute_area_shape_features(regions: List[RegionProperties]):
-    min_feret_diameter = []
-    max_feret_diameter = []
-    compacteness = []
-    extent = []
-    max_radius = []
-    min_radius = []
-    mean_radius = []
-    median_radius = []
-    formfactor = []
-    zernike_features = []
-
-    for region in regions:
-        max_feret_diameter.append(region.feret_diameter_max)
-        # Todo implement minimum feret diameter
-        extent.append(np.sum(region.image) / region.bbox_area)
-        distances = np.argwhere(region.image)
-        distances[0, :] -= region.centroid[0]
-        distances[1, :] -= region.centroid[1]
-        distances = np.apply_along_axis(distances, func1d=np.linalg.norm, axis=0)
-        compacteness.append(np.mean(distances) / region.area)
-        edge = region.image ^ erosion(region.image)
-        radii = np.argwhere(edge)
-        radii[0, :] -= region.centroid[0]
-        radii[1, :] -= region.centroid[1]
-        radii = np.apply_along_axis(arr=radii, func1d=np.linalg.norm, axis=0)
-        min_radius.append(min(radii))
-        max_radius.append(max(radii))
-        mean_radius.append(np.mean(radii))
-        median_radius.append(np.median(radii))
-        formfactor.append(4 * np.pi * region.area / (region.perimeter ** 2))
-        zernike_features.append(zernike_moments(region.intensity_image, 10)[:30])
-    columns = [
-        "max_feret_diameter",
-        "extent",
-        "compactness",
-        "min_radius",
-        "max_radius",
-        "mean_radius",
-        "median_radius",
-        "formfactor",
-    ].extend(["zernike_{}".format(i) for i in range(30)])
-    area_shape_features = np.concatenate(
+    features = pd.concat(
         [
-            max_feret_diameter,
-            extent,
-            compacteness,
-            min_radius,
-            max_radius,
-            mean_radius,
-            median_radius,
-            formfactor,
-            zernike_features,
+            propstable,
+            compute_area_shape_features(label_image, labels, centroids, propstable),
+            compute_intensity_features(label_image, raw_image, labels, centroids),
+            compute_location_features(
+                label_image, raw_image, labels, centroids, offset=offset
+            ),
+            compute_neighbor_features(
+                all_centroids, all_labels, labels, neighbor_distance=neighbor_distance
+            ),
+            compute_granularity_features(
+                label_image,
+                raw_image,
+                labels,
+                n_steps=granularity_steps,
+                subsample_size=granularity_subsample_size,
+            ),
         ],
         axis=1,
     )
-    area_shape_features = pd.DataFrame(area_shape_features, columns=columns)
-    return area_shape_features
-
-
-def compute_granularity_features(regions: List[RegionProperties]):
-    pass
-
-
-def compute_intensity_features(regions: List[RegionProperties]):
-    min_edge_int = []
-    max_edge_int = []
-    mean_edge_int = []
-    std_edge_int = []
-    med_edge_int = []
-
-    min_int = []
-    max_int = []
-    mean_int = []
-    std_int = []
-    med_int = []
-    lower_quart_int = []
-    upper_quart_int = []
-
-    for region in regions:
-        edges = np.logical_xor(erosion(region.image), region.image)
-        edge_int_img = region.intensity_image[edges]
-        min_edge_int.append(np.min(edge_int_img))
-        max_edge_int.append(np.max(edge_int_img))
-        mean_edge_int.append(np.mean(edge_int_img))
-        std_edge_int.append(np.std(edge_int_img))
-        med_edge_int.append(np.median(edge_int_img))
-
-        min_int.append(np.min(region.intensity_image))
-        max_int.append(np.max(region.intensity_image))
-        mean_int.append(np.mean(region.intensity_image))
-        std_int.append(np.std(region.intensity_image))
-        med_int.append(np.median(region.intensity_image))
-        lower_quart_int.append(np.quantile(region.intensity_image, q=0.25))
-        upper_quart_int.append(np.quantile(region.intensity_image, q=0.75))
-
-    columns = [
-        "min_int",
-        "max_int",
-        "mean_int",
-        "med_int",
-        "std_int",
-        "q25_int",
-        "q75_int",
-        "min_edge_int",
-        "max_edge_int",
-        "mean_edge_int",
-        "median_edge_int",
-        "std_edge_int",
-    ]
-    int_features = np.concatenate(
-        [
-            min_int,
-            max_int,
-            mean_int,
-            med_int,
-            std_int,
-            lower_quart_int,
-            upper_quart_int,
-            min_edge_int,
-            max_edge_int,
-            mean_edge_int,
-            med_edge_int,
-            std_edge_int,
-        ]
+    return features
+
+
+def get_labeled_quantiles(
+    values: np.ndarray, value_labels: np.ndarray, labels: np.ndarray, q: float
+) -> np.ndarray:
+    r"""Returns the q-quantile (with linear interpolation as np.quantile) of the values of every label.
+
+    The values of all labels are sorted once such that the quantiles of all labels are obtained by indexing.
+    """
+    order = np.lexsort((values, value_labels))
+    values = values[order]
+    counts = np.bincount(np.searchsorted(labels, value_labels), minlength=len(labels))
+    starts = np.cumsum(counts) - counts
+    positions = q * (np.maximum(counts, 1) - 1)
+    lower = np.floor(positions).astype(int)
+    upper = np.ceil(positions).astype(int)
+    quantiles = values[np.minimum(starts + lower, len(values) - 1)] + (
+        values[np.minimum(starts + upper, len(values) - 1)]
+        - values[np.minimum(starts + lower, len(values) - 1)]
+    ) * (positions - lower)
+    quantiles[counts == 0] = np.nan
+    return quantiles
+
+
+def get_labeled_statistics(
+    values: np.ndarray, value_labels: np.ndarray, labels: np.ndarray, prefix: str
+) -> dict:
+    r"""Returns summary statistics of the values of every label."""
+    # scipy divides by the (zero) counts of the values not in labels
+    with np.errstate(divide="ignore", invalid="ignore"):
+        std = ndimage.standard_deviation(values, value_labels, labels)
+    return {
+        "min_" + prefix: ndimage.minimum(values, value_labels, labels),
+        "max_" + prefix: ndimage.maximum(values, value_labels, labels),
+        "mean_" + prefix: ndimage.mean(values, value_labels, labels),
+        "std_" + prefix: std,
+        "median_" + prefix: get_labeled_quantiles(values, value_labels, labels, 0.5),
+        "q25_" + prefix: get_labeled_quantiles(values, value_labels, labels, 0.25),
+        "q75_" + prefix: get_labeled_quantiles(values, value_labels, labels, 0.75),
+    }
+
+
+def get_edge_mask(label_image: np.ndarray) -> np.ndarray:
+    return find_boundaries(label_image, mode="inner") & (label_image > 0)
+
+
+def compute_area_shape_features(
+    label_image: np.ndarray,
+    labels: np.ndarray,
+    centroids: np.ndarray,
+    propstable: pd.DataFrame,
+) -> pd.DataFrame:
+    rows, cols = np.nonzero(label_image)
+    pixel_labels = np.searchsorted(labels, label_image[rows, cols])
+    squared_distances = (rows - centroids[pixel_labels, 0]) ** 2 + (
+        cols - centroids[pixel_labels, 1]
+    ) ** 2
+    area = np.array(propstable["area"], dtype=float)
+
+    edge_rows, edge_cols = np.nonzero(get_edge_mask(label_image))
+    edge_labels = label_image[edge_rows, edge_cols]
+    edge_pixel_labels = np.searchsorted(labels, edge_labels)
+    radii = np.sqrt(
+        (edge_rows - centroids[edge_pixel_labels, 0]) ** 2
+        + (edge_cols - centroids[edge_pixel_labels, 1]) ** 2
+    )
+
+    area_shape_features = {
+        "extent": area / np.array(propstable["bbox_area"]),
+        "form_factor": 4 * np.pi * area / np.array(propstable["perimeter"]) ** 2,
+        # Equals one for a disk
+        "compactness": 2
+        * np.pi
+        * np.bincount(pixel_labels, squared_distances, minlength=len(labels))
+        / area ** 2,
+    }
+    radius_features = get_labeled_statistics(radii, edge_labels, labels, "radius")
+    for stat in ["min", "max", "mean", "median"]:
+        area_shape_features[stat + "_radius"] = radius_features[stat + "_radius"]
+    return pd.DataFrame(area_shape_features)
+
+
+def compute_intensity_features(
+    label_image: np.ndarray,
+    intensity_image: np.ndarray,
+    labels: np.ndarray,
+    centroids: np.ndarray,
+) -> pd.DataFrame:
+    mask = label_image > 0
+    intensity_features = get_labeled_statistics(
+        intensity_image[mask], label_image[mask], labels, "int"
+    )
+    intensity_features["integrated_int"] = ndimage.sum(
+        intensity_image, label_image, labels
+    )
+    edge_mask = get_edge_mask(label_image)
+    intensity_features.update(
+        get_labeled_statistics(
+            intensity_image[edge_mask], label_image[edge_mask], labels, "edge_int"
+        )
+    )
+    intensity_features["integrated_edge_int"] = ndimage.sum(
+        intensity_image[edge_mask], label_image[edge_mask], labels
+    )
+    # Distance between the center of mass of the intensities and the centroid
+    weighted_centroids = np.array(
+        ndimage.center_of_mass(intensity_image, label_image, labels)
+    ).reshape(-1, 2)
+    intensity_features["mass_displacement"] = np.linalg.norm(
+        weighted_centroids - centroids, axis=1
+    )
+    return pd.DataFrame(intensity_features)
+
+
+def compute_location_features(
+    label_image: np.ndarray,
+    intensity_image: np.ndarray,
+    labels: np.ndarray,
+    centroids: np.ndarray,
+    offset: Tuple[int, int] = (0, 0),
+) -> pd.DataFrame:
+    weighted_centroids = np.array(
+        ndimage.center_of_mass(intensity_image, label_image, labels)
+    ).reshape(-1, 2)
+    max_int_locations = np.array(
+        ndimage.maximum_position(intensity_image, label_image, labels)
+    ).reshape(-1, 2)
+    location_features = pd.DataFrame(
+        {
+            "centroid-0": centroids[:, 0] + offset[0],
+            "centroid-1": centroids[:, 1] + offset[1],
+            "weighted_centroid-0": weighted_centroids[:, 0] + offset[0],
+            "weighted_centroid-1": weighted_centroids[:, 1] + offset[1],
+            "max_int_location-0": max_int_locations[:, 0] + offset[0],
+            "max_int_location-1": max_int_locations[:, 1] + offset[1],
+        }
     )
-    int_features = pd.DataFrame(int_features, columns=columns)
-    return int_features
-
-
-def compute_texture_features(regions: List[RegionProperties]):
-    pass
-
-
-def compute_neighbor_features(regions: List[RegionProperties]):
-    angle_between_closest_neighbors = []
-    closest_neighbor = []
-    closest_neighbor_dist = []
-    second_closest_neighbor = []
-    second_closest_neighbor_dist = []
-    pass
-
-
-def compute_location_features(regions: List[RegionProperties]):
-    center_x = []
-    center_y = []
-    max_int_x = []
-    max_int_y = []
-    for region in regions:
-        center_x.append(region.centroid[0])
-        center_y.append(region.centroid[1])
-        max_int_xy = np.where(region.intensity_image == np.max(region.intensity_image))
-        max_int_x.append(max_int_xy[0])
-        max_int_y.append(max_int_xy[1])
-    columns = ["centroid_x", "centroid_y", "max_int_x", "max_int_y"]
-    location_features = np.concatenate([center_x, center_y, max_int_x, max_int_y])
-    location_features = pd.DataFrame(location_features, columns=columns)
     return location_features
 
 
+def compute_neighbor_features(
+    all_centroids: np.ndarray,
+    all_labels: np.ndarray,
+    labels: np.ndarray,
+    neighbor_distance: float = 50,
+) -> pd.DataFrame:
+    tree = cKDTree(all_centroids)
+    centroids = all_centroids[np.searchsorted(all_labels, labels)]
+    # The closest point is the nucleus itself. Missing neighbors are returned with infinite distance and are reported
+    # with label and distance 0 as in CellProfiler.
+    distances, idc = tree.query(centroids, k=3)
+    distances = distances.reshape(-1, 3)
+    idc = idc.reshape(-1, 3)
+    missing = np.isinf(distances)
+    distances[missing] = 0
+    padded_centroids = np.concatenate([all_centroids, [[0, 0]]])
+    padded_labels = np.concatenate([all_labels, [0]])
+    first_vectors = padded_centroids[idc[:, 1]] - centroids
+    second_vectors = padded_centroids[idc[:, 2]] - centroids
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cos_angles = np.sum(first_vectors * second_vectors, axis=1) / (
+            np.linalg.norm(first_vectors, axis=1)
+            * np.linalg.norm(second_vectors, axis=1)
+        )
+    angles = np.degrees(np.arccos(np.clip(cos_angles, -1, 1)))
+    angles[missing[:, 2] | np.isnan(angles)] = 0
+    neighbor_features = pd.DataFrame(
+        {
+            "n_neighbors": np.array(
+                [
+                    len(neighbors) - 1
+                    for neighbors in tree.query_ball_point(centroids, neighbor_distance)
+                ]
+            ),
+            "first_closest_neighbor": padded_labels[idc[:, 1]],
+            "first_closest_distance": distances[:, 1],
+            "second_closest_neighbor": padded_labels[idc[:, 2]],
+            "second_closest_distance": distances[:, 2],
+            "angle_between_neighbors": angles,
+        }
+    )
+    return neighbor_features
+
+
+def compute_granularity_features(
+    label_image: np.ndarray,
+    intensity_image: np.ndarray,
+    labels: np.ndarray,
+    n_steps: int = 8,
+    subsample_size: float = 0.25,
+) -> pd.DataFrame:
+    # Granularity spectrum as in CellProfiler: the image is successively eroded and reconstructed and the fraction of
+    # the initial mean intensity of every nucleus removed by each step is measured. As in CellProfiler, the spectrum
+    # is computed on a subsampled image whose reconstructions are upsampled to measure the nuclei at full resolution.
+    start_means = ndimage.mean(intensity_image, label_image, labels)
+    previous_means = start_means
+    subsampled_image = rescale(intensity_image, subsample_size, order=1)
+    eroded_image = subsampled_image
+    granularity_features = {}
+    footprint = disk(1)
+    for i in range(n_steps):
+        eroded_image = grey_erosion(eroded_image, footprint=footprint)
+        reconstructed_image = resize(
+            reconstruction(eroded_image, subsampled_image, "dilation", footprint),
+            intensity_image.shape,
+            order=1,
+        )
+        current_means = ndimage.mean(reconstructed_image, label_image, labels)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            granularity_features["granularity_{}".format(i + 1)] = (
+                (previous_means - current_means) * 100 / start_means
+            )
+        previous_means = current_means
+    return pd.DataFrame(granularity_features)
+
+
+def get_nuclear_chromatin_feature_rows(regions: List[Tuple]) -> List[List[Tuple]]:
+    r"""Computes the nmco features of the given regions.
+
+    Parameters
+    ----------
+    regions : list
+        Tuples of the binary image, the intensity image, the local centroid and the label of each region.
+
+    Returns
+    -------
+    feature_rows : list
+        Lists of (feature name, value) pairs for every region.
+    """
+    feature_rows = []
+    for image, intensity_image, local_centroid, label in regions:
+        features = [
+            BLC.curvature_features(image, step=5).reset_index(drop=True),
+            BG.boundary_features(image, centroids=local_centroid).reset_index(
+                drop=True
+            ),
+            IDF.intensity_features(image, intensity_image).reset_index(drop=True),
+            IT.texture_features(image, intensity_image),
+        ]
+        feature_row = [
+            (column, values.iloc[0])
+            for feature in features
+            for column, values in feature.items()
+        ]
+        feature_row.append(("label", label))
+        feature_rows.append(feature_row)
+    return feature_rows
+
+
 def compute_nuclear_chromatin_features(
-    label_image: np.ndarray, intensity_image: np.ndarray
+    label_image: np.ndarray,
+    intensity_image: np.ndarray,
+    intensity_range: Tuple[float, float] = None,
+    n_jobs: int = 1,
+    labels: List[int] = None,
+    feature_cache: NuclearFeatureCache = None,
 ) -> pd.DataFrame:
     """
     Function that reads in the raw and segmented/labelled images for a field of view and computes nuclear features.
@@ -237,10 +388,21 @@ def compute_nuclear_chromatin_features(
         raw_image_path: path pointing to the raw image
         labelled_image_path: path pointing to the segmented image
         output_dir: path where the results need to be stored
+        intensity_range: minimum and maximum intensity used for normalization if the images are only a part of the
+            field of view
+        n_jobs: number of workers among which the nuclei are split
+        labels: labels of the nuclei to be featurized, all nuclei are featurized if not given
+        feature_cache: cache of the nmco features of individual nuclei whose version should be NMCO_FEATURE_VERSION
     """
-    raw_image = copy.deepcopy(intensity_image)
-    raw_image -= raw_image.min()
-    raw_image = raw_image / raw_image.max()
+    if labels is not None:
+        label_image = np.where(np.isin(label_image, labels), label_image, 0)
+    if intensity_range is None:
+        raw_image = copy.deepcopy(intensity_image)
+        raw_image -= raw_image.min()
+        raw_image = raw_image / raw_image.max()
+    else:
+        raw_image = intensity_image - intensity_range[0]
+        raw_image = raw_image / (intensity_range[1] - intensity_range[0])
     raw_image = (raw_image * 255).astype(int)
     # Get features for the individual nuclei in the image
     props = measure.regionprops(label_image, raw_image)
@@ -273,41 +435,49 @@ def compute_nuclear_chromatin_features(
     )
     propstable = pd.DataFrame(propstable)
 
-    # measure other inhouse features
-    all_features = pd.concat(
-        [
-            BLC.curvature_features(props[0].image, step=5).reset_index(drop=True),
-            BG.boundary_features(
-                props[0].image, centroids=props[0].local_centroid
-            ).reset_index(drop=True),
-            IDF.intensity_features(
-                props[0].image, props[0].intensity_image
-            ).reset_index(drop=True),
-            IT.texture_features(props[0].image, props[0].intensity_image),
-            pd.DataFrame([1], columns=["label"]),
-        ],
-        axis=1,
-    )
-    for i in range(1, len(props)):
-        all_features = all_features.append(
-            pd.concat(
-                [
-                    BLC.curvature_features(props[i].image, step=5).reset_index(
-                        drop=True
-                    ),
-                    BG.boundary_features(
-                        props[i].image, centroids=props[i].local_centroid
-                    ).reset_index(drop=True),
-                    IDF.intensity_features(
-                        props[i].image, props[i].intensity_image
-                    ).reset_index(drop=True),
-                    IT.texture_features(props[i].image, props[i].intensity_image),
-                    pd.DataFrame([i + 1], columns=["label"]),
-                ],
-                axis=1,
-            ),
-            ignore_index=True,
+    # measure other inhouse features, the results for all nuclei are collected column-wise and the feature table
+    # is assembled once.
+    regions = [
+        (props[i].image, props[i].intensity_image, props[i].local_centroid, props[i].label)
+        for i in range(len(props))
+    ]
+    # Features of nuclei with identical mask and intensity crop are taken from the cache if given
+    feature_rows = [None] * len(regions)
+    if feature_cache is not None:
+        keys = [
+            feature_cache.get_key(region[0], region[1]) for region in regions
+        ]
+        cached_rows = feature_cache.get(keys)
+        for i, key in enumerate(keys):
+            if key in cached_rows:
+                feature_rows[i] = cached_rows[key] + [("label", regions[i][3])]
+    missing = [i for i in range(len(regions)) if feature_rows[i] is None]
+    missing_regions = [regions[i] for i in missing]
+
+    if n_jobs == 1 or len(missing_regions) == 0:
+        missing_rows = get_nuclear_chromatin_feature_rows(missing_regions)
+    else:
+        chunk_size = int(np.ceil(len(missing_regions) / n_jobs))
+        missing_rows = Parallel(n_jobs=n_jobs)(
+            delayed(get_nuclear_chromatin_feature_rows)(
+                missing_regions[start : start + chunk_size]
+            )
+            for start in range(0, len(missing_regions), chunk_size)
         )
+        missing_rows = [row for rows in missing_rows for row in rows]
+    for i, row in zip(missing, missing_rows):
+        feature_rows[i] = row
+    if feature_cache is not None:
+        # The label is not cached as it is specific to the label image
+        feature_cache.put({keys[i]: feature_rows[i][:-1] for i in missing})
+
+    columns = {}
+    for i, row in enumerate(feature_rows):
+        for column, value in row:
+            if column not in columns:
+                columns[column] = np.full(len(feature_rows), np.nan, dtype=object)
+            columns[column][i] = value
+    all_features = pd.DataFrame(columns).infer_objects()
 
     # Add in other related features for good measure
     features = pd.merge(all_features, propstable, on="label")
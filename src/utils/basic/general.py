@@ -2,6 +2,7 @@ import datetime
 import time
 
 import numpy as np
+import pandas as pd
 
 
 def get_timestamp():
@@ -49,3 +50,31 @@ def key_in_dict(keys, dictionary):
 
 def combine_path(x):
     return np.array("/".join(x), dtype=object)
+
+
+def combine_paths(parts):
+    r"""Joins the given path components element-wise.
+
+    Vectorized version of applying combine_path along the first axis of the given components.
+
+    Parameters
+    ----------
+    parts : list
+        Path components, each given by a string or an array of the same length as the other arrays.
+
+    Returns
+    -------
+    paths : np.ndarray
+        Object array of the joined paths.
+    """
+    n = max([len(part) for part in parts if not isinstance(part, str)], default=1)
+    paths = None
+    for part in parts:
+        if isinstance(part, str):
+            part = np.repeat(part, n).astype(object)
+        else:
+            # Only the unique values are converted to strings
+            codes, uniques = pd.factorize(part, use_na_sentinel=False)
+            part = np.array(uniques, dtype=str).astype(object)[codes]
+        paths = part if paths is None else paths + "/" + part
+    return paths
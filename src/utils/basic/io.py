@@ -1,32 +1,408 @@
+import fcntl
+import json
+import logging
 import os
-from typing import List
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Tuple
 
+import numpy as np
 import pandas as pd
 
+# ioctl request code to clone the extents of a file (copy-on-write) on e.g. btrfs or XFS
+FICLONE = 0x40049409
+
 
 def get_file_list(
     root_dir: str,
     absolute_path: bool = True,
     file_ending: bool = True,
     file_type_filter: str = None,
+    n_jobs: int = 8,
 ) -> List:
 
     assert os.path.exists(root_dir)
     list_of_data_locs = []
-    for (root_dir, dirname, filename) in os.walk(root_dir):
-        for file in filename:
+    for dir_path, record in iter_file_index(root_dir, n_jobs=n_jobs):
+        for file, _, _ in record["files"]:
             if file_type_filter is not None and file_type_filter not in file:
                 continue
             else:
                 if not file_ending:
                     file = file[: file.index(".")]
                 if absolute_path:
-                    list_of_data_locs.append(os.path.join(root_dir, file))
+                    list_of_data_locs.append(os.path.join(dir_path, file))
                 else:
                     list_of_data_locs.append(file)
     return sorted(list_of_data_locs)
 
 
+def get_file_stats(file) -> List:
+    # Returns the size and modification time of a file given by its path or a directory entry
+    try:
+        stat = file.stat() if isinstance(file, os.DirEntry) else os.stat(file)
+        return [stat.st_size, stat.st_mtime_ns]
+    except FileNotFoundError:
+        return [None, None]
+
+
+def scan_dir(
+    dir_path: str, with_stats: bool = False, manifest: dict = None
+) -> Iterator[Tuple[str, dict]]:
+    r"""Recursively lists the files of a directory tree with os.scandir.
+
+    Parameters
+    ----------
+    dir_path : str
+        Path to the root of the directory tree.
+    with_stats : bool
+        If True the size and modification time of every file are obtained as well.
+    manifest : dict
+        Records of a previous scan (see index_files). Directories whose modification time did not change since then
+        are not listed again. As files that are modified in place do not change the modification time of their
+        directory, the stats of the files of these directories are nevertheless obtained anew if requested.
+
+    Yields
+    ------
+    dir_path : str
+        Path to a directory of the tree.
+    record : dict
+        The modification time (``"mtime_ns"``), the subdirectories (``"dirs"``) and the files given by their name,
+        size and modification time (``"files"``) of the directory. Sizes and modification times are None if not
+        requested.
+    """
+    dir_mtime = os.stat(dir_path).st_mtime_ns
+    record = None
+    if manifest is not None and dir_path in manifest:
+        record = manifest[dir_path]
+        if record["mtime_ns"] != dir_mtime:
+            record = None
+        elif with_stats:
+            # Only the listing of the directory is reused
+            record = dict(
+                record,
+                stats=True,
+                files=[
+                    [file] + get_file_stats(os.path.join(dir_path, file))
+                    for file, _, _ in record["files"]
+                ],
+            )
+    if record is None:
+        record = {"mtime_ns": dir_mtime, "stats": with_stats, "dirs": [], "files": []}
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                # Symbolic links to directories are not followed as by os.walk
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        record["dirs"].append(entry.name)
+                    continue
+                if with_stats:
+                    record["files"].append([entry.name] + get_file_stats(entry))
+                else:
+                    record["files"].append([entry.name, None, None])
+    yield dir_path, record
+    for dir_name in record["dirs"]:
+        yield from scan_dir(
+            os.path.join(dir_path, dir_name), with_stats=with_stats, manifest=manifest
+        )
+
+
+def iter_file_index(
+    root_dir: str, with_stats: bool = False, manifest: dict = None, n_jobs: int = 8
+) -> Iterator[Tuple[str, dict]]:
+    r"""Streams the records of the directories of a tree (see scan_dir).
+
+    The subdirectories of the root directory (e.g. the plates) are scanned by n_jobs threads and their records are
+    returned as soon as the scan of the respective subdirectory is complete.
+    """
+    root_records = scan_dir(root_dir, with_stats=with_stats, manifest=manifest)
+    root_dir, root_record = next(root_records)
+    root_records.close()
+    yield root_dir, root_record
+
+    def scan_subdir(dir_name: str) -> List[Tuple[str, dict]]:
+        return list(
+            scan_dir(
+                os.path.join(root_dir, dir_name),
+                with_stats=with_stats,
+                manifest=manifest,
+            )
+        )
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        for records in executor.map(scan_subdir, root_record["dirs"]):
+            yield from records
+
+
+def index_files(
+    root_dir: str,
+    file_type_filter: str = None,
+    with_stats: bool = True,
+    manifest_file: str = None,
+    n_jobs: int = 8,
+) -> pd.DataFrame:
+    r"""Returns the paths (sorted), sizes and modification times of all files in a directory tree.
+
+    Parameters
+    ----------
+    root_dir : str
+        Path to the root of the directory tree.
+    file_type_filter : str
+        If given, only files whose name contains the string are returned.
+    with_stats : bool
+        If True the size and modification time of every file are obtained as well.
+    manifest_file : str
+        Path to a JSON file holding the records of the directories. If it exists, the records of unchanged
+        directories are reused (see scan_dir) and the file is updated afterwards.
+    n_jobs : int
+        Number of threads scanning the subdirectories of the root directory.
+
+    Returns
+    -------
+    file_index : pd.DataFrame
+        The columns ``path``, ``size`` and ``mtime_ns`` of the files.
+    """
+    manifest = None
+    if manifest_file is not None and os.path.exists(manifest_file):
+        with open(manifest_file, "r") as f:
+            manifest = json.load(f)
+        if manifest["root_dir"] == root_dir:
+            manifest = manifest["dirs"]
+        else:
+            manifest = None
+
+    records = {}
+    paths, sizes, mtimes = [], [], []
+    for dir_path, record in iter_file_index(
+        root_dir, with_stats=with_stats, manifest=manifest, n_jobs=n_jobs
+    ):
+        records[dir_path] = record
+        for file, size, mtime in record["files"]:
+            if file_type_filter is None or file_type_filter in file:
+                paths.append(os.path.join(dir_path, file))
+                sizes.append(size)
+                mtimes.append(mtime)
+
+    if manifest_file is not None:
+        with open(manifest_file + ".tmp", "w") as f:
+            json.dump({"root_dir": root_dir, "dirs": records}, f)
+        os.replace(manifest_file + ".tmp", manifest_file)
+
+    file_index = pd.DataFrame({"path": paths, "size": sizes, "mtime_ns": mtimes})
+    return file_index.sort_values("path", ignore_index=True)
+
+
+def save_table(
+    data: pd.DataFrame, file_path: str, data_columns: List[str] = None
+) -> None:
+    r"""Saves the data frame as (gzipped) CSV or, if file_path ends with ``.h5``, as compressed HDF5 table.
+
+    Parameters
+    ----------
+    data : pd.DataFrame
+        The data frame to save.
+    file_path : str
+        Path to the output file.
+    data_columns : list
+        Columns of the HDF5 table that are indexed such that rows can be selected by their values when reading the
+        table (see read_table). Columns not contained in the data frame are ignored.
+    """
+    if not file_path.endswith(".h5"):
+        data.to_csv(file_path)
+        return
+    if data_columns is not None:
+        data_columns = [col for col in data_columns if col in data.columns]
+    # PyTables can only store object columns of strings
+    data = data.copy()
+    for col in data.columns:
+        if data[col].dtype == object and pd.api.types.infer_dtype(
+            data[col], skipna=True
+        ) not in ["string", "empty"]:
+            data[col] = data[col].astype(str)
+    data.to_hdf(
+        file_path,
+        key="table",
+        mode="w",
+        format="table",
+        data_columns=data_columns,
+        complib="blosc:zstd",
+        complevel=5,
+    )
+
+
+def get_common_dtype(dtype1, dtype2) -> np.dtype:
+    r"""Returns the dtype of a column that can hold values of both dtypes, i.e. object if any is not numeric."""
+    if dtype1.kind not in "biuf" or dtype2.kind not in "biuf":
+        return np.dtype(object)
+    return np.result_type(dtype1, dtype2)
+
+
+def update_common_dtypes(dtypes: dict, data: pd.DataFrame):
+    r"""Updates the dtypes of the columns of the data frames seen so far (e.g. the parts of a table) with the ones of
+    the given data frame such that every column can hold the values of all data frames (see get_common_dtype)."""
+    for col, dtype in data.dtypes.items():
+        dtypes[col] = get_common_dtype(dtypes[col], dtype) if col in dtypes else dtype
+
+
+class TableWriter(object):
+    r"""Writes a table (see save_table) by appending data frames with the same columns.
+
+    CSV files are appended as additional gzip members. For HDF5 tables, the string columns are padded to at least
+    min_itemsize characters as their width is fixed by the first data frame and empty data frames are skipped. The
+    file is only created once a data frame has been appended.
+
+    The columns are cast to the given dtypes (e.g. obtained by update_common_dtypes over all data frames) and, for
+    HDF5 tables, the dtypes of columns not given are fixed by the first data frame. Values of object columns are
+    converted to strings while missing values are kept.
+    """
+
+    def __init__(
+        self,
+        file_path: str,
+        data_columns: List[str] = None,
+        min_itemsize: int = 256,
+        dtypes: dict = None,
+    ):
+        self.file_path = file_path
+        self.data_columns = data_columns
+        self.min_itemsize = min_itemsize
+        self.dtypes = {} if dtypes is None else dict(dtypes)
+        self.n_rows = 0
+        self.n_appends = 0
+
+        if os.path.exists(self.file_path):
+            os.remove(self.file_path)
+
+    def normalize_dtypes(self, data: pd.DataFrame, fix_dtypes: bool) -> pd.DataFrame:
+        data = data.copy()
+        for col in data.columns:
+            values = data[col]
+            if col not in self.dtypes:
+                if not fix_dtypes:
+                    continue
+                self.dtypes[col] = values.dtype
+            dtype = np.dtype(self.dtypes[col])
+            if dtype == object:
+                data[col] = values.astype(str).where(values.notna(), np.nan)
+            elif values.dtype != dtype:
+                # Only lossless casts are applied and missing values require a float column
+                lossless = values.dtype != object and (
+                    dtype.kind == "f" or not values.isna().any()
+                )
+                if lossless:
+                    cast_values = values.astype(dtype)
+                    lossless = ((cast_values == values) | values.isna()).all()
+                if not lossless:
+                    raise ValueError(
+                        "Column {} of dtype {} cannot be written as {} to {}, declare the common dtype of the "
+                        "column.".format(col, values.dtype, dtype, self.file_path)
+                    )
+                data[col] = cast_values
+        return data
+
+    def append(self, data: pd.DataFrame):
+        if not self.file_path.endswith(".h5"):
+            data = self.normalize_dtypes(data, fix_dtypes=False)
+            data.to_csv(self.file_path, mode="a", header=self.n_appends == 0)
+            self.n_rows += len(data)
+            self.n_appends += 1
+            return
+        if len(data) == 0:
+            return
+        data = self.normalize_dtypes(data, fix_dtypes=True)
+        if self.n_appends == 0:
+            min_itemsize = {
+                col: max(self.min_itemsize, data[col].str.len().max())
+                for col in data.columns
+                if np.dtype(self.dtypes[col]) == object
+            }
+        else:
+            min_itemsize = None
+        data_columns = self.data_columns
+        if data_columns is not None:
+            data_columns = [col for col in data_columns if col in data.columns]
+        data.to_hdf(
+            self.file_path,
+            key="table",
+            mode="a",
+            append=True,
+            format="table",
+            data_columns=data_columns,
+            min_itemsize=min_itemsize,
+            complib="blosc:zstd",
+            complevel=5,
+        )
+        self.n_rows += len(data)
+        self.n_appends += 1
+
+
+def get_table_columns(file_path: str) -> List[str]:
+    r"""Returns the columns of a table saved by save_table without reading its rows."""
+    if file_path.endswith(".h5"):
+        with pd.HDFStore(file_path, mode="r") as store:
+            return list(store.get_storer("table").non_index_axes[0][1])
+    return list(pd.read_csv(file_path, index_col=0, nrows=0).columns)
+
+
+def read_table(
+    file_path: str, columns: List[str] = None, filters: dict = None
+) -> pd.DataFrame:
+    r"""Reads a table saved by save_table.
+
+    Parameters
+    ----------
+    file_path : str
+        Path to the CSV or HDF5 (``.h5``) file.
+    columns : list
+        The columns to read, all columns are read if not given.
+    filters : dict
+        Maps columns to lists of values. Only rows whose values are contained in these lists are returned. For HDF5
+        tables, only the selected rows are read if the columns are indexed.
+
+    Returns
+    -------
+    data : pd.DataFrame
+        The selected rows and columns of the table.
+    """
+    if filters is None:
+        filters = {}
+    if columns is not None:
+        columns = list(columns)
+    if file_path.endswith(".h5"):
+        with pd.HDFStore(file_path, mode="r") as store:
+            data_columns = store.get_storer("table").data_columns
+            where = [
+                "{} in {}".format(col, list(values))
+                for col, values in filters.items()
+                if col in data_columns
+            ]
+            # Columns used for filtering are read as well and removed afterwards
+            read_columns = columns
+            if columns is not None:
+                read_columns = columns + [
+                    col for col in filters if col not in columns
+                ]
+            data = store.select(
+                "table", where=where if len(where) > 0 else None, columns=read_columns
+            )
+    else:
+        usecols = None
+        if columns is not None:
+            # The first column holds the index
+            selected = set(columns).union(filters)
+            usecols = [0] + [
+                i + 1
+                for i, col in enumerate(get_table_columns(file_path))
+                if col in selected
+            ]
+        data = pd.read_csv(file_path, index_col=0, usecols=usecols)
+    for col, values in filters.items():
+        data = data.loc[data[col].isin(values)]
+    if columns is not None:
+        data = data.loc[:, columns]
+    return data
+
+
 def get_genesets_from_gmt_file(file):
     data = pd.read_csv(file, sep="\t", index_col=0, header=None)
     data = data.iloc[:, 1:]
@@ -34,3 +410,68 @@ def get_genesets_from_gmt_file(file):
     for i in data.index:
         geneset_dict[i] = list(data.loc[i].loc[data.loc[i].notnull()])
     return geneset_dict
+
+
+def stage_file(
+    input_file: str, output_file: str, link_mode: str = "copy"
+) -> Tuple[str, int]:
+    r"""Makes the file at input_file available at output_file without duplicating its content if possible.
+
+    Parameters
+    ----------
+    input_file : str
+        Path to the source file.
+    output_file : str
+        Path to the staged file.
+    link_mode : str
+        One of ``"copy"``, ``"hardlink"``, ``"reflink"`` or ``"symlink"``. If a hard link or reflink cannot be
+        created (e.g. across file systems) the file is copied instead.
+
+    Returns
+    -------
+    action : str
+        One of ``"skipped"`` if an identical file already existed at output_file, ``"linked"``, ``"copied"`` or
+        ``"missing"`` if there is no file at input_file.
+    n_bytes : int
+        The size of the input file in bytes.
+    """
+    if link_mode not in ["copy", "hardlink", "reflink", "symlink"]:
+        raise ValueError("Unknown link mode: {}".format(link_mode))
+    try:
+        input_stat = os.stat(input_file)
+    except FileNotFoundError as e:
+        logging.error(e)
+        return "missing", 0
+
+    # Files of the same size and modification time are assumed to be identical
+    if os.path.lexists(output_file):
+        if os.path.exists(output_file):
+            output_stat = os.stat(output_file)
+            if os.path.samefile(input_file, output_file) or (
+                output_stat.st_size == input_stat.st_size
+                and output_stat.st_mtime_ns == input_stat.st_mtime_ns
+            ):
+                return "skipped", input_stat.st_size
+        os.remove(output_file)
+
+    if link_mode == "symlink":
+        os.symlink(os.path.abspath(input_file), output_file)
+        return "linked", input_stat.st_size
+    if link_mode == "hardlink":
+        try:
+            os.link(input_file, output_file)
+            return "linked", input_stat.st_size
+        except OSError:
+            pass
+    elif link_mode == "reflink":
+        try:
+            with open(input_file, "rb") as src, open(output_file, "wb") as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            shutil.copystat(input_file, output_file)
+            return "linked", input_stat.st_size
+        except OSError:
+            if os.path.exists(output_file):
+                os.remove(output_file)
+    # Metadata is copied as well such that unchanged files are skipped when staging again
+    shutil.copy2(input_file, output_file)
+    return "copied", input_stat.st_size
@@ -0,0 +1,108 @@
+import threading
+import time
+
+import psutil
+
+
+class ResourceMonitor(object):
+    r"""Measures the resources used by the current process and its child processes (e.g. joblib workers).
+
+    The process tree is sampled every interval seconds by a background thread while the monitor is active. The CPU
+    time and the I/O of every process are measured relative to their values when the monitor was started (or when a
+    child process was first seen). Resources used by child processes that terminate between two samples after their
+    last sample are not accounted for.
+
+    The I/O is given by the bytes passed to read and write calls (including cached reads but excluding memory-mapped
+    files) if available and by the bytes read from and written to the storage otherwise.
+    """
+
+    def __init__(self, interval: float = 0.1):
+        self.interval = interval
+        self.process = psutil.Process()
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.start_time = None
+        self.stop_time = None
+        self.peak_rss = 0
+        # First and last sampled CPU time and I/O counters of every process
+        self.first_samples = {}
+        self.last_samples = {}
+
+    @staticmethod
+    def get_process_sample(process: psutil.Process):
+        with process.oneshot():
+            cpu_times = process.cpu_times()
+            try:
+                io_counters = process.io_counters()
+                read_bytes = getattr(io_counters, "read_chars", io_counters.read_bytes)
+                write_bytes = getattr(
+                    io_counters, "write_chars", io_counters.write_bytes
+                )
+            except (psutil.AccessDenied, AttributeError):
+                read_bytes, write_bytes = 0, 0
+            return (
+                process.memory_info().rss,
+                cpu_times.user + cpu_times.system,
+                read_bytes,
+                write_bytes,
+            )
+
+    def sample(self, baseline: bool = False):
+        rss = 0
+        processes = [self.process] + self.process.children(recursive=True)
+        for process in processes:
+            try:
+                process_rss, *counters = self.get_process_sample(process)
+            except (psutil.NoSuchProcess, psutil.ZombieProcess):
+                continue
+            rss += process_rss
+            if process.pid not in self.first_samples:
+                # Processes started after the monitor count from zero
+                self.first_samples[process.pid] = (
+                    counters if baseline else [0] * len(counters)
+                )
+            self.last_samples[process.pid] = counters
+        self.peak_rss = max(self.peak_rss, rss)
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self.start_time = time.time()
+        self.sample(baseline=True)
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+        self.sample()
+        self.stop_time = time.time()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def get_stats(self) -> dict:
+        r"""Returns the wall time and CPU time (in s), the peak RSS of the process tree and the bytes read and
+        written."""
+        deltas = [
+            [
+                last - first
+                for first, last in zip(self.first_samples[pid], self.last_samples[pid])
+            ]
+            for pid in self.last_samples
+        ]
+        stop_time = self.stop_time if self.stop_time is not None else time.time()
+        return {
+            "wall_time": stop_time - self.start_time,
+            "cpu_time": sum([delta[0] for delta in deltas]),
+            "peak_rss": self.peak_rss,
+            "read_bytes": sum([delta[1] for delta in deltas]),
+            "write_bytes": sum([delta[2] for delta in deltas]),
+        }
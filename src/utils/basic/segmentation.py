@@ -3,6 +3,8 @@ from typing import Tuple
 import numpy as np
 from numpy import ndarray
 from scipy.ndimage import binary_fill_holes
+from skimage.measure import label
+from skimage.morphology import remove_small_holes, remove_small_objects
 
 
 def get_mask_image_from_outline(outline_image: ndarray) -> ndarray:
@@ -12,6 +14,16 @@ def get_mask_image_from_outline(outline_image: ndarray) -> ndarray:
     return binary
 
 
+def get_label_image_from_outline(
+    outline_image: ndarray, min_area: int = None, fill_holes: int = 16
+) -> ndarray:
+    mask_image = get_mask_image_from_outline(outline_image)
+    mask_image = remove_small_holes(mask_image, area_threshold=fill_holes)
+    if min_area is not None:
+        mask_image = remove_small_objects(mask_image, min_size=min_area)
+    return label(mask_image)
+
+
 def pad_image(image: ndarray, size: Tuple[int]) -> ndarray:
     padded_img = np.zeros(size)
     img_x, img_y = image.shape
@@ -29,3 +41,42 @@ def pad_image(image: ndarray, size: Tuple[int]) -> ndarray:
     ] = image
 
     return padded_img
+
+
+def pad_and_normalize_image(image: ndarray, size: Tuple[int]) -> ndarray:
+    padded_image = pad_image(image, size)
+    padded_image = padded_image.astype(np.uint16)
+    padded_image = padded_image - padded_image.min()
+    padded_image = padded_image / padded_image.max()
+    padded_image = np.clip(padded_image, 0, 1)
+    padded_image = (padded_image * 255).astype(np.uint8)
+    return padded_image
+
+
+def normalize_image_to_uint8(image: ndarray) -> ndarray:
+    # Images with intensities exceeding the 8-bit range are rescaled w.r.t. their 0.1 and 99.9 percentiles
+    if (image > 255).any():
+        image_min = np.percentile(image, 0.1)
+        image_max = np.percentile(image, 99.9)
+        if image_max > 255:
+            image = image - image_min
+            image = image / image_max
+        image = np.clip(image, 0, 1) * 255
+        image = np.uint8(image)
+    return image
+
+
+def get_centered_crop(
+    image: ndarray, centroid: Tuple[float], size: int, fill: int
+) -> ndarray:
+    # Equivalent to padding the image by size pixels on every side with the fill value before cropping the window
+    top = int(centroid[0]) + (size // 2) - size
+    left = int(centroid[1]) + (size // 2) - size
+    window = np.full((size, size) + image.shape[2:], fill, dtype=image.dtype)
+    rows = slice(max(top, 0), min(top + size, image.shape[0]))
+    cols = slice(max(left, 0), min(left + size, image.shape[1]))
+    if rows.start < rows.stop and cols.start < cols.stop:
+        window[
+            rows.start - top : rows.stop - top, cols.start - left : cols.stop - left
+        ] = image[rows, cols]
+    return window
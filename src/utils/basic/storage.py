@@ -0,0 +1,327 @@
+import atexit
+import fcntl
+import glob
+import json
+import os
+import shutil
+import tempfile
+from typing import List, Tuple
+
+import numpy as np
+import pandas as pd
+
+CROP_STORE_MARKER = "crop_store.json"
+
+
+class PackedCropWriter(object):
+    r"""Writer for a packed crop store.
+
+    Crops are appended to chunked binary files per plate (``<store_dir>/<plate>/<part>_<chunk>.bin``) and their
+    offsets and shapes are recorded in an index file for the part that is written when the writer is closed. Writing
+    a part again overwrites the previous version of that part.
+    """
+
+    def __init__(self, store_dir: str, part_name: str = "all", chunk_size: int = 2 ** 30):
+        self.store_dir = store_dir
+        self.part_name = part_name
+        self.chunk_size = chunk_size
+        self.index = []
+        self.open_chunks = {}
+
+        os.makedirs(os.path.join(self.store_dir, "index"), exist_ok=True)
+        with open(os.path.join(self.store_dir, CROP_STORE_MARKER), "w") as f:
+            json.dump({"format": "packed_crops", "version": 1}, f)
+
+    def _open_chunk(self, plate: str, chunk: int):
+        plate_dir = os.path.join(self.store_dir, plate)
+        os.makedirs(plate_dir, exist_ok=True)
+        chunk_file = "{}_{:04d}.bin".format(self.part_name, chunk)
+        self.open_chunks[plate] = [
+            open(os.path.join(plate_dir, chunk_file), "wb"),
+            chunk,
+            os.path.join(plate, chunk_file),
+            0,
+        ]
+
+    def add(self, plate: str, image_file: str, crop: np.ndarray):
+        plate = str(plate)
+        crop = np.ascontiguousarray(crop)
+        if plate not in self.open_chunks:
+            self._open_chunk(plate, 0)
+        elif self.open_chunks[plate][3] + crop.nbytes > self.chunk_size:
+            self.open_chunks[plate][0].close()
+            self._open_chunk(plate, self.open_chunks[plate][1] + 1)
+        handle, _, chunk_file, offset = self.open_chunks[plate]
+
+        handle.write(crop.tobytes())
+        self.index.append(
+            [
+                plate + "/" + image_file,
+                chunk_file,
+                offset,
+                crop.dtype.str,
+                crop.shape[0],
+                crop.shape[1],
+            ]
+        )
+        # Keep offsets 8-byte aligned such that crops of any dtype can be viewed without copying
+        padding = -crop.nbytes % 8
+        handle.write(b"\0" * padding)
+        self.open_chunks[plate][3] = offset + crop.nbytes + padding
+
+    def close(self):
+        for handle, _, _, _ in self.open_chunks.values():
+            handle.close()
+        self.open_chunks = {}
+        index_file = os.path.join(
+            self.store_dir, "index", "{}_index.csv".format(self.part_name)
+        )
+        pd.DataFrame(
+            self.index, columns=["key", "file", "offset", "dtype", "height", "width"]
+        ).to_csv(index_file + ".tmp", index=False)
+        os.replace(index_file + ".tmp", index_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            for handle, _, _, _ in self.open_chunks.values():
+                handle.close()
+
+
+class TablePartWriter(object):
+    r"""Appendable on-disk table that is written and read back part by part.
+
+    Every appended data frame is pickled to ``<table_dir>/<part>.pkl`` such that large tables can be assembled
+    without holding them in memory and the parts keep their dtypes. Existing parts are removed when the writer is
+    created.
+    """
+
+    def __init__(self, table_dir: str):
+        self.table_dir = table_dir
+        self.n_parts = 0
+
+        if os.path.exists(self.table_dir):
+            shutil.rmtree(self.table_dir)
+        os.makedirs(self.table_dir)
+
+    def append(self, data: pd.DataFrame):
+        data.to_pickle(
+            os.path.join(self.table_dir, "{:06d}.pkl".format(self.n_parts))
+        )
+        self.n_parts += 1
+
+    def __len__(self):
+        return self.n_parts
+
+    def __iter__(self):
+        for part in range(self.n_parts):
+            yield pd.read_pickle(
+                os.path.join(self.table_dir, "{:06d}.pkl".format(part))
+            )
+
+    def remove(self):
+        shutil.rmtree(self.table_dir)
+        self.n_parts = 0
+
+
+class PackedCropStore(object):
+    r"""Read-only access to the crops of a packed crop store.
+
+    Crops are keyed by ``<plate>/<image_file>`` and returned as zero-copy views of the memory-mapped chunk files.
+    """
+
+    def __init__(self, store_dir: str, part_names: List[str] = None):
+        self.store_dir = store_dir
+        if part_names is None:
+            index_files = sorted(
+                glob.glob(os.path.join(self.store_dir, "index", "*_index.csv"))
+            )
+        else:
+            index_files = [
+                os.path.join(self.store_dir, "index", "{}_index.csv".format(part_name))
+                for part_name in part_names
+            ]
+        if len(index_files) > 0:
+            index = pd.concat(
+                [pd.read_csv(index_file) for index_file in index_files],
+                ignore_index=True,
+            )
+        else:
+            index = pd.DataFrame(
+                columns=["key", "file", "offset", "dtype", "height", "width"]
+            )
+
+        self.keys = np.array(index.loc[:, "key"], dtype=object)
+        self.files, self.file_ids = np.unique(
+            np.array(index.loc[:, "file"], dtype=str), return_inverse=True
+        )
+        self.dtypes, self.dtype_ids = np.unique(
+            np.array(index.loc[:, "dtype"], dtype=str), return_inverse=True
+        )
+        self.offsets = np.array(index.loc[:, "offset"], dtype=np.int64)
+        self.shapes = np.array(index.loc[:, ["height", "width"]], dtype=np.int64)
+        self.key_positions = dict(zip(self.keys, range(len(self.keys))))
+        self.memmaps = {}
+
+    @staticmethod
+    def is_store(store_dir: str) -> bool:
+        return store_dir is not None and os.path.exists(
+            os.path.join(store_dir, CROP_STORE_MARKER)
+        )
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.key_positions
+
+    def __getitem__(self, key: str) -> np.ndarray:
+        return self.get_crop(self.key_positions[key])
+
+    def get_crop(self, position: int) -> np.ndarray:
+        file_id = self.file_ids[position]
+        if file_id not in self.memmaps:
+            self.memmaps[file_id] = np.memmap(
+                os.path.join(self.store_dir, self.files[file_id]),
+                dtype=np.uint8,
+                mode="r",
+            )
+        dtype = np.dtype(self.dtypes[self.dtype_ids[position]])
+        shape = self.shapes[position]
+        offset = self.offsets[position]
+        nbytes = shape[0] * shape[1] * dtype.itemsize
+        return (
+            self.memmaps[file_id][offset : offset + nbytes]
+            .view(dtype)
+            .reshape(shape)
+        )
+
+    def __getstate__(self):
+        # Memory maps are reopened lazily e.g. in every data loader worker
+        state = self.__dict__.copy()
+        state["memmaps"] = {}
+        return state
+
+
+class SharedImageCache(object):
+    r"""Cache of decoded uint8 images of a fixed shape that is shared by all processes using it.
+
+    The images are kept in a memory-mapped file (in ``/dev/shm`` if available) that is mapped by every process, e.g.
+    by all data loader workers, such that an image decoded by one process is available to all others. The cache holds
+    as many images as fit into the given byte budget. It is direct-mapped: the image of item idx is stored in slot
+    ``idx % n_slots`` and evicts the image of the item previously stored there.
+
+    Writes are serialized by a file lock. Every slot has a version counter that is odd while the slot is written,
+    such that reads do not need a lock and a read that overlaps with a write is treated as a miss. The file is removed
+    when the process that created the cache exits.
+    """
+
+    def __init__(
+        self,
+        n_items: int,
+        image_shape: Tuple[int, int],
+        max_bytes: int,
+        cache_dir: str = None,
+    ):
+        if cache_dir is None:
+            cache_dir = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+        self.image_shape = tuple(image_shape)
+        self.n_slots = int(
+            min(n_items, max_bytes // (self.image_shape[0] * self.image_shape[1]))
+        )
+        if self.n_slots < 1:
+            raise ValueError(
+                "The cache size of {} bytes is too small for images of shape {}.".format(
+                    max_bytes, self.image_shape
+                )
+            )
+        handle, self.file_path = tempfile.mkstemp(
+            prefix="image_cache_", suffix=".bin", dir=cache_dir
+        )
+        # The file is sparse, hence only the pages of the cached images take up memory
+        os.ftruncate(handle, 16 * self.n_slots + self.n_slots * self.slot_size)
+        os.close(handle)
+        atexit.register(self.remove, os.getpid())
+        self.memmaps = None
+        self.tags[:] = -1
+
+    @property
+    def slot_size(self) -> int:
+        return self.image_shape[0] * self.image_shape[1]
+
+    def _open(self):
+        # Slot tags (the cached item) and versions followed by the image data
+        self.memmaps = (
+            np.memmap(self.file_path, dtype=np.int64, mode="r+", shape=(self.n_slots,)),
+            np.memmap(
+                self.file_path,
+                dtype=np.int64,
+                mode="r+",
+                offset=8 * self.n_slots,
+                shape=(self.n_slots,),
+            ),
+            np.memmap(
+                self.file_path,
+                dtype=np.uint8,
+                mode="r+",
+                offset=16 * self.n_slots,
+                shape=(self.n_slots,) + self.image_shape,
+            ),
+        )
+
+    @property
+    def tags(self) -> np.ndarray:
+        if self.memmaps is None:
+            self._open()
+        return self.memmaps[0]
+
+    @property
+    def versions(self) -> np.ndarray:
+        if self.memmaps is None:
+            self._open()
+        return self.memmaps[1]
+
+    @property
+    def data(self) -> np.ndarray:
+        if self.memmaps is None:
+            self._open()
+        return self.memmaps[2]
+
+    def get(self, idx: int) -> np.ndarray:
+        r"""Returns a copy of the cached image of the item or None if it is not cached."""
+        slot = idx % self.n_slots
+        version = self.versions[slot]
+        if version % 2 == 1 or self.tags[slot] != idx:
+            return None
+        image = np.array(self.data[slot])
+        if self.versions[slot] != version:
+            return None
+        return image
+
+    def put(self, idx: int, image: np.ndarray) -> bool:
+        r"""Caches the image of the item if it is an uint8 image of the cache's image shape."""
+        if image.dtype != np.uint8 or image.shape != self.image_shape:
+            return False
+        slot = idx % self.n_slots
+        with open(self.file_path, "rb") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            self.versions[slot] += 1
+            self.tags[slot] = idx
+            self.data[slot] = image
+            self.versions[slot] += 1
+            fcntl.flock(f, fcntl.LOCK_UN)
+        return True
+
+    def remove(self, pid: int = None):
+        if (pid is None or pid == os.getpid()) and os.path.exists(self.file_path):
+            os.remove(self.file_path)
+
+    def __getstate__(self):
+        # Memory maps are reopened lazily e.g. in every data loader worker
+        state = self.__dict__.copy()
+        state["memmaps"] = None
+        return state
@@ -0,0 +1,170 @@
+import os
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+from scipy.ndimage import gaussian_filter
+from skimage.draw import ellipse
+from skimage.segmentation import find_boundaries
+from tifffile import tifffile
+
+
+def get_synthetic_field_of_view(
+    image_size: int = 1024,
+    n_nuclei: int = 200,
+    min_radius: int = 8,
+    max_radius: int = 20,
+    rng: np.random.Generator = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    r"""Generates a field of view with randomly placed, non-overlapping elliptic nuclei.
+
+    Parameters
+    ----------
+    image_size : int
+        Height and width of the field of view.
+    n_nuclei : int
+        Number of nuclei to place. Fewer nuclei are placed if the field of view is too crowded.
+    min_radius : int
+        Minimum radius of the axes of the nuclei.
+    max_radius : int
+        Maximum radius of the axes of the nuclei.
+    rng : np.random.Generator
+        Random number generator.
+
+    Returns
+    -------
+    intensity_image : np.ndarray
+        The 16-bit intensity image with a textured chromatin signal inside the nuclei and a noisy background.
+    label_image : np.ndarray
+        The corresponding label image.
+    """
+    if rng is None:
+        rng = np.random.default_rng(1234)
+    label_image = np.zeros((image_size, image_size), dtype=np.int32)
+    intensity_image = rng.normal(200, 20, size=label_image.shape)
+    # Smoothed noise with dense spots mimicking the chromatin texture
+    texture = gaussian_filter(rng.normal(0, 1, size=label_image.shape), sigma=1.5)
+    texture = texture / texture.std()
+    label = 0
+    for _ in range(20 * n_nuclei):
+        if label == n_nuclei:
+            break
+        r_radius, c_radius = rng.integers(min_radius, max_radius + 1, size=2)
+        center = rng.integers(max_radius, image_size - max_radius, size=2)
+        rr, cc = ellipse(
+            center[0],
+            center[1],
+            r_radius,
+            c_radius,
+            shape=label_image.shape,
+            rotation=rng.uniform(0, np.pi),
+        )
+        if (label_image[rr, cc] > 0).any():
+            continue
+        label += 1
+        label_image[rr, cc] = label
+        brightness = rng.uniform(800, 3000)
+        intensity_image[rr, cc] += brightness * (1 + 0.3 * texture[rr, cc])
+    intensity_image = np.clip(intensity_image, 0, 2 ** 16 - 1).astype(np.uint16)
+    return intensity_image, label_image
+
+
+def generate_synthetic_plates(
+    output_dir: str,
+    n_plates: int = 2,
+    n_images_per_plate: int = 8,
+    image_size: int = 1024,
+    n_nuclei: int = 200,
+    n_genes: int = 4,
+    seed: int = 1234,
+) -> str:
+    r"""Generates synthetic plates in the layout of the Rohban et al. data set.
+
+    The illumination-corrected images, label images and nuclei outline images are saved to
+    ``<output_dir>/{images,labels,outlines}/<plate>/`` and the image metadata to ``<output_dir>/metadata.csv``
+    using the ``Image_Metadata_*`` schema expected by the ImageDatasetPreprocessor.
+
+    Parameters
+    ----------
+    output_dir : str
+        Path to the output directory.
+    n_plates : int
+        Number of plates.
+    n_images_per_plate : int
+        Number of fields of view per plate.
+    image_size : int
+        Height and width of the fields of view.
+    n_nuclei : int
+        Number of nuclei per field of view.
+    n_genes : int
+        Number of genes assigned to the wells of the plates. The first gene is the empty control.
+    seed : int
+        Seed of the random number generator.
+
+    Returns
+    -------
+    metadata_file : str
+        Path to the metadata file.
+    """
+    rng = np.random.default_rng(seed)
+    genes = ["EMPTY"] + ["GENE{}".format(i) for i in range(1, n_genes)]
+    rows = []
+    for plate in range(1, n_plates + 1):
+        plate = 40000 + plate
+        for sub_dir in ["images", "labels", "outlines"]:
+            os.makedirs(os.path.join(output_dir, sub_dir, str(plate)), exist_ok=True)
+        for i in range(n_images_per_plate):
+            well = "{}{:02d}".format("abcdefgh"[(i // 12) % 8], i % 12 + 1)
+            gene = genes[i % n_genes]
+            image, label_image = get_synthetic_field_of_view(
+                image_size=image_size, n_nuclei=n_nuclei, rng=rng
+            )
+            outline_image = (
+                find_boundaries(label_image, mode="outer").astype(np.uint8) * 255
+            )
+            orig_image_file_name = "taoe005-u2os-{}-{}-{}.tif".format(plate, well, i)
+            image_file_name = orig_image_file_name.replace(".tif", "_illum_corrected.tif")
+            outline_file_name = orig_image_file_name.replace(".tif", "_outlines.tif")
+            tifffile.imsave(
+                os.path.join(output_dir, "images", str(plate), image_file_name), image
+            )
+            tifffile.imsave(
+                os.path.join(output_dir, "labels", str(plate), image_file_name),
+                label_image,
+            )
+            tifffile.imsave(
+                os.path.join(output_dir, "outlines", str(plate), outline_file_name),
+                outline_image,
+            )
+            rows.append(
+                {
+                    "Image_Metadata_Plate": plate,
+                    "Image_Metadata_Well": well,
+                    "Image_FileName_OrigHoechst": orig_image_file_name,
+                    "Image_FileName_IllumHoechst": image_file_name,
+                    "Image_FileName_NucleiOutlines": outline_file_name,
+                    "Image_Count_Nuclei": int(label_image.max()),
+                    "Image_Metadata_GeneID": i % n_genes,
+                    "Image_Metadata_GeneSymbol": gene,
+                    "Image_Metadata_IsLandmark": 0,
+                    "Image_Metadata_AlleleDesc": "WT",
+                    "Image_Metadata_ExpressionVector": "pLX317",
+                    "Image_Metadata_FlaggedForToxicity": 0,
+                    "Image_Metadata_IE_Blast_noBlast": "Blast",
+                    "Image_Metadata_IntendedOrfMismatch": 0,
+                    "Image_Metadata_OpenOrClosed": "Closed",
+                    "Image_Metadata_RNAiVirusPlateName": "plate",
+                    "Image_Metadata_Site": 1,
+                    "Image_Metadata_Type": "control" if gene == "EMPTY" else "trt",
+                    "Image_Metadata_Virus_Vol_ul": 0.5,
+                    "Image_Metadata_TimePoint_Hours": 96,
+                    "Image_Metadata_ASSAY_WELL_ROLE": "Untreated"
+                    if gene == "EMPTY"
+                    else "Treated",
+                    "Image_Metadata_QCFlag_isBlurry": 0,
+                    "Image_Metadata_QCFlag_isSaturated": 0,
+                }
+            )
+    metadata_file = os.path.join(output_dir, "metadata.csv")
+    pd.DataFrame(rows).to_csv(metadata_file, index=False)
+    return metadata_file
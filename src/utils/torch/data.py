@@ -23,6 +23,8 @@ def init_image_dataset(
     pseudo_rgb: bool = False,
     extra_features: List = None,
     nmco_feature_file: str = None,
+    image_cache_size: int = None,
+    index_cache_dir: str = None,
 ) -> TorchImageSlideDataset:
     logging.debug(
         "Load image data set from {} and label information from {}.".format(
@@ -41,6 +43,8 @@ def init_image_dataset(
         nmco_feature_file=nmco_feature_file,
         extra_features=extra_features,
         slide_image_name_col=slide_image_name_col,
+        image_cache_size=image_cache_size,
+        index_cache_dir=index_cache_dir,
     )
     logging.debug("Samples loaded: {}".format(len(image_dataset)))
     return image_dataset
@@ -61,6 +65,10 @@ def init_multi_image_dataset(
     pseudo_rgb: bool = False,
     extra_features: List = None,
     nmco_feature_file: str = None,
+    image_cache_size: int = None,
+    slide_cache_size: int = 64,
+    slide_patch_dir: str = None,
+    index_cache_dir: str = None,
 ) -> TorchImageSlideDataset:
     logging.debug(
         "Load single nuclei image data set from {}, slide image data set from {} and"
@@ -83,6 +91,10 @@ def init_multi_image_dataset(
         extra_features=extra_features,
         slide_image_name_col=slide_image_name_col,
         train_target_list=train_target_list,
+        image_cache_size=image_cache_size,
+        slide_cache_size=slide_cache_size,
+        slide_patch_dir=slide_patch_dir,
+        index_cache_dir=index_cache_dir,
     )
     logging.debug("Samples loaded: {}".format(len(image_dataset)))
     return image_dataset
@@ -95,6 +107,8 @@ def init_profile_dataset(
     target_list: List = None,
     exclude_features: List = None,
     slide_image_name_col: str = "slide_image_name",
+    scaler: str = "standard",
+    scaler_file: str = None,
 ):
     logging.debug("Load image data set from {}.".format(feature_label_file))
     profile_dataset = TorchProfileSlideDataset(
@@ -104,6 +118,8 @@ def init_profile_dataset(
         n_control_samples=n_control_samples,
         exclude_features=exclude_features,
         slide_image_name_col=slide_image_name_col,
+        scaler=scaler,
+        scaler_file=scaler_file,
     )
     logging.debug("Samples loaded: {}".format(len(profile_dataset)))
     return profile_dataset
@@ -275,6 +275,37 @@ def get_slide_image_transformations_dict(input_size):
     return data_transforms
 
 
+def get_slide_context_patch_transformations_dict(input_size):
+    # Transformations of precomputed slide context patches that were already cropped around the nuclei, resizing
+    # patches that were already resized to the input size returns a copy of the patch
+    data_transforms = {
+        "train": CustomCompose(
+            [
+                CustomResize(input_size),
+                CustomRandomHorizontalFlip(p=0.5),
+                CustomRandomVerticalFlip(p=0.5),
+                ToRGBTensor(),
+                CustomNormalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
+            ]
+        ),
+        "val": CustomCompose(
+            [
+                CustomResize(input_size),
+                ToRGBTensor(),
+                CustomNormalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
+            ]
+        ),
+        "test": CustomCompose(
+            [
+                CustomResize(input_size),
+                ToRGBTensor(),
+                CustomNormalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
+            ]
+        ),
+    }
+    return data_transforms
+
+
 def get_binary_slide_image_transformations_dict(input_size):
     data_transforms = {
         "train": CustomCompose(
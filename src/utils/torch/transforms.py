@@ -12,6 +12,8 @@ from torch_geometric.utils import negative_sampling, add_self_loops
 from torchvision import transforms
 from torchvision.transforms import functional as F
 
+from src.utils.basic.segmentation import get_centered_crop
+
 
 class CustomCompose(transforms.Compose):
     def __init__(self, transforms):
@@ -103,16 +105,13 @@ class CustomCenteredCrop(object):
     def __call__(self, img, kwargs):
         centroid = kwargs["centroid"]
         x, y = centroid[0], centroid[1]
-        fill = int(np.percentile(np.array(img), 1))
-        img = transforms.Pad(self.size, fill=fill)(img)
-        img = transforms.functional.crop(
-            img,
-            int(x) + (self.size // 2),
-            int(y) + (self.size // 2),
-            self.size,
-            self.size,
-        )
-        return img
+        # The fill value is kept with the image as the same slide image is cropped around all of its nuclei if it is
+        # cached by the data set
+        if "centered_crop_fill" not in img.info:
+            img.info["centered_crop_fill"] = int(np.percentile(np.array(img), 1))
+        fill = img.info["centered_crop_fill"]
+        window = get_centered_crop(np.asarray(img), centroid=[x, y], size=self.size, fill=fill)
+        return Image.fromarray(window, mode=img.mode)
 
     def __repr__(self):
         return self.__class__.__name__ + "(size={})".format(self.size)